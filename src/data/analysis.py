@@ -6,25 +6,36 @@ from config import *
 from analysis_comply import *
 from analysis_metadata import *
 from analysis_connections import *
+from analysis_colocation import *
+from analysis_graphs import *
+from snapshots import publish_analysis_snapshot
 
 
-def analyze_data():
+def analyze_data(incremental=False, resume=False):
     """
     Runs domain-specific analysis on the data. In our case, we have two time periods, and therefor we'll run
     the analysis on each period (we fill in data gaps, so it doesn't make sense to have a large gap in the middle)
-    :return:
+    :param incremental: keep the existing analysis store, only analyze days that were not analyzed yet, and
+    update the connection tables with new or changed days
+    :param resume: keep the existing analysis store, and continue an interrupted compliance analysis
+        from the last committed day
+    :return: path of the published snapshot (see snapshots.py)
     """
     logger.info("Analysing data")
 
-    try:
-        os.remove(analysis_store_path)
-    except OSError:
-        pass
+    # readers use the published snapshots, so the store can be rebuilt while they read
+    if not incremental and not resume:
+        try:
+            os.remove(analysis_store_path)
+        except OSError:
+            pass
 
-    analysis_comply()
+    analysis_comply(incremental=incremental, resume=resume)
     logger.info("----------------------------------------------------------")
     analysis_metadata()
     logger.info("----------------------------------------------------------")
-    analysis_connections()
-
-
+    analysis_connections(incremental=incremental)
+    logger.info("----------------------------------------------------------")
+    analysis_colocation()
+    logger.info("----------------------------------------------------------")
+    return publish_analysis_snapshot()
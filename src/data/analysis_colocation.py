@@ -0,0 +1,200 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pandas as pd
+from config import *
+from storage import store_lock
+from analysis_comply import read_analyzed_days
+from analysis_connections import _analysis_agg_m2m, _analysis_bucket_cutoffs, _analysis_connections_daily_levels, \
+    _analysis_mirror_m2m, _analysis_rssi_buckets, _analysis_split_cutoffs, _time_bin_minutes, \
+    _write_connections_tables, generate_analysis_connections_store_key
+from member_pairs import decode_pairs, pair_keys
+
+# Co-location tables are stored like the connection tables, as
+#   proximity/rssi_<cutoff>/colocation_m2m_dbl_<level> (cutoffs are analysis_colocation_rssi_cutoffs)
+analysis_colocation_table_name = 'colocation_m2m_dbl'
+
+# Number of chunks of pairs that are reduced before they are combined
+_analysis_colocation_combine_every = 10
+
+
+def analysis_colocation_store_key(rssi_cutoff, freq_name):
+    """
+    Generates the store key of a co-location table
+    :param rssi_cutoff: one of analysis_colocation_rssi_cutoffs
+    :param freq_name: name of the time level (e.g. - daily)
+    """
+    return generate_analysis_connections_store_key(rssi_cutoff, analysis_colocation_table_name + "_" + freq_name)
+
+
+def _analysis_colocation_validate():
+    """
+    Checks the co-location settings
+    """
+    if not 1 <= analysis_colocation_top_k <= 5:
+        raise ValueError("analysis_colocation_top_k should be between 1 and 5, got {}".format(
+            analysis_colocation_top_k))
+    if not 1 <= analysis_colocation_min_overlap <= analysis_colocation_top_k:
+        raise ValueError("analysis_colocation_min_overlap should be between 1 and analysis_colocation_top_k, "
+                         "got {}".format(analysis_colocation_min_overlap))
+    for freq, freq_name in analysis_colocation_freqs:
+        if freq != 'D' and freq.split('-')[0] not in _analysis_connections_daily_levels:
+            raise ValueError("Co-location tables are built daily, time level {} is not supported".format(freq))
+
+
+def _analysis_colocation_records(where, bucket_cutoffs):
+    """
+    Loads the beacons each member is at, in each time bin, while the member complies. With
+    analysis_colocation_top_k of 1, the closest beacon is read from m1cb, otherwise the top k
+    beacons are read from m5cb
+    :param where: where clause selecting the records of a day
+    :param bucket_cutoffs: cutoffs, ordered as returned by _analysis_bucket_cutoffs()
+    :return: table with datetime, beacon, member and rssi_bucket columns. Records that don't
+        pass the loosest cutoff are dropped
+    """
+    if analysis_colocation_top_k == 1:
+        with store_lock(analysis_store_path):
+            m1cb = pd.read_hdf(analysis_store_path, 'proximity/member_closest_beacon', where=where)
+        records = m1cb[['beacon', 'rssi']].reset_index()
+    else:
+        m5cb = pd.read_hdf(clean_store_path, 'proximity/member_5_closest_beacons', where=where).reset_index()
+        records = pd.concat([m5cb[['datetime', 'member', 'beacon_' + str(i), 'rssi_' + str(i)]]
+                             .rename(columns={'beacon_' + str(i): 'beacon', 'rssi_' + str(i): 'rssi'})
+                             for i in range(analysis_colocation_top_k)], ignore_index=True)
+    records = records[records.beacon.notnull()]
+
+    with store_lock(analysis_store_path):
+        m_comply = pd.read_hdf(analysis_store_path, 'proximity/member_comply', where=where)
+    comply = m_comply.reindex(pd.MultiIndex.from_arrays([records['datetime'], records['member']])).values
+    records = records[comply == True]
+
+    records = records.assign(rssi_bucket=_analysis_rssi_buckets(records.rssi.values.astype(float), bucket_cutoffs))
+    return records[records.rssi_bucket < len(bucket_cutoffs)][['datetime', 'beacon', 'member', 'rssi_bucket']]
+
+
+def _analysis_colocation_pairs(records):
+    """
+    Generates the co-located pairs of members, and reduces them to the minutes each pair spent
+    together in each rssi bucket. A pair is in the bucket of the member that is farther from the
+    beacon. Records are sorted by time bin, beacon and member, so the members at a beacon in a time
+    bin are contiguous, and their pairs are generated from the positions within the group, without
+    joining the table with itself. Pairs are generated in chunks of whole time bins, of about
+    analysis_colocation_chunk_pairs pairs, and each chunk is reduced before the next one.
+    With analysis_colocation_top_k > 1, a pair can share several beacons in a time bin. It's
+    counted once, if it shares at least analysis_colocation_min_overlap beacons
+    :param records: as returned by _analysis_colocation_records()
+    :return: table with member1, member2, rssi_bucket and minutes columns (member1 < member2)
+    """
+    member_codes, members = pd.factorize(records['member'], sort=True)
+    beacon_codes, _ = pd.factorize(records['beacon'])
+    times = records['datetime'].values.view('int64')
+    order = np.lexsort((member_codes, beacon_codes, times))
+    times = times[order]
+    beacon_codes = beacon_codes[order]
+    member_codes = member_codes[order]
+    buckets = records['rssi_bucket'].values[order]
+    count = len(order)
+
+    # number of pairs in which each record is the first member
+    new_group = np.ones(count, dtype=bool)
+    new_group[1:] = (times[1:] != times[:-1]) | (beacon_codes[1:] != beacon_codes[:-1])
+    group_starts = np.flatnonzero(new_group)
+    group_sizes = np.diff(np.append(group_starts, count))
+    partners = np.repeat(group_sizes, group_sizes) - (np.arange(count) - np.repeat(group_starts, group_sizes)) - 1
+    logger.info("Co-location - {} records, {} pairs, largest group {}".format(
+        count, partners.sum(), group_sizes.max()))
+
+    # chunks of whole time bins
+    bin_starts = np.flatnonzero(np.append(True, times[1:] != times[:-1]))
+    bin_pairs = np.add.reduceat(partners, bin_starts)
+    bin_chunks = np.append(0, np.cumsum(bin_pairs)[:-1]) // analysis_colocation_chunk_pairs
+    chunk_starts = np.append(bin_starts[np.flatnonzero(np.append(True, bin_chunks[1:] != bin_chunks[:-1]))], count)
+
+    minutes = None
+    reduced = []
+    for start, end in zip(chunk_starts[:-1], chunk_starts[1:]):
+        chunk_partners = partners[start:end]
+        total = chunk_partners.sum()
+        if total == 0:
+            continue
+        first = np.repeat(np.arange(start, end), chunk_partners)
+        second = first + np.arange(total) - np.repeat(np.cumsum(chunk_partners) - chunk_partners, chunk_partners) + 1
+        pairs = pd.DataFrame({'time': times[first],
+                              'pair': pair_keys(member_codes[first], member_codes[second], len(members)),
+                              'rssi_bucket': np.maximum(buckets[first], buckets[second])})
+        if analysis_colocation_top_k > 1:
+            # the bucket of the min_overlap-th shared beacon
+            pairs = pairs.sort_values(['time', 'pair', 'rssi_bucket'])
+            nth = pairs.groupby(['time', 'pair']).cumcount().values
+            pairs = pairs[nth == analysis_colocation_min_overlap - 1]
+        reduced.append(pairs.groupby(['pair', 'rssi_bucket']).size())
+        del pairs
+
+        if len(reduced) >= _analysis_colocation_combine_every:
+            minutes = _analysis_colocation_combine(minutes, reduced)
+            reduced = []
+    minutes = _analysis_colocation_combine(minutes, reduced)
+
+    if minutes is None:
+        return pd.DataFrame(columns=['member1', 'member2', 'rssi_bucket', 'minutes'])
+    minutes = (minutes * _time_bin_minutes()).rename('minutes').reset_index()
+    minutes['member1'], minutes['member2'] = decode_pairs(members, minutes['pair'].values)
+    return minutes[['member1', 'member2', 'rssi_bucket', 'minutes']]
+
+
+def _analysis_colocation_combine(minutes, reduced):
+    """
+    Helper, adds reduced chunks of pairs to the totals
+    """
+    if len(reduced) == 0:
+        return minutes
+    if minutes is not None:
+        reduced = [minutes] + reduced
+    return pd.concat(reduced).groupby(level=[0, 1]).sum()
+
+
+def analysis_colocation():
+    """
+    Creates the co-location tables: the minutes each pair of members spent at the same beacon,
+    while both complied. Days are processed one at a time, and the daily tables are rolled up
+    to the other levels in analysis_colocation_freqs. Tables are double sided, and written for
+    each of analysis_colocation_rssi_cutoffs
+    :return:
+    """
+    logger.info("Analysis - co-location")
+    _analysis_colocation_validate()
+    bucket_cutoffs = _analysis_bucket_cutoffs(analysis_colocation_rssi_cutoffs)
+    logger.info("##### Beacon RSSI cutoffs: {}, top {} beacons, overlap {}".format(
+        bucket_cutoffs, analysis_colocation_top_k, analysis_colocation_min_overlap))
+
+    analyzed_days = read_analyzed_days()
+    if analyzed_days is None:
+        logger.info("No analyzed days, skipping co-location")
+        return
+
+    daily = []
+    for day in analyzed_days.index:
+        where = "datetime >= '" + str(day) + "' & datetime < '" + str(day + pd.Timedelta(days=1)) + "'"
+        records = _analysis_colocation_records(where, bucket_cutoffs)
+        logger.info("Co-location - {}".format(day.date()))
+        if len(records) == 0:
+            continue
+        pairs = _analysis_colocation_pairs(records)
+        pairs['datetime'] = day
+        daily.append(pairs)
+        del records
+
+    if len(daily) == 0:
+        logger.info("No co-location records")
+        return
+
+    daily = _analysis_mirror_m2m(pd.concat(daily, ignore_index=True), 'member1', 'member2')
+    for freq, freq_name in analysis_colocation_freqs:
+        logger.info("Creating {}_{} tables".format(analysis_colocation_table_name, freq_name))
+        table = daily if freq == 'D' else _analysis_agg_m2m(daily, freq, 'member1', 'member2')
+        tables = _analysis_split_cutoffs(table, bucket_cutoffs, 'member1', 'member2')
+        _write_connections_tables(tables, analysis_colocation_table_name + "_" + freq_name)
+        del tables
+
+    logger.info('---------------------------------------')
+    logger.info('Completed analysis co-location!')
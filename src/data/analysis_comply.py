@@ -1,8 +1,24 @@
 from __future__ import absolute_import, division, print_function
 import datetime
+import time
+from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
 from config import *
+from storage import commit_unit, merge_units, recover_checkpoint, reset_checkpoint, store_lock
+
+# Tables created by analysis_comply(), in the order they are written to the analysis store
+analysis_comply_store_keys = ['proximity/member_closest_beacon', 'proximity/member_comply',
+                              'proximity/member_to_member', 'proximity/member_comply_dirty',
+                              'proximity/member_comply_daily']
+
+# Columns of the daily compliance summary (see _analysis_comply_summary)
+analysis_comply_summary_columns = ['observed_bins', 'off_board_hours', 'comply_hours',
+                                   'observed_bins_dirty', 'off_board_hours_dirty', 'comply_hours_dirty']
+
+# Days written by analysis_comply(), with the number of m2m_comply records and their checksum
+analysis_comply_days_store_key = 'proximity/member_to_member_days'
 
 
 def _analysis_m1cb(m5cb, members_metadata, beacons_metadata):
@@ -187,7 +203,41 @@ def _analysis_m2m_comply(m2m, m_comply):
     return df
 
 
+def _analysis_comply_summary(day, m1cb=None, m_comply=None, m1cb_dirty=None, m_comply_dirty=None):
+    """
+    Summarizes the compliance of a day, for each member: the number of time bins with a closest
+    beacon (observed_bins), the hours in which the closest beacon was not a board (off_board_hours),
+    and the hours in which the member complied, out of the observed bins (comply_hours). The
+    _dirty columns are the same, for the data before cleaning. Missing tables count as zeros
+    :param day: the day (midnight)
+    :return: table indexed by datetime (the day) and member, with analysis_comply_summary_columns
+    """
+    bin_hours = pd.Timedelta(time_bins_size).total_seconds() / 3600
+    columns = []
+    for suffix, m1cb_table, comply in [('', m1cb, m_comply), ('_dirty', m1cb_dirty, m_comply_dirty)]:
+        if m1cb_table is None:
+            continue
+        observed = pd.DataFrame({'off_board': (m1cb_table['beacon_type'] != 'board').values,
+                                 'comply': (comply.reindex(m1cb_table.index) == True).values},
+                                index=m1cb_table.index.get_level_values('member'))
+        grouped = observed.groupby(level='member')
+        columns.append(pd.DataFrame({'observed_bins' + suffix: grouped.size(),
+                                     'off_board_hours' + suffix: grouped['off_board'].sum() * bin_hours,
+                                     'comply_hours' + suffix: grouped['comply'].sum() * bin_hours}))
+
+    summary = pd.concat(columns, axis=1).reindex(columns=analysis_comply_summary_columns).fillna(0)
+    for column in ['observed_bins', 'observed_bins_dirty']:
+        summary[column] = summary[column].astype(np.int64)
+    summary.index = pd.MultiIndex.from_arrays([[day] * len(summary), summary.index], names=['datetime', 'member'])
+    return summary.sort_index()
+
+
 def _analyze_day(start_ts, end_ts):
+    """
+    Creates the compliance tables for a single day. Returns a dictionary mapping store
+    names to dataframes, ready to be written via _write_analyze_day()
+    """
+    output = {}
     members_metadata = pd.read_csv(members_metadata_path).set_index('member')
     beacons_metadata = pd.read_csv(beacons_metadata_path).set_index('beacon')
 
@@ -206,8 +256,7 @@ def _analyze_day(start_ts, end_ts):
     m2m = pd.read_hdf(clean_store_path, 'proximity/member_to_member', where=where)
 
     # --- m1cb + m_onboard + m2m_ncomply
-    store = pd.HDFStore(analysis_store_path)
-
+    summary_tables = {}
     if len(m5cb)  > 0:
         logger.info("Preparing m1cb")
         m1cb = _analysis_m1cb(m5cb, members_metadata, beacons_metadata)
@@ -219,9 +268,10 @@ def _analyze_day(start_ts, end_ts):
         m2m_comply = _analysis_m2m_comply(m2m, m_comply)
         logger.info("m2m_comply: before {}, after {}".format(len(m2m),len(m2m_comply)))
 
-        store.append('proximity/member_closest_beacon', m1cb)
-        store.append('proximity/member_comply', m_comply)
-        store.append('proximity/member_to_member', m2m_comply)
+        output['proximity/member_closest_beacon'] = m1cb
+        output['proximity/member_comply'] = m_comply
+        output['proximity/member_to_member'] = m2m_comply
+        summary_tables.update(m1cb=m1cb, m_comply=m_comply)
         del m1cb
         del m_comply
         del m2m_comply
@@ -236,28 +286,92 @@ def _analyze_day(start_ts, end_ts):
         logger.info("Preparing compliance table from dirty (to be used to determine participants' start day")
         m_comply_dirty = _analysis_compliance(m2badge, m1cb_dirty, board_threshold=-48)
 
-        store.append('proximity/member_comply_dirty', m_comply_dirty)
+        output['proximity/member_comply_dirty'] = m_comply_dirty
+        summary_tables.update(m1cb_dirty=m1cb_dirty, m_comply_dirty=m_comply_dirty)
+        del m1cb_dirty
         del m_comply_dirty
     else:
         logger.debug("m5cb_dirty is empty, skipping")
 
-    store.close()
+    if len(summary_tables) > 0:
+        logger.info("Preparing compliance summary")
+        output['proximity/member_comply_daily'] = _analysis_comply_summary(start_ts.normalize(), **summary_tables)
+    del summary_tables
 
     del m2badge
     del m5cb
+    return output
 
 
-def analysis_comply():
+def _analyze_day_timed(day_range):
     """
-    Create compliance tables and use them to cleans main datasets.
-    Create compliance tables and use them to cleans main datasets.
-    :return:
+    Helper, allows parallelization of analysis_comply(). Runs _analyze_day() on a
+    (start_ts, end_ts) tuple and returns its output along with the time it took
     """
-    logger.info("Analysis - comply")
+    start_time = time.time()
+    output = _analyze_day(day_range[0], day_range[1])
+    return output, time.time() - start_time
 
-    ##################################################
-    # Create list of dates to process
-    ##################################################
+
+def _m2m_checksum(m2m):
+    """
+    Helper, computes an order-independent checksum of a m2m table (index and values)
+    """
+    if len(m2m) == 0:
+        return np.int64(0)
+    return pd.util.hash_pandas_object(m2m, index=True).values.sum().view('int64')
+
+
+def _write_analyze_day(day_range, output):
+    """
+    Helper function; appends the output of _analyze_day() to the analysis store.
+    Tables are written in a fixed order so serial and parallel runs produce the same store.
+    Analyzed days are recorded in the analyzed days table, along with a checksum of their m2m
+    records, so later stages can tell which days are new or changed. The day is committed as a
+    single unit (see storage.commit_unit), with the analyzed days row last, and the committed days
+    are merged into the store when the stage ends. Days without data are recorded too (with no
+    records), so incremental runs don't analyze them again
+    """
+    m2m = output.get('proximity/member_to_member', pd.DataFrame())
+    analyzed_day = pd.DataFrame({'records': [len(m2m)], 'checksum': [_m2m_checksum(m2m)]},
+                                index=pd.DatetimeIndex([day_range[0].normalize()], name='day'))
+
+    tables = [(name, output[name]) for name in analysis_comply_store_keys if name in output]
+    tables.append((analysis_comply_days_store_key, analyzed_day))
+    commit_unit(analysis_store_path, 'analysis_comply', str(day_range[0]), tables)
+
+
+def _reset_analysis_comply_tables():
+    """
+    Helper function; removes the tables created by analysis_comply() from the analysis store,
+    leaving the tables of other stages in place
+    """
+    with store_lock(analysis_store_path), pd.HDFStore(analysis_store_path) as store:
+        for name in analysis_comply_store_keys + [analysis_comply_days_store_key]:
+            if name in store:
+                store.remove(name)
+    reset_checkpoint(analysis_store_path, 'analysis_comply')
+
+
+def read_analyzed_days():
+    """
+    Returns the analyzed days table (one row per day, with the number of m2m_comply records
+    and their checksum), or None if no day was analyzed yet. If a day was analyzed more than
+    once, the last entry is used
+    """
+    with store_lock(analysis_store_path), pd.HDFStore(analysis_store_path) as store:
+        if analysis_comply_days_store_key not in store:
+            return None
+        analyzed_days = store[analysis_comply_days_store_key]
+    return analyzed_days[~analyzed_days.index.duplicated(keep='last')]
+
+
+def _analysis_day_ranges():
+    """
+    Creates the list of (start, end) timestamps to analyze, one per day, for both periods.
+    The first and last ranges of each period use the exact start/end times of the period
+    :return:
+    """
     # Convert text into timestamps with timezone
     period1_start_ts = pd.Timestamp(period1_start, tz=time_zone)
     period1_end_ts = pd.Timestamp(period1_end, tz=time_zone)
@@ -279,24 +393,70 @@ def analysis_comply():
     period2_dates = period2_dates.append(
         pd.date_range(start=period2_end_ts, end=period2_end_ts, normalize=False, name='start').to_series(keep_tz=True))
 
+    day_ranges = []
+    for dates in (period1_dates, period2_dates):
+        for i in range(0, len(dates) - 1, 1):
+            day_ranges.append((dates[i], dates[i+1]))
+    return day_ranges
+
+
+def analysis_comply(num_workers=None, incremental=False, resume=False):
+    """
+    Create compliance tables and use them to cleans main datasets.
+
+    Days are independent, so when num_workers > 1 they are analyzed in a process pool.
+    Results are streamed back in order, and written by the parent process only.
+    :param num_workers: number of processes to use. Defaults to analysis_comply_num_processors
+    :param incremental: only analyze days that are not in the analyzed days table yet
+    :param resume: continue an interrupted run. Removes the partially written day, if any, and
+        then works like incremental
+    :return:
+    """
+    logger.info("Analysis - comply")
+    if num_workers is None:
+        num_workers = analysis_comply_num_processors
+
+    day_ranges = _analysis_day_ranges()
+    if resume or incremental:
+        # merges the days an interrupted run committed, so they are in the analyzed days table
+        recover_checkpoint(analysis_store_path, 'analysis_comply')
+        incremental = True
+
+    if not incremental:
+        _reset_analysis_comply_tables()
+    else:
+        analyzed_days = read_analyzed_days()
+        if analyzed_days is not None:
+            day_ranges = [d for d in day_ranges if d[0].normalize() not in analyzed_days.index]
+        logger.info("Incremental mode, {} days to analyze".format(len(day_ranges)))
 
     ##################################################
     # Analyse data, one day at a time
     ##################################################
-    # period 1
-    for i in range(0, len(period1_dates) - 1, 1):
-        logger.info('---------------------------------------')
-        logger.info("Analysis comply: {} - {}".format(period1_dates[i],period1_dates[i+1]))
-        _analyze_day(period1_dates[i], period1_dates[i+1])
+    if num_workers > 1:
+        logger.info("Analysing {} days using {} processes".format(len(day_ranges), num_workers))
+        pool = Pool(num_workers)
+        results = pool.imap(_analyze_day_timed, day_ranges)
+    else:
+        pool = None
+        results = (_analyze_day_timed(day_range) for day_range in day_ranges)
 
-    # Period 2
-    for i in range(0, len(period2_dates) - 1, 1):
+    day_times = []
+    for day_range, (output, elapsed) in zip(day_ranges, results):
         logger.info('---------------------------------------')
-        logger.info("Analysis comply: {} - {}".format(period2_dates[i], period2_dates[i + 1]))
-        _analyze_day(period2_dates[i], period2_dates[i+1])
-
-    logger.info('---------------------------------------')
-    logger.info('Completed analysis comply!')
+        logger.info("Analysis comply: {} - {} ({:.1f} seconds)".format(day_range[0], day_range[1], elapsed))
+        _write_analyze_day(day_range, output)
+        day_times.append((elapsed, day_range[0]))
+        del output
 
+    if pool is not None:
+        pool.close()
+        pool.join()
 
+    # Report the slowest days, so stragglers are visible
+    for elapsed, day_start in sorted(day_times, reverse=True)[:5]:
+        logger.info("Analysis comply - slowest days: {} ({:.1f} seconds)".format(day_start, elapsed))
 
+    merge_units(analysis_store_path, 'analysis_comply')
+    logger.info('---------------------------------------')
+    logger.info('Completed analysis comply!')
@@ -1,8 +1,33 @@
 from __future__ import absolute_import, division, print_function
 import datetime
 
+import numpy as np
 import pandas as pd
 from config import *
+from storage import hdf_storage_kwargs, store_lock
+from analysis_comply import read_analyzed_days
+from analysis_graphs import analysis_create_graphs
+from member_pairs import code_book_lookup, decode_pairs, encode_pairs, pair_codes, swap_pairs
+
+
+# Entity levels of the connection tables, as (table name, (side1_column, side2_column))
+analysis_connections_levels = [
+    ('m2m_dbl', ('member1', 'member2')),
+    ('m2c', ('member1', 'company2')),
+    ('c2c_dbl', ('company1', 'company2')),
+]
+
+# Time levels that are not pandas frequencies (see _analysis_time_labels)
+analysis_connections_custom_levels = ['week', 'shift', 'period']
+
+# Time levels that can be rolled up from the daily tables instead of the base tables. Anchored
+# frequencies (e.g. - W-MON) are matched by their prefix
+_analysis_connections_daily_levels = ['week', 'period', 'W', 'M', 'MS', 'Q', 'QS', 'A', 'AS']
+
+# Days (and their m2m_comply checksums) and settings the connection tables were built from.
+# Used by the incremental mode to find new or changed days
+analysis_connections_days_store_key = 'proximity/connections_days'
+analysis_connections_config_store_key = 'proximity/connections_config'
 
 
 def generate_analysis_connections_store_key(rssi_cutoff, table_name):
@@ -16,21 +41,107 @@ def generate_analysis_connections_store_key(rssi_cutoff, table_name):
     return 'proximity/rssi'+rssi_path+'/'+table_name
 
 
-def _analysis_create_m2m_filtered(rssi_cutoff):
+def _analysis_bucket_cutoffs(rssi_cutoffs):
+    """
+    Returns the rssi cutoffs ordered from the strictest to the loosest. The position of a
+    cutoff in this list is the index of its rssi bucket
+    :param rssi_cutoffs:
+    :return:
+    """
+    return sorted(set(rssi_cutoffs), reverse=True)
+
+
+def _analysis_rssi_buckets(rssi, bucket_cutoffs):
+    """
+    Buckets RSSI values into the intervals defined by the cutoffs (see _analysis_load_m2m_bucketed)
+    :param rssi: array of RSSI values
+    :param bucket_cutoffs: cutoffs, ordered as returned by _analysis_bucket_cutoffs()
+    :return: array of bucket indexes. Values that don't pass any cutoff (and NaN values) get
+        len(bucket_cutoffs)
+    """
+    # number of cutoffs the value passes. NaN values don't pass any
+    passed = np.searchsorted(bucket_cutoffs[::-1], rssi, side='right')
+    passed[np.isnan(rssi)] = 0
+    return len(bucket_cutoffs) - passed
+
+
+def _analysis_load_m2m_bucketed(rssi_cutoffs, where=None):
+    """
+    Loads m2m_comply once, and buckets rssi_max into the intervals defined by the cutoffs.
+    Bucket i holds the records that pass the i-th strictest cutoff but not the stricter ones,
+    so a cutoff's records are the ones in buckets 0..i. Records that do not pass any cutoff
+    are dropped
+    :param rssi_cutoffs:
+    :param where: optional where clause, for loading only some of the records
+    :return:
+    """
+    bucket_cutoffs = _analysis_bucket_cutoffs(rssi_cutoffs)
+    logger.info("Loading m2m_comply, RSSI: {}".format(bucket_cutoffs))
+    with store_lock(analysis_store_path):
+        m2m_comply = pd.read_hdf(analysis_store_path, 'proximity/member_to_member', where=where)
+    logger.info("m2m_comply records: {}".format(len(m2m_comply)))
+
+    m2m_comply['rssi_bucket'] = _analysis_rssi_buckets(m2m_comply.rssi_max.values, bucket_cutoffs)
+    m2m_comply = m2m_comply[m2m_comply.rssi_bucket < len(bucket_cutoffs)]
+    logger.info("m2m_comply records passing the loosest cutoff: {}".format(len(m2m_comply)))
+    return m2m_comply
+
+
+def _analysis_select_cutoff(m2m, bucket_cutoffs, rssi_cutoff):
     """
-    Creates a table with the closest beacon for each member, and adds metadata to it
+    Selects the records of a bucketed table that pass a given cutoff, and removes the bucket column
+    :param m2m: table with a rssi_bucket column
+    :param bucket_cutoffs: cutoffs, ordered as returned by _analysis_bucket_cutoffs()
     :param rssi_cutoff:
     :return:
     """
-    logger.info("Filtering m2m_comply, RSSI: {}".format(rssi_cutoff))
-    m2m_comply = pd.read_hdf(analysis_store_path, 'proximity/member_to_member')
-    m2m_comply_filtered = m2m_comply[m2m_comply.rssi_max >= rssi_cutoff].copy()
+    i = bucket_cutoffs.index(rssi_cutoff)
+    return m2m[m2m.rssi_bucket <= i].drop('rssi_bucket', axis=1)
 
-    store_key = generate_analysis_connections_store_key(rssi_cutoff, "m2m_comply_filtered")
-    m2m_comply_filtered.to_hdf(analysis_store_path, store_key, mode="a", format="table", append=False)
 
-    del m2m_comply
-    return m2m_comply_filtered
+def _write_connections_tables(tables, table_name, replace_where=None):
+    """
+    Writes a set of connection tables, one per rssi cutoff, to the analysis store
+    :param tables: dict mapping rssi cutoffs to tables
+    :param table_name:
+    :param replace_where: if given, only the stored records matching this where clause are
+        replaced by the tables. Otherwise, the stored tables are overwritten
+    :return:
+    """
+    for rssi_cutoff, table in tables.items():
+        store_key = generate_analysis_connections_store_key(rssi_cutoff, table_name)
+        if replace_where is None:
+            with store_lock(analysis_store_path):
+                table.to_hdf(analysis_store_path, store_key, mode="a", format="table", append=False,
+                             **hdf_storage_kwargs(store_key))
+        else:
+            with store_lock(analysis_store_path), pd.HDFStore(analysis_store_path) as store:
+                if store_key in store:
+                    store.remove(store_key, where=replace_where)
+                store.append(store_key, table, **hdf_storage_kwargs(store_key))
+
+
+def _read_connections_table(rssi_cutoff, table_name):
+    """
+    Reads a connections table created using a specific rssi_cutoff
+    """
+    with store_lock(analysis_store_path):
+        return pd.read_hdf(analysis_store_path, generate_analysis_connections_store_key(rssi_cutoff, table_name))
+
+
+def _analysis_create_m2m_filtered(m2m_comply, bucket_cutoffs, replace_where=None):
+    """
+    Writes the m2m_comply records that pass each of the cutoffs
+    :param m2m_comply: bucketed m2m_comply, as returned by _analysis_load_m2m_bucketed()
+    :param bucket_cutoffs:
+    :param replace_where: see _write_connections_tables()
+    :return:
+    """
+    for rssi_cutoff in bucket_cutoffs:
+        logger.info("Filtering m2m_comply, RSSI: {}".format(rssi_cutoff))
+        m2m_comply_filtered = _analysis_select_cutoff(m2m_comply, bucket_cutoffs, rssi_cutoff)
+        _write_connections_tables({rssi_cutoff: m2m_comply_filtered}, "m2m_comply_filtered", replace_where)
+        del m2m_comply_filtered
 
 
 def make_m2m_double_sided(m2m):
@@ -41,13 +152,10 @@ def make_m2m_double_sided(m2m):
     :return:
     """
     m2m = m2m.reset_index()
-    m2m_reversed = m2m.copy()
-    m2m_reversed['temp'] = m2m_reversed['member2']
-    m2m_reversed['member2'] = m2m_reversed['member1']
-    m2m_reversed['member1'] = m2m_reversed['temp']
-    del m2m_reversed['temp']
-    m2m_dbl = m2m.append(m2m_reversed).set_index(['datetime','member1','member2'])
-    return m2m_dbl
+    code_book, keys = encode_pairs(m2m['member1'], m2m['member2'])
+    m2m_dbl = m2m.iloc[np.tile(np.arange(len(m2m)), 2)].reset_index(drop=True)
+    m2m_dbl['member1'], m2m_dbl['member2'] = decode_pairs(code_book, np.append(keys, swap_pairs(keys, len(code_book))))
+    return m2m_dbl.set_index(['datetime','member1','member2'])
 
 
 def add_companies_to_m2m(m2m):
@@ -57,180 +165,520 @@ def add_companies_to_m2m(m2m):
     :return:
     """
     members_store_key = "metadata/members"
-    members = pd.read_hdf(analysis_store_path, members_store_key)
-
-    m2m_with_company = pd.merge(left=m2m.reset_index(), right=members[['company']], left_on='member1', right_index=True)
-    m2m_with_company = m2m_with_company.rename(columns={'company': 'company1'})
-    m2m_with_company = pd.merge(left=m2m_with_company.reset_index(), right=members[['company']], left_on='member2',
-                                right_index=True)
-    m2m_with_company = m2m_with_company.rename(columns={'company': 'company2'})
+    with store_lock(analysis_store_path):
+        members = pd.read_hdf(analysis_store_path, members_store_key)
+    m2m_with_company = _analysis_add_companies_to_reduced(m2m.reset_index(), members)
     return m2m_with_company.set_index(['datetime','member1','member2'])
 
 
-def _analysis_create_m2m_dbl(m2m, rssi_cutoff):
+def _time_bin_minutes():
+    """
+    Length of a time bin, in minutes
+    """
+    return int(time_bins_size[:-1])/60
+
+
+def _analysis_create_m2m_dbl(m2m, bucket_cutoffs, replace_where=None):
+    """
+    Makes a bucketed m2m table double sided, and writes the m2m_dbl table of each cutoff.
+    The aggregates don't need it, so it's only created when explicitly requested
+    :param m2m: bucketed m2m_comply, as returned by _analysis_load_m2m_bucketed()
+    :param bucket_cutoffs:
+    :param replace_where: see _write_connections_tables()
+    :return:
+    """
     logger.info("Making m2m double sided. Size before: {}".format(len(m2m)))
     m2m_dbl = make_m2m_double_sided(m2m)
-    m2m_dbl['minutes'] = int(time_bins_size[:-1])/60
-    store_key = generate_analysis_connections_store_key(rssi_cutoff, "m2m_dbl")
-    m2m_dbl.to_hdf(analysis_store_path, store_key, mode="a", format="table", append=False)
+    m2m_dbl['minutes'] = _time_bin_minutes()
+    for rssi_cutoff in bucket_cutoffs:
+        _write_connections_tables({rssi_cutoff: _analysis_select_cutoff(m2m_dbl, bucket_cutoffs, rssi_cutoff)},
+                                  "m2m_dbl", replace_where)
     logger.info("Making m2m double sided. Size after: {}".format(len(m2m_dbl)))
-    return m2m_dbl
+    del m2m_dbl
 
 
-def _analysis_agg_m2m(m2m, rssi_cutoff, freq, side1_column, side2_column):
+def _analysis_reduce_m2m(m2m, freq):
     """
-    Aggregated the m2m table to a certain level
-    :param m2m table. level 0 should be the datetime
-    :param rssi_cutoff:
+    Reduces a (single sided) bucketed m2m table to the minutes each pair spent together in
+    each time bin and rssi bucket
+    :param m2m: bucketed m2m table. level 0 should be the datetime
     :param freq frequency (e.g. - D,W,etc)
+    :return: table with datetime, member1, member2, rssi_bucket and minutes columns
+    """
+    logger.info("Reducing m2m, frequency: {}. Records: {}".format(freq, len(m2m)))
+    code_book, keys = encode_pairs(m2m.index.get_level_values('member1'), m2m.index.get_level_values('member2'))
+    m2m_agg = pd.DataFrame({'pair': keys, 'rssi_bucket': m2m['rssi_bucket'].values},
+                           index=m2m.index.get_level_values(0))
+    m2m_agg = m2m_agg[keys >= 0].groupby([
+        pd.Grouper(level=0, freq=freq), # level 0 should be datetime
+        'pair', 'rssi_bucket'
+    ]).size()
+    m2m_agg = (m2m_agg * _time_bin_minutes()).rename('minutes').reset_index()
+    m2m_agg = _decode_pairs_column(m2m_agg, code_book, 'member1', 'member2')
+    logger.info("Records: {}".format(len(m2m_agg)))
+    return m2m_agg
+
+
+def _decode_pairs_column(m2m_agg, code_book, side1_column, side2_column):
+    """
+    Helper, replaces the pair column of a table with the side columns, in its place
+    """
+    columns = list(m2m_agg.columns)
+    i = columns.index('pair')
+    m2m_agg[side1_column], m2m_agg[side2_column] = decode_pairs(code_book, m2m_agg['pair'].values)
+    return m2m_agg[columns[:i] + [side1_column, side2_column] + columns[i+1:]]
+
+
+def _analysis_period_index(datetimes):
+    """
+    Finds the project period (see project_time_slices) of each timestamp. Periods start at
+    midnight of their first day, so daily bins are assigned to the period they are in
+    :param datetimes: series of timestamps
+    :return: array with the index of the period of each timestamp (-1 if not in any period),
+        and the list of period start times
+    """
+    period_starts = [pd.Timestamp(s.start, tz=time_zone).normalize() for s in project_time_slices]
+    period_index = np.full(len(datetimes), -1, dtype=int)
+    for i, time_slice in enumerate(project_time_slices):
+        cond = (datetimes >= period_starts[i]) & (datetimes <= pd.Timestamp(time_slice.stop, tz=time_zone))
+        period_index[cond.values] = i
+    return period_index, period_starts
+
+
+def _analysis_shift_index(datetimes):
+    """
+    Finds the shift window (see analysis_connections_shifts) of each timestamp
+    :param datetimes: series of timestamps
+    :return: array with the index of the shift of each timestamp (-1 if not in any shift)
+    """
+    shift_of_hour = np.full(24, -1, dtype=int)
+    for i, (shift_name, start_hour, end_hour) in enumerate(analysis_connections_shifts):
+        shift_of_hour[start_hour:end_hour] = i
+    return shift_of_hour[datetimes.dt.hour.values]
+
+
+def _analysis_time_labels(datetimes, freq):
+    """
+    Labels timestamps with the start of their time bin, for the time levels that are not
+    pandas frequencies:
+      - 'week' - ISO weeks, starting on Monday
+      - 'shift' - shift windows within each day (see analysis_connections_shifts)
+      - 'period' - the project periods (see project_time_slices)
+    :param datetimes: series of timestamps
+    :param freq: 'week', 'shift' or 'period'
+    :return: boolean array of timestamps that are in a time bin, and a DatetimeIndex with the labels
+        of these timestamps
+    """
+    if freq == 'week':
+        labels = (datetimes - pd.to_timedelta(datetimes.dt.dayofweek, unit='D')).dt.normalize()
+        return np.ones(len(datetimes), dtype=bool), pd.DatetimeIndex(labels)
+
+    if freq == 'shift':
+        shift_index = _analysis_shift_index(datetimes)
+        in_shift = shift_index >= 0
+        start_hours = np.array([start_hour for shift_name, start_hour, end_hour in analysis_connections_shifts])
+        labels = datetimes[in_shift].dt.normalize() + \
+            pd.to_timedelta(start_hours[shift_index[in_shift]], unit='h')
+        return in_shift, pd.DatetimeIndex(labels)
+
+    if freq == 'period':
+        period_index, period_starts = _analysis_period_index(datetimes)
+        in_period = period_index >= 0
+        return in_period, pd.DatetimeIndex(period_starts).take(period_index[in_period])
+
+    raise ValueError("Unknown time level: {}".format(freq))
+
+
+def _analysis_agg_m2m(m2m_agg, freq, side1_column, side2_column):
+    """
+    Aggregated a reduced m2m table to a certain level. Since the time bins of coarser frequencies
+    contain whole bins of finer ones, this can be used to roll up any aggregate to a coarser level
+    :param m2m_agg: table with datetime and minutes columns, and the side columns. If it has a
+        rssi_bucket column, buckets are kept separate
+    :param freq frequency (e.g. - H,D,AS,etc), or one of the time levels of _analysis_time_labels()
     :param side1_column first column for group by (e.g. member 1 or company)
     :param side2_column second column for group by (e.g. member 2 or company)
-    :return:
+    :return: table with datetime, side1_column, side2_column, (rssi_bucket) and minutes columns
     """
-    logger.info("Aggregating, frequency: {}, RSSI: {}".format(freq, rssi_cutoff))
-
-    # Groupper is the way to go, because I don't care about missing values (as opposed to resample)
-    m2m_agg = m2m.groupby([
-        pd.Grouper(level=0, freq=freq), # level 0 should be datetime
-        side1_column, side2_column
-    ])[['minutes']].sum()
+    logger.info("Aggregating, frequency: {}, sides: {}, {}".format(freq, side1_column, side2_column))
+
+    if freq in analysis_connections_custom_levels:
+        # label each record with the start of its time bin. Records outside the bins are dropped
+        in_bin, labels = _analysis_time_labels(m2m_agg['datetime'], freq)
+        m2m_agg = m2m_agg[in_bin].copy()
+        m2m_agg['datetime'] = labels
+        time_grouper = 'datetime'
+    else:
+        # Groupper is the way to go, because I don't care about missing values (as opposed to resample)
+        time_grouper = pd.Grouper(key='datetime', freq=freq)
+
+    bucket_columns = ['rssi_bucket'] if 'rssi_bucket' in m2m_agg.columns else []
+    code_book, keys = encode_pairs(m2m_agg[side1_column], m2m_agg[side2_column])
+    m2m_agg = m2m_agg[['datetime'] + bucket_columns + ['minutes']].assign(pair=keys)[keys >= 0]
+    m2m_agg = m2m_agg.groupby([
+        time_grouper,
+        'pair'
+    ] + bucket_columns)[['minutes']].sum().reset_index()
+    m2m_agg = _decode_pairs_column(m2m_agg, code_book, side1_column, side2_column)
 
-    #m2m_agg['minutes'] = m2m_agg['minutes'] * 15 / 60
     logger.info("Records: {}".format(len(m2m_agg)))
     return m2m_agg
 
 
-def _analysis_create_m2m_dbl_daily(m2m_dbl, rssi_cutoff):
+def _analysis_mirror_m2m(m2m_agg, side1_column, side2_column, mirror_same=True):
     """
-    Aggregated the m2m table to a daily level
-    :param m2m_dbl:
-    :param rssi_cutoff:
+    Makes a reduced (single sided) table symmetric, by adding the b->a totals to the a->b totals.
+    This gives the same totals as aggregating a double sided m2m, without materializing it
+    :param m2m_agg: table with datetime, rssi_bucket and minutes columns, and the side columns
+    :param side1_column:
+    :param side2_column:
+    :param mirror_same: if False, records with the same value on both sides (e.g. - same company)
+        are not mirrored, so they are only counted once
     :return:
     """
-    m2m_dbl_daily = _analysis_agg_m2m(m2m=m2m_dbl, rssi_cutoff=rssi_cutoff, freq='D', side1_column='member1', side2_column='member2')
+    code_book, keys = encode_pairs(m2m_agg[side1_column], m2m_agg[side2_column])
+    m2m_agg = m2m_agg[['datetime', 'rssi_bucket', 'minutes']].assign(pair=keys)[keys >= 0]
+    mirrored = m2m_agg.assign(pair=swap_pairs(m2m_agg['pair'].values, len(code_book)))
+    if not mirror_same:
+        mirrored = mirrored[mirrored['pair'].values != m2m_agg['pair'].values]
 
-    out_store_key = generate_analysis_connections_store_key(rssi_cutoff, "m2m_dbl_daily")
-    m2m_dbl_daily.to_hdf(analysis_store_path, out_store_key, mode="a", format="table", append=False)
-    return m2m_dbl_daily
+    m2m_agg = pd.concat([m2m_agg, mirrored])
+    m2m_agg = m2m_agg.groupby(['datetime', 'pair', 'rssi_bucket'])[['minutes']].sum().reset_index()
+    return _decode_pairs_column(m2m_agg, code_book, side1_column, side2_column)
 
 
-def _analysis_create_m2m_dbl_annual(m2m_dbl, rssi_cutoff):
+def _analysis_add_companies_to_reduced(m2m_agg, members):
     """
-    Aggregated the m2m table to a annual level
-    :param m2m_dbl:
-    :param rssi_cutoff:
+    Adds company names to both sides of a reduced m2m table. Like add_companies_to_m2m(),
+    records of members that are not in the members table are dropped
+    :param m2m_agg: table with member1 and member2 columns
+    :param members: members table, indexed by member
     :return:
     """
+    code_book, keys = encode_pairs(m2m_agg['member1'], m2m_agg['member2'])
+    companies = code_book_lookup(code_book, members['company'])
+    known = code_book.isin(members.index)
+
+    codes1, codes2 = pair_codes(keys, len(code_book))
+    in_members = (keys >= 0) & known[codes1] & known[codes2]
+    m2m_agg = m2m_agg[in_members].copy()
+    m2m_agg['company1'] = companies[codes1[in_members]]
+    m2m_agg['company2'] = companies[codes2[in_members]]
+    return m2m_agg
 
-    m2m_dbl_annual = _analysis_agg_m2m(m2m=m2m_dbl, rssi_cutoff=rssi_cutoff, freq='AS', side1_column='member1', side2_column='member2')
 
-    out_store_key = generate_analysis_connections_store_key(rssi_cutoff, "m2m_dbl_annual")
-    m2m_dbl_annual.to_hdf(analysis_store_path, out_store_key, mode="a", format="table", append=False)
-    return m2m_dbl_annual
+def _analysis_split_cutoffs(m2m_agg, bucket_cutoffs, side1_column, side2_column):
+    """
+    Creates the table of each rssi cutoff from a bucketed aggregate. Since bucket i holds the
+    records that pass the i-th cutoff but not the stricter ones, each cutoff's table is the
+    cumulative sum over the buckets
+    :param m2m_agg: table with datetime, rssi_bucket and minutes columns, and the side columns
+    :param bucket_cutoffs: cutoffs, ordered as returned by _analysis_bucket_cutoffs()
+    :param side1_column:
+    :param side2_column:
+    :return: dict mapping rssi cutoffs to tables indexed by datetime, side1_column, side2_column
+    """
+    # one column per bucket, cumulative over buckets
+    m2m_agg = m2m_agg.set_index(['datetime', side1_column, side2_column, 'rssi_bucket'])['minutes'] \
+        .unstack('rssi_bucket', fill_value=0) \
+        .reindex(columns=range(len(bucket_cutoffs)), fill_value=0) \
+        .cumsum(axis=1)
 
+    m2m_aggs = {}
+    for i, rssi_cutoff in enumerate(bucket_cutoffs):
+        minutes = m2m_agg[i]
+        m2m_aggs[rssi_cutoff] = minutes[minutes > 0].to_frame('minutes')
+        logger.info("Records, RSSI {}: {}".format(rssi_cutoff, len(m2m_aggs[rssi_cutoff])))
+    return m2m_aggs
 
-def _analysis_create_m2c_daily(m2m_dbl_with_company, rssi_cutoff):
+
+def _analysis_create_base_aggregates(m2m, members, freq):
     """
-    Aggregated the m2m table to a daily level, with company on side 2
-    :param m2m_dbl_with_company: a m2m table with company info on both sides
-    :param rssi_cutoff:
-    :return:
+    Creates the m2m_dbl, m2c and c2c_dbl aggregates at the finest time level. The single sided
+    m2m is reduced once, and the company levels are derived from the reduced member level.
+    Totals are symmetric, but only the reduced results are mirrored
+    :param m2m: bucketed (single sided) m2m_comply
+    :param members: members table, indexed by member
+    :param freq frequency (e.g. - D,W,etc)
+    :return: dict mapping table names to aggregates
     """
-    m2c_daily = _analysis_agg_m2m(m2m=m2m_dbl_with_company, rssi_cutoff=rssi_cutoff, freq='D', side1_column='member1', side2_column='company2')
+    m2m_agg = _analysis_reduce_m2m(m2m, freq)
+    aggs = {}
+
+    # m2m - member to member, both directions
+    logger.info("Creating m2m aggregate, frequency: {}".format(freq))
+    aggs['m2m_dbl'] = _analysis_mirror_m2m(m2m_agg, 'member1', 'member2')
 
-    out_store_key = generate_analysis_connections_store_key(rssi_cutoff, "m2c_daily")
-    m2c_daily.to_hdf(analysis_store_path, out_store_key, mode="a", format="table", append=False)
-    return m2c_daily
+    # m2c (member to company). Every member is on side 1 of the double sided table
+    logger.info("Creating m2c aggregate, frequency: {}".format(freq))
+    m2c_agg = _analysis_add_companies_to_reduced(aggs['m2m_dbl'], members)
+    aggs['m2c'] = _analysis_agg_m2m(m2c_agg, freq, 'member1', 'company2')
+    del m2c_agg
 
+    # c2c (company to company). Same company pairs are already counted once in the single sided table
+    logger.info("Creating c2c aggregate, frequency: {}".format(freq))
+    c2c_agg = _analysis_add_companies_to_reduced(m2m_agg, members)
+    c2c_agg = _analysis_agg_m2m(c2c_agg, freq, 'company1', 'company2')
+    aggs['c2c_dbl'] = _analysis_mirror_m2m(c2c_agg, 'company1', 'company2', mirror_same=False)
+    del c2c_agg
 
-def _analysis_create_m2c_annual(m2m_dbl_with_company, rssi_cutoff):
+    del m2m_agg
+    return aggs
+
+
+def _analysis_rollup_source(freq, built_freqs):
     """
-    Aggregated the m2m table to a member2company, annual level
-    :param m2m_dbl_with_company: a m2m table with company info on both sides
-    :param rssi_cutoff:
-    :return:
+    Chooses the finest table a time level can be rolled up from. Levels made of whole days are
+    rolled up from the daily tables (if built), and the rest from the base tables
+    :param freq:
+    :param built_freqs: frequencies of the tables built so far
+    :return: frequency of the source table, or None for the base tables
     """
-    m2c_annual = _analysis_agg_m2m(m2m=m2m_dbl_with_company, rssi_cutoff=rssi_cutoff, freq='AS', side1_column='member1', side2_column='company2')
+    if 'D' in built_freqs and freq.split('-')[0] in _analysis_connections_daily_levels:
+        return 'D'
+    return None
 
-    out_store_key = generate_analysis_connections_store_key(rssi_cutoff, "m2c_annual")
-    m2c_annual.to_hdf(analysis_store_path, out_store_key, mode="a", format="table", append=False)
-    return m2c_annual
 
-
-def _analysis_create_c2c_dbl_daily(m2m_dbl_with_company, rssi_cutoff):
+def _analysis_validate_levels(base_freq, freqs):
     """
-    Aggregated the m2m table to a company2company, daily level
-    :param m2m_dbl_with_company: a m2m table with company info on both sides
-    :param rssi_cutoff:
-    :return:
+    Checks that all the time levels can be rolled up from the base frequency
     """
-    c2c_dbl_daily = _analysis_agg_m2m(m2m=m2m_dbl_with_company, rssi_cutoff=rssi_cutoff, freq='D', side1_column='company1', side2_column='company2')
+    for freq, freq_name in freqs:
+        if freq in ('H', 'shift') and base_freq != 'H':
+            raise ValueError("Time level {} requires an hourly base frequency, got {}".format(freq, base_freq))
+    for shift_name, start_hour, end_hour in analysis_connections_shifts:
+        if not (0 <= start_hour < end_hour <= 24):
+            raise ValueError("Invalid shift window {}: {}-{}".format(shift_name, start_hour, end_hour))
 
-    # If we have the same company on both sides, we counted twice. So need to divide by 2
-    c2c_dbl_daily = c2c_dbl_daily.reset_index()
-    same_company_cond = (c2c_dbl_daily.company1 == c2c_dbl_daily.company2)
-    c2c_dbl_daily.loc[same_company_cond, 'minutes'] = c2c_dbl_daily.loc[same_company_cond, 'minutes'] / 2
-    c2c_dbl_daily.set_index(['datetime','company1','company2'], inplace=True)
 
-    out_store_key = generate_analysis_connections_store_key(rssi_cutoff, "c2c_dbl_daily")
-    c2c_dbl_daily.to_hdf(analysis_store_path, out_store_key, mode="a", format="table", append=False)
-    return c2c_dbl_daily
+def _analysis_write_level(tables, members, table_name, freq, freq_name, side1_column, side2_column):
+    """
+    Writes the connection tables of a time level. Daily tables listed in analysis_graphs_tables are
+    also written as sparse daily graphs (see analysis_graphs)
+    """
+    _write_connections_tables(tables, table_name + "_" + freq_name)
+    if freq == 'D' and table_name in analysis_graphs_tables:
+        analysis_create_graphs(members, tables, table_name + "_" + freq_name, side1_column, side2_column)
 
 
-def _analysis_create_c2c_dbl_annual(m2m_dbl_with_company, rssi_cutoff):
+def _analysis_create_connections(base_aggs, members, bucket_cutoffs, base_freq, freqs):
     """
-    Aggregated the m2m table to a company2company, annual level
-    :param m2m_dbl_with_company: a m2m table with company info on both sides
-    :param rssi_cutoff:
+    Creates the connection tables of each time level, and writes them for all rssi cutoffs.
+    Levels are built bottom-up: each one is rolled up from the base aggregates or, for levels
+    made of whole days, from the daily aggregates
+    :param base_aggs: base aggregates, as returned by _analysis_create_base_aggregates()
+    :param members: members table, indexed by member
+    :param bucket_cutoffs:
+    :param base_freq: the frequency of the base aggregates
+    :param freqs: list of (frequency, name) pairs. The name is used in the store keys (e.g. - daily).
+        Levels that are rolled up from other levels should come after them
     :return:
     """
-    c2c_dbl_annual = _analysis_agg_m2m(m2m=m2m_dbl_with_company, rssi_cutoff=rssi_cutoff, freq='AS', side1_column='company1', side2_column='company2')
+    for table_name, (side1_column, side2_column) in analysis_connections_levels:
+        built = {base_freq: base_aggs[table_name]}
+        for freq, freq_name in freqs:
+            logger.info("Creating {}_{} tables".format(table_name, freq_name))
+            if freq not in built:
+                source = built[_analysis_rollup_source(freq, built) or base_freq]
+                built[freq] = _analysis_agg_m2m(source, freq, side1_column, side2_column)
+
+            tables = _analysis_split_cutoffs(built[freq], bucket_cutoffs, side1_column, side2_column)
+            _analysis_write_level(tables, members, table_name, freq, freq_name, side1_column, side2_column)
+            del tables
+        del built
 
-    # If we have the same company on both sides, we counted twice. So need to divide by 2
-    c2c_dbl_annual = c2c_dbl_annual.reset_index()
-    same_company_cond = (c2c_dbl_annual.company1 == c2c_dbl_annual.company2)
-    c2c_dbl_annual.loc[same_company_cond, 'minutes'] = c2c_dbl_annual.loc[same_company_cond, 'minutes'] / 2
-    c2c_dbl_annual.set_index(['datetime','company1','company2'], inplace=True)
 
-    out_store_key = generate_analysis_connections_store_key(rssi_cutoff, "c2c_dbl_annual")
-    c2c_dbl_annual.to_hdf(analysis_store_path, out_store_key, mode="a", format="table", append=False)
-    return c2c_dbl_annual
+def _analysis_connections_config():
+    """
+    Settings the connection tables depend on. If any of them changes, tables must be rebuilt
+    """
+    return repr((_analysis_bucket_cutoffs(rssi_cutoffs), time_bins_size,
+                 analysis_connections_base_freq, analysis_connections_freqs, analysis_connections_shifts))
 
 
-def analysis_connections():
+def _analysis_write_connections_state(analyzed_days):
     """
-    Creates connection tables in multiple levels
+    Records the days and settings the connection tables were built from
+    :param analyzed_days: analyzed days table, as returned by read_analyzed_days()
     :return:
     """
-    logger.info("Analysis - connections")
+    if analyzed_days is None:
+        return
+    with store_lock(analysis_store_path):
+        analyzed_days.to_hdf(analysis_store_path, analysis_connections_days_store_key,
+                             mode="a", format="table", append=False,
+                             **hdf_storage_kwargs(analysis_connections_days_store_key))
+        pd.DataFrame({'config': [_analysis_connections_config()]}) \
+            .to_hdf(analysis_store_path, analysis_connections_config_store_key, mode="a", format="table", append=False,
+                    **hdf_storage_kwargs(analysis_connections_config_store_key))
+
+
+def _analysis_changed_days(analyzed_days):
+    """
+    Finds the days of m2m_comply that are new, changed or removed since the connection tables
+    were built, by comparing their checksums
+    :param analyzed_days: analyzed days table, as returned by read_analyzed_days()
+    :return: DatetimeIndex of days, or None if the tables must be fully rebuilt
+    """
+    if analyzed_days is None:
+        logger.info("No analyzed days table")
+        return None
 
-    for rssi_cutoff in rssi_cutoffs:
-        logger.info("##### RSSI cutoff: {}".format(rssi_cutoff))
-        # m2m
-        logger.info("Creating m2m tables")
-        m2m_comply_filtered = _analysis_create_m2m_filtered(rssi_cutoff)
-        _analysis_create_m2m_dbl(m2m_comply_filtered, rssi_cutoff)
-        del m2m_comply_filtered
+    if dict(analysis_connections_freqs).get(analysis_connections_base_freq) is None:
+        logger.info("Base frequency {} is not stored".format(analysis_connections_base_freq))
+        return None
 
-        m2m_dbl_store_key = generate_analysis_connections_store_key(rssi_cutoff, "m2m_dbl")
-        m2m_dbl = pd.read_hdf(analysis_store_path, m2m_dbl_store_key)
+    with store_lock(analysis_store_path), pd.HDFStore(analysis_store_path) as store:
+        if analysis_connections_days_store_key not in store or analysis_connections_config_store_key not in store:
+            logger.info("Connection tables were not built yet")
+            return None
+        built_days = store[analysis_connections_days_store_key]
+        config = store[analysis_connections_config_store_key]
 
-        _analysis_create_m2m_dbl_daily(m2m_dbl, rssi_cutoff)
-        _analysis_create_m2m_dbl_annual(m2m_dbl, rssi_cutoff)
+    if config['config'].iloc[0] != _analysis_connections_config():
+        logger.info("Connections settings changed")
+        return None
 
-        # m2c (member to company)
-        logger.info("Creating m2c tables")
-        m2m_dbl_with_company = add_companies_to_m2m(m2m_dbl)
-        _analysis_create_m2c_daily(m2m_dbl_with_company, rssi_cutoff)
-        _analysis_create_m2c_annual(m2m_dbl_with_company, rssi_cutoff)
+    checksums = pd.concat([analyzed_days['checksum'].rename('current'),
+                           built_days['checksum'].rename('built')], axis=1)
+    return checksums.index[checksums['current'] != checksums['built']]
 
-        # c2c (company to company)
-        logger.info("Creating c2c tables")
-        _analysis_create_c2c_dbl_daily(m2m_dbl_with_company, rssi_cutoff)
-        _analysis_create_c2c_dbl_annual(m2m_dbl_with_company, rssi_cutoff)
 
-        logger.info('---------------------------------------')
-        logger.info('Completed analysis connections!')
+def _analysis_days_where(days):
+    """
+    Helper, creates a where clause that selects the given days
+    """
+    return " | ".join(["(datetime >= '" + str(day) + "' & datetime < '" + str(day + pd.Timedelta(days=1)) + "')"
+                       for day in days])
 
 
+def _analysis_update_rollup(existing, delta, freq, side1_column, side2_column):
+    """
+    Updates a coarser connections table by adding the rolled up changes of the base table
+    :param existing: stored table. Index should be datetime,side1_column,side2_column
+    :param delta: new minus old base table records, same index
+    :param freq: frequency of the existing table
+    :param side1_column:
+    :param side2_column:
+    :return:
+    """
+    delta = _analysis_agg_m2m(delta.reset_index(), freq, side1_column, side2_column) \
+        .set_index(['datetime', side1_column, side2_column])
+    updated = existing.add(delta, fill_value=0)
+
+    # pairs whose minutes all came from removed records
+    updated = updated[updated['minutes'].abs() > 1e-9]
+    return updated.sort_index()
+
+
+def _analysis_connections_incremental(members, bucket_cutoffs, changed_days, write_m2m_dbl):
+    """
+    Updates the connection tables with the records of new or changed days. Base tables are
+    recomputed for these days only and merged into the stored tables. Coarser tables are
+    updated by adding the changes, without regrouping all history
+    :param members: members table, indexed by member
+    :param bucket_cutoffs:
+    :param changed_days: DatetimeIndex of days, as returned by _analysis_changed_days()
+    :param write_m2m_dbl:
+    :return:
+    """
+    logger.info("Updating connection tables, days: {}".format(len(changed_days)))
+    if len(changed_days) == 0:
+        return
+
+    days_where = _analysis_days_where(changed_days)
+    m2m_comply = _analysis_load_m2m_bucketed(rssi_cutoffs, where=days_where)
+    _analysis_create_m2m_filtered(m2m_comply, bucket_cutoffs, replace_where=days_where)
+    if write_m2m_dbl:
+        _analysis_create_m2m_dbl(m2m_comply, bucket_cutoffs, replace_where=days_where)
+
+    base_freq = analysis_connections_base_freq
+    base_freq_name = dict(analysis_connections_freqs)[base_freq]
+    # changed days can also be days whose records were all removed
+    base_aggs = None
+    if len(m2m_comply) > 0:
+        base_aggs = _analysis_create_base_aggregates(m2m_comply, members, base_freq)
+    del m2m_comply
+
+    for table_name, (side1_column, side2_column) in analysis_connections_levels:
+        logger.info("Updating {}_{} tables".format(table_name, base_freq_name))
+        new_tables = {}
+        if base_aggs is not None:
+            new_tables = _analysis_split_cutoffs(base_aggs[table_name], bucket_cutoffs, side1_column, side2_column)
+
+        tables = {}
+        deltas = {}
+        for rssi_cutoff in bucket_cutoffs:
+            existing = _read_connections_table(rssi_cutoff, table_name + "_" + base_freq_name)
+            new = new_tables.get(rssi_cutoff, existing.iloc[:0])
+            in_changed_days = existing.index.get_level_values('datetime').normalize().isin(changed_days)
+            deltas[rssi_cutoff] = new.sub(existing[in_changed_days], fill_value=0)
+            tables[rssi_cutoff] = pd.concat([existing[~in_changed_days], new]).sort_index()
+            del existing
+
+        _analysis_write_level(tables, members, table_name, base_freq, base_freq_name, side1_column, side2_column)
+        del tables
+
+        for freq, freq_name in analysis_connections_freqs:
+            if freq == base_freq:
+                continue
+            logger.info("Updating {}_{} tables".format(table_name, freq_name))
+            tables = {}
+            for rssi_cutoff in bucket_cutoffs:
+                existing = _read_connections_table(rssi_cutoff, table_name + "_" + freq_name)
+                tables[rssi_cutoff] = _analysis_update_rollup(existing, deltas[rssi_cutoff], freq,
+                                                              side1_column, side2_column)
+            _analysis_write_level(tables, members, table_name, freq, freq_name, side1_column, side2_column)
+            del tables
+
+
+def analysis_connections(write_m2m_dbl=None, incremental=False):
+    """
+    Creates connection tables in multiple levels, for all rssi cutoffs.
+    m2m_comply is read once and bucketed by rssi_max, and each level is aggregated once
+    for all cutoffs (see _analysis_split_cutoffs). Coarser time levels are rolled up from the
+    aggregates at analysis_connections_base_freq
+    :param write_m2m_dbl: also write the (15 seconds level) double sided m2m. Defaults to
+        analysis_write_m2m_dbl
+    :param incremental: only update the tables with days of m2m_comply that are new or changed
+        since the last run. Falls back to a full rebuild if the tables or their settings changed
+    :return:
+    """
+    logger.info("Analysis - connections")
+    if write_m2m_dbl is None:
+        write_m2m_dbl = analysis_write_m2m_dbl
+
+    bucket_cutoffs = _analysis_bucket_cutoffs(rssi_cutoffs)
+    logger.info("##### RSSI cutoffs: {}".format(bucket_cutoffs))
+    _analysis_validate_levels(analysis_connections_base_freq, analysis_connections_freqs)
+
+    with store_lock(analysis_store_path):
+        members = pd.read_hdf(analysis_store_path, "metadata/members")
+    analyzed_days = read_analyzed_days()
+
+    if incremental:
+        changed_days = _analysis_changed_days(analyzed_days)
+        if changed_days is not None:
+            _analysis_connections_incremental(members, bucket_cutoffs, changed_days, write_m2m_dbl)
+            _analysis_write_connections_state(analyzed_days)
+            logger.info('---------------------------------------')
+            logger.info('Completed analysis connections (incremental)!')
+            return
+        logger.info("Can't update incrementally, rebuilding all connection tables")
+
+    # m2m
+    logger.info("Creating m2m tables")
+    m2m_comply = _analysis_load_m2m_bucketed(rssi_cutoffs)
+    _analysis_create_m2m_filtered(m2m_comply, bucket_cutoffs)
+    if write_m2m_dbl:
+        _analysis_create_m2m_dbl(m2m_comply, bucket_cutoffs)
+
+    base_aggs = _analysis_create_base_aggregates(m2m_comply, members, analysis_connections_base_freq)
+    del m2m_comply
+
+    _analysis_create_connections(base_aggs, members, bucket_cutoffs, analysis_connections_base_freq,
+                                 analysis_connections_freqs)
+    _analysis_write_connections_state(analyzed_days)
 
+    logger.info('---------------------------------------')
+    logger.info('Completed analysis connections!')
@@ -0,0 +1,240 @@
+from __future__ import absolute_import, division, print_function
+import datetime
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from config import *
+from snapshots import current_analysis_graphs_dir
+from storage import store_lock
+
+
+def generate_analysis_graphs_path(rssi_cutoff, table_name, graphs_dir=None):
+    """
+    Generates a path to a graphs file created using a specific rssi_cutoff. Uses the same
+    naming scheme as the connections store keys
+    :param rssi_cutoff:
+    :param table_name: name of the connections table the graphs are built from (e.g. - m2m_dbl_daily)
+    :param graphs_dir: defaults to graphs_data_dir, where the analysis writes the graphs
+    :return:
+    """
+    if graphs_dir is None:
+        graphs_dir = graphs_data_dir
+    rssi_path = "rssi_"+str(abs(rssi_cutoff))
+    return os.path.join(graphs_dir, rssi_path, table_name + '.npz')
+
+
+def _analysis_graph_labels(members, tables, side1_column, side2_column):
+    """
+    Creates a stable index for the nodes of the graphs. Nodes from the members metadata come
+    first (sorted), followed by any other node that appears in the tables (sorted), so the
+    index is the same for all days and all rssi cutoffs
+    :param members: members table, indexed by member
+    :param tables: dict mapping rssi cutoffs to connection tables
+    :param side1_column:
+    :param side2_column:
+    :return: list of node labels
+    """
+    if side1_column.startswith('company'):
+        labels = sorted(members['company'].dropna().unique())
+    else:
+        labels = sorted(members.index)
+
+    known = set(labels)
+    observed = set()
+    for table in tables.values():
+        observed |= set(table.index.get_level_values(side1_column))
+        observed |= set(table.index.get_level_values(side2_column))
+    return labels + sorted(observed - known)
+
+
+def _analysis_write_graphs(table, side1_column, side2_column, labels, path):
+    """
+    Writes the daily graphs of a connection table into a single file. Edges are stored in
+    coordinate format, ordered by day, with an indptr array pointing to the edges of each day
+    :param table: daily connections table. Index should be datetime,side1_column,side2_column
+    :param side1_column:
+    :param side2_column:
+    :param labels: node labels, as returned by _analysis_graph_labels()
+    :param path:
+    :return:
+    """
+    table = table.reset_index()
+
+    # Timestamps are stored as UTC nanoseconds
+    day_values = table['datetime'].values.astype('int64')
+    days = np.unique(day_values)
+    day_pos = np.searchsorted(days, day_values)
+    order = np.argsort(day_pos, kind='mergesort')
+    indptr = np.searchsorted(day_pos[order], np.arange(len(days) + 1))
+
+    row = pd.Categorical(table[side1_column], categories=labels).codes[order]
+    col = pd.Categorical(table[side2_column], categories=labels).codes[order]
+    data = table['minutes'].values[order]
+
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # written under a temporary name, and replaced under the store lock, so publishing a snapshot
+    # never copies a half-written file
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, labels=np.array(labels), days=days, indptr=indptr,
+                            row=row.astype('int32'), col=col.astype('int32'), data=data)
+    with store_lock(analysis_store_path):
+        os.rename(path + '.tmp', path)
+
+
+def analysis_create_graphs(members, tables, table_name, side1_column, side2_column):
+    """
+    Creates the daily graphs of a connection table for all rssi cutoffs. Each graph is a
+    sparse node x node matrix of minutes, with a node index that is stable across days and cutoffs
+    :param members: members table, indexed by member
+    :param tables: dict mapping rssi cutoffs to daily connection tables
+    :param table_name: (e.g. - m2m_dbl_daily)
+    :param side1_column:
+    :param side2_column:
+    :return:
+    """
+    logger.info("Creating graphs for {}".format(table_name))
+    labels = _analysis_graph_labels(members, tables, side1_column, side2_column)
+    for rssi_cutoff, table in tables.items():
+        path = generate_analysis_graphs_path(rssi_cutoff, table_name)
+        _analysis_write_graphs(table, side1_column, side2_column, labels, path)
+        logger.info("Graphs, RSSI {}: {} nodes, {} edges".format(rssi_cutoff, len(labels), len(table)))
+
+
+def load_graphs(rssi_cutoff, table_name='m2m_dbl_daily', start=None, end=None, graphs_dir=None):
+    """
+    Loads the daily graphs of a connection table
+    :param rssi_cutoff:
+    :param table_name: (e.g. - m2m_dbl_daily, c2c_dbl_daily)
+    :param start: if given, only days on or after this time are loaded
+    :param end: if given, only days before this time are loaded
+    :param graphs_dir: defaults to the graphs of the current published snapshot (see snapshots.py)
+    :return: list of node labels, DatetimeIndex of days, and a list with a csr_matrix for each day
+    """
+    if graphs_dir is None:
+        graphs_dir = current_analysis_graphs_dir()
+    with np.load(generate_analysis_graphs_path(rssi_cutoff, table_name, graphs_dir)) as f:
+        labels = list(f['labels'])
+        days = pd.to_datetime(f['days'], utc=True).tz_convert(time_zone)
+        indptr = f['indptr']
+        row = f['row']
+        col = f['col']
+        data = f['data']
+
+    selected = np.ones(len(days), dtype=bool)
+    if start is not None:
+        selected &= (days >= pd.Timestamp(start, tz=time_zone))
+    if end is not None:
+        selected &= (days < pd.Timestamp(end, tz=time_zone))
+
+    n = len(labels)
+    matrices = []
+    for i in np.flatnonzero(selected):
+        a, b = indptr[i], indptr[i+1]
+        matrices.append(scipy.sparse.csr_matrix((data[a:b], (row[a:b], col[a:b])), shape=(n, n)))
+    return labels, days[selected], matrices
+
+
+def _graphs_to_frame(values, labels, days):
+    """
+    Helper, creates a day x node table from a list of per-day node vectors
+    """
+    df = pd.DataFrame(np.vstack(values) if len(values) > 0 else np.empty((0, len(labels))),
+                      index=days, columns=labels)
+    df.index.name = 'datetime'
+    df.columns.name = 'node'
+    return df
+
+
+def _binary(matrix):
+    """
+    Helper, returns the (unweighted) adjacency matrix of a graph, without self loops
+    """
+    b = (matrix > 0).astype('float64')
+    b.setdiag(0)
+    b.eliminate_zeros()
+    return b
+
+
+def graph_degree(labels, days, matrices):
+    """
+    Number of nodes each node was connected to, for each day
+    :return: day x node table
+    """
+    return _graphs_to_frame([np.asarray(_binary(m).sum(axis=1)).ravel() for m in matrices], labels, days)
+
+
+def graph_strength(labels, days, matrices):
+    """
+    Total minutes each node spent with other nodes, for each day. Self loops (e.g. - time with
+    members of the same company, in company graphs) are not included
+    :return: day x node table
+    """
+    return _graphs_to_frame([np.asarray(m.sum(axis=1)).ravel() - m.diagonal() for m in matrices], labels, days)
+
+
+def graph_clustering(labels, days, matrices):
+    """
+    Local (unweighted) clustering coefficient of each node, for each day. Same as
+    networkx.clustering(). Nodes with less than two neighbors have a coefficient of 0
+    :return: day x node table
+    """
+    values = []
+    for m in matrices:
+        b = _binary(m)
+        degree = np.asarray(b.sum(axis=1)).ravel()
+        triangles = np.asarray((b * b).multiply(b).sum(axis=1)).ravel()  # twice the number of triangles
+        pairs = degree * (degree - 1)
+        values.append(np.where(pairs > 0, triangles / np.maximum(pairs, 1), 0))
+    return _graphs_to_frame(values, labels, days)
+
+
+def graph_cross_company_share(labels, days, matrices, members):
+    """
+    Share of the minutes each member spent with members of other companies, for each day.
+    Only defined for member graphs (e.g. - m2m_dbl_daily). Members with no minutes get NaN
+    :param members: members table, indexed by member
+    :return: day x node table
+    """
+    companies = pd.Series(labels).map(members['company']).values
+    values = []
+    for m in matrices:
+        coo = m.tocoo()
+        cross = (companies[coo.row] != companies[coo.col]) & (coo.row != coo.col)
+        cross_minutes = np.bincount(coo.row[cross], weights=coo.data[cross], minlength=len(labels))
+        total_minutes = np.asarray(m.sum(axis=1)).ravel() - m.diagonal()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values.append(cross_minutes / total_minutes)
+    return _graphs_to_frame(values, labels, days)
+
+
+def graph_temporal_stability(labels, days, matrices):
+    """
+    Jaccard similarity between the neighbors of each node on a given day and on the previous
+    day in the list. Nodes with no neighbors on both days get NaN. The first day is not included
+    :return: day x node table
+    """
+    values = []
+    for previous, current in zip(matrices[:-1], matrices[1:]):
+        b_prev = _binary(previous)
+        b_cur = _binary(current)
+        both = np.asarray(b_prev.multiply(b_cur).sum(axis=1)).ravel()
+        either = np.asarray(b_prev.sum(axis=1)).ravel() + np.asarray(b_cur.sum(axis=1)).ravel() - both
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values.append(both / either)
+    return _graphs_to_frame(values, labels, days[1:])
+
+
+def graph_to_networkx(labels, matrix):
+    """
+    Converts a single graph to a networkx graph, with node labels
+    :param labels:
+    :param matrix:
+    :return:
+    """
+    import networkx as nx
+    g = nx.from_scipy_sparse_matrix(matrix)
+    return nx.relabel_nodes(g, dict(enumerate(labels)))
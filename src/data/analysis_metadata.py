@@ -3,6 +3,7 @@ import datetime
 
 import pandas as pd
 from config import *
+from storage import hdf_storage_kwargs, store_lock
 
 
 def _analysis_create_members():
@@ -21,7 +22,9 @@ def _analysis_create_members():
     members_metadata.set_index('member', inplace=True)
 
     out_store_key = "metadata/members"
-    members_metadata.to_hdf(analysis_store_path, out_store_key, mode="a", format="table", append=False)
+    with store_lock(analysis_store_path):
+        members_metadata.to_hdf(analysis_store_path, out_store_key, mode="a", format="table", append=False,
+                                **hdf_storage_kwargs(out_store_key))
 
 
 def analysis_metadata():
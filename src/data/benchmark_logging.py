@@ -0,0 +1,118 @@
+################################################################################
+#                           benchmark_logging.py
+#
+# Usage:
+#   python benchmark_logging.py [records_per_task] [tasks]
+#
+# Measures the time spent on logging by worker processes, with the logging set
+# up before logs.py (DEBUG level, every process writing to the same log file)
+# and with logs.setup_logging() (queue listener in the
+# parent, INFO level and sampled debug records by default). Each task logs
+# records_per_task debug records, like the per-participant lines of clean,
+# and one info record per 100 debug records. The legacy tasks format their
+# messages eagerly, as clean.py did. Console output is not included.
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import logging
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+import pandas as pd
+from config import *
+from logs import setup_logging, stop_logging
+
+
+def _log_task_legacy(records):
+    """
+    Helper, logs like the cleaning loops of clean.py did before logs.py
+    """
+    start_time = time.time()
+    member = 'member_id'
+    start_date_ts = pd.Timestamp('2018-06-12', tz=time_zone)
+    for i in range(records):
+        logger.debug("({}/{}) {},{},{}".format(i, records, member, start_date_ts, start_date_ts))
+        if i % 100 == 0:
+            logger.info("So far, keeping {} rows".format(i))
+    return time.time() - start_time
+
+
+def _log_task(records):
+    """
+    Helper, logs like the cleaning loops of clean.py
+    """
+    start_time = time.time()
+    member = 'member_id'
+    start_date_ts = pd.Timestamp('2018-06-12', tz=time_zone)
+    for i in range(records):
+        logger.debug("(%d/%d) %s,%s,%s", i, records, member, start_date_ts, start_date_ts)
+        if i % 100 == 0:
+            logger.info("So far, keeping {} rows".format(i))
+    return time.time() - start_time
+
+
+def _legacy_logging(path):
+    """
+    Helper, sets up logging the way config.py did before logs.py
+    """
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for log_filter in list(logger.filters):
+        logger.removeFilter(log_filter)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    file_handler = logging.FileHandler(path)
+    file_handler.setFormatter(logging.Formatter(log_fmt))
+    logger.addHandler(file_handler)
+
+
+def _run(func, records, tasks):
+    """
+    Helper, runs the tasks in a pool of num_processors processes
+    :return: wall time, and the total time spent inside the tasks
+    """
+    start_time = time.time()
+    pool = Pool(num_processors)
+    task_seconds = pool.map(func, [records] * tasks)
+    pool.close()
+    pool.join()
+    return time.time() - start_time, sum(task_seconds)
+
+
+def benchmark_logging(records, tasks):
+    """
+    Runs the benchmark with both logging setups
+    :return: table with one row per setup
+    """
+    directory = tempfile.mkdtemp(prefix='benchmark_logging_')
+    results = []
+    try:
+        _legacy_logging(os.path.join(directory, 'legacy.log'))
+        wall_seconds, task_seconds = _run(_log_task_legacy, records, tasks)
+        results.append({'setup': 'legacy', 'wall_sec': wall_seconds, 'task_sec': task_seconds,
+                        'log_mb': os.path.getsize(os.path.join(directory, 'legacy.log')) / 1024**2})
+
+        setup_logging(os.path.join(directory, 'queue.log'), console=False)
+        wall_seconds, task_seconds = _run(_log_task, records, tasks)
+        stop_logging()
+        results.append({'setup': 'queue', 'wall_sec': wall_seconds, 'task_sec': task_seconds,
+                        'log_mb': os.path.getsize(os.path.join(directory, 'queue.log')) / 1024**2})
+    finally:
+        shutil.rmtree(directory)
+    return pd.DataFrame(results).set_index('setup')
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tasks = int(sys.argv[2]) if len(sys.argv) > 2 else num_processors * 2
+
+    results = benchmark_logging(records, tasks)
+    with pd.option_context('display.width', 200, 'display.precision', 2):
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+################################################################################
+#                              benchmark_m2m.py
+#
+# Usage:
+#   python benchmark_m2m.py [members] [beacons] [hours]
+#
+# Compares the member to member table created by member_pairs.py with the one
+# of openbadge_analysis, on synthetic member to badge records: in each time
+# bin, each member observes a random subset of the other badges and of the
+# beacons. Reports the time of each implementation, and the largest
+# difference between their results (the index and columns must be the same).
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from config import *
+import member_pairs
+
+import openbadge_analysis as ob
+import openbadge_analysis.preprocessing
+
+# badge ids of the beacons start here, so they are not in the idmap
+_beacon_id_start = 40000
+
+
+def synthetic_m2badge(members, beacons, hours, seed=0):
+    """
+    Creates member to badge records, and the idmap of the members' badges
+    :return: records indexed by datetime, member and observed_id, with rssi and count columns,
+        and the idmap
+    """
+    random = np.random.RandomState(seed)
+    bins = pd.date_range(period1_start, periods=int(hours * 3600 / pd.Timedelta(time_bins_size).total_seconds()),
+                         freq=time_bins_size, tz=time_zone)
+    names = np.array(['M{:04d}'.format(m) for m in range(members)], dtype=object)
+    ids = np.append(np.arange(1, members + 1), _beacon_id_start + np.arange(beacons))
+    idmap = pd.Series(names, index=pd.Index(ids[:members], name='id'), name='member')
+
+    tables = []
+    for m in range(members):
+        seen = random.uniform(size=(len(bins), len(ids))) < 0.2
+        seen[:, m] = False
+        bin_index, id_index = np.nonzero(seen)
+        tables.append(pd.DataFrame({'datetime': bins[bin_index], 'member': names[m], 'observed_id': ids[id_index],
+                                    'rssi': np.round(random.normal(-75, 8, size=len(bin_index))),
+                                    'count': random.randint(1, 4, size=len(bin_index))}))
+    m2badge = pd.concat(tables, ignore_index=True).set_index(['datetime', 'member', 'observed_id']).sort_index()
+    return m2badge, idmap
+
+
+def benchmark_m2m(members, beacons, hours):
+    """
+    Runs both implementations on the same synthetic records
+    :return: table with one row per implementation
+    """
+    m2badge, idmap = synthetic_m2badge(members, beacons, hours)
+    rows = []
+    outputs = {}
+    for name, module in [('openbadge_analysis', ob.preprocessing), ('local', member_pairs)]:
+        start_time = time.time()
+        outputs[name] = module.member_to_member_proximity(m2badge, idmap)
+        rows.append({'implementation': name, 'seconds': time.time() - start_time, 'rows': len(outputs[name])})
+
+    reference, candidate = outputs['openbadge_analysis'], outputs['local']
+    if not reference.index.equals(candidate.index):
+        raise AssertionError("Different index: {} and {} rows".format(len(reference), len(candidate)))
+    if sorted(reference.columns) != sorted(candidate.columns):
+        raise AssertionError("Different columns: {} and {}".format(list(reference.columns), list(candidate.columns)))
+    difference = float(np.nanmax(np.abs(reference.values.astype(float) -
+                                        candidate[reference.columns].values.astype(float))))
+    for row in rows:
+        row['max_difference'] = difference
+    return pd.DataFrame(rows).set_index('implementation')[['rows', 'seconds', 'max_difference']]
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    beacons = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    hours = float(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    results = benchmark_m2m(members, beacons, hours)
+    with pd.option_context('display.width', 200, 'display.precision', 3):
+        print("{} members, {} beacons, {} hours".format(members, beacons, hours))
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
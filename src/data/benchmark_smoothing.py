@@ -0,0 +1,100 @@
+################################################################################
+#                           benchmark_smoothing.py
+#
+# Usage:
+#   python benchmark_smoothing.py [members] [beacons] [hours]
+#
+# Compares the smoothing and gap filling of the member to beacon table in
+# proximity_smooth.py with the ones of openbadge_analysis, on a synthetic
+# table: each member sees each beacon in a random fraction of the time bins.
+# Reports the time of each implementation, and
+# the largest difference between their results (the index must be the same).
+# The smoothing settings are the ones in config.py.
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from config import *
+import proximity_smooth
+
+import openbadge_analysis as ob
+import openbadge_analysis.preprocessing
+
+
+def synthetic_m2b(members, beacons, hours, seed=0):
+    """
+    Creates a member to beacon table. Each (member, beacon) pair is seen in a random fraction of
+    the time bins, so its series has gaps of all sizes
+    :return: table indexed by datetime, member and beacon, with an rssi column
+    """
+    random = np.random.RandomState(seed)
+    bins = pd.date_range(period1_start, periods=int(hours * 3600 / pd.Timedelta(time_bins_size).total_seconds()),
+                         freq=time_bins_size, tz=time_zone)
+    tables = []
+    for m in range(members):
+        for b in range(beacons):
+            seen = random.uniform(size=len(bins)) < random.uniform(0.05, 0.9)
+            tables.append(pd.DataFrame({'datetime': bins[seen], 'member': 'M{:04d}'.format(m),
+                                        'beacon': 'B{:03d}'.format(b),
+                                        'rssi': np.round(random.normal(-70, 8, size=seen.sum()), 1)}))
+    return pd.concat(tables, ignore_index=True).set_index(['datetime', 'member', 'beacon']).sort_index()
+
+
+def _max_difference(reference, candidate):
+    """
+    Helper, largest absolute difference between two tables with the same index and columns
+    """
+    if not reference.index.equals(candidate.index):
+        raise AssertionError("Different index: {} and {} rows".format(len(reference), len(candidate)))
+    return float(np.nanmax(np.abs(reference[reference.columns].values - candidate[reference.columns].values)))
+
+
+def benchmark_smoothing(members, beacons, hours):
+    """
+    Runs both implementations on the same synthetic table
+    :return: table with one row per step and implementation
+    """
+    m2b_raw = synthetic_m2b(members, beacons, hours)
+    rows = []
+    outputs = {}
+    for name, module in [('openbadge_analysis', ob.preprocessing), ('local', proximity_smooth)]:
+        start_time = time.time()
+        smooth = module.member_to_beacon_proximity_smooth(
+            m2b_raw, window_size=rssi_smooth_window_size, min_samples=rssi_smooth_min_samples)
+        smooth_seconds = time.time() - start_time
+
+        start_time = time.time()
+        filled = module.member_to_beacon_proximity_fill_gaps(
+            smooth, time_bins_size=time_bins_size, max_gap_size=time_bins_max_gap_size)
+        fill_seconds = time.time() - start_time
+
+        outputs[name] = (smooth, filled)
+        rows.append({'implementation': name, 'step': 'smooth', 'seconds': smooth_seconds, 'rows': len(smooth)})
+        rows.append({'implementation': name, 'step': 'fill_gaps', 'seconds': fill_seconds, 'rows': len(filled)})
+
+    for i, step in enumerate(['smooth', 'fill_gaps']):
+        difference = _max_difference(outputs['openbadge_analysis'][i], outputs['local'][i])
+        for row in rows:
+            if row['step'] == step:
+                row['max_difference'] = difference
+    return pd.DataFrame(rows).set_index(['step', 'implementation'])[['rows', 'seconds', 'max_difference']]
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    beacons = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    hours = float(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    results = benchmark_smoothing(members, beacons, hours)
+    with pd.option_context('display.width', 200, 'display.precision', 3):
+        print("{} members, {} beacons, {} hours. Window {}, min samples {}, max gap {} bins".format(
+            members, beacons, hours, rssi_smooth_window_size, rssi_smooth_min_samples, time_bins_max_gap_size))
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+################################################################################
+#                           benchmark_startup.py
+#
+# Usage:
+#   python benchmark_startup.py [repeats] [workers]
+#
+# Measures how long make_dataset takes to start, for each verb: a new
+# interpreter imports make_dataset and the modules the verb imports before it
+# does any work (help runs in full). The 'eager' row imports every stage
+# module, as make_dataset did before its imports were moved into the verbs.
+# Reports the median time over repeats, the number of modules loaded and
+# whether pandas was loaded.
+#
+# Then measures worker startup in process: the time to run workers trivial
+# tasks through workers.adaptive_imap() with each start method, from a parent
+# that holds parent_mb of memory (like process, which holds the results that
+# wait to be written). The forkserver is started by the first task, so its
+# time includes importing worker_preload_modules once.
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import json
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import pandas as pd
+from config import *
+
+# modules imported by each verb of make_dataset
+_verb_modules = OrderedDict([
+    ('help', []),
+    ('download', ['download']),
+    ('group', ['process']),
+    ('process', ['process']),
+    ('clean', ['clean']),
+    ('analysis', ['analysis']),
+    ('surveys', ['surveys']),
+    ('publish', ['snapshots']),
+    ('stream', ['stream', 'synthetic']),
+    ('preview', ['pandas', 'pipeline', 'preview']),
+    ('run', ['pipeline']),
+    ('eager', ['clean', 'download', 'process', 'analysis', 'surveys', 'stream', 'preview', 'synthetic',
+               'pipeline', 'snapshots']),
+])
+
+# memory held by the parent in the worker benchmark
+parent_mb = 1024
+
+_child_code = """
+import json, sys, time
+start_time = time.time()
+sys.argv = ['make_dataset.py', {verb!r}]
+import make_dataset
+{imports}
+seconds = time.time() - start_time
+print(json.dumps({{'seconds': seconds, 'modules': len(sys.modules), 'pandas': 'pandas' in sys.modules}}))
+"""
+
+
+def _start_verb(verb):
+    """
+    Helper, starts make_dataset in a new interpreter, up to where the verb starts working
+    :return: dict with the wall time (including interpreter startup), the time spent in python,
+        the number of modules, and whether pandas was loaded
+    """
+    if verb == 'help':
+        imports = "make_dataset._main()"
+    else:
+        imports = "\n".join("import " + module for module in _verb_modules[verb])
+    start_time = time.time()
+    output = subprocess.check_output([sys.executable, '-c', _child_code.format(verb=verb, imports=imports)],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    wall_seconds = time.time() - start_time
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['wall_seconds'] = wall_seconds
+    return result
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def benchmark_verbs(repeats):
+    """
+    Runs the startup of each verb repeats times
+    :return: table with one row per verb
+    """
+    rows = []
+    for verb in _verb_modules:
+        try:
+            runs = [_start_verb(verb) for _ in range(repeats)]
+        except subprocess.CalledProcessError as e:
+            rows.append({'verb': verb, 'error': 'exit code {}'.format(e.returncode)})
+            continue
+        rows.append({'verb': verb, 'wall_sec': _median([r['wall_seconds'] for r in runs]),
+                     'import_sec': _median([r['seconds'] for r in runs]),
+                     'modules': runs[0]['modules'], 'pandas': runs[0]['pandas']})
+    return pd.DataFrame(rows, columns=['verb', 'wall_sec', 'import_sec', 'modules', 'pandas', 'error']).set_index('verb')
+
+
+def _trivial_task(i):
+    """
+    Helper, a task that uses pandas, like the process workers
+    """
+    return len(pd.DataFrame({'i': [i]}))
+
+
+def benchmark_workers(workers):
+    """
+    Runs trivial tasks through adaptive_imap with each start method
+    :return: table with one row per start method
+    """
+    from workers import adaptive_imap
+
+    held = bytearray(parent_mb * 1024**2)
+    rows = []
+    for start_method in ['fork', 'forkserver']:
+        start_time = time.time()
+        list(adaptive_imap(_trivial_task, list(range(workers)), [1] * workers, num_processors,
+                           name='trivial tasks', start_method=start_method))
+        seconds = time.time() - start_time
+        rows.append({'start_method': start_method, 'tasks': workers, 'wall_sec': seconds,
+                     'ms_per_task': seconds / workers * 1000})
+    del held
+    return pd.DataFrame(rows).set_index('start_method')
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else num_processors * 4
+
+    verbs = benchmark_verbs(repeats)
+    worker_starts = benchmark_workers(workers)
+    with pd.option_context('display.width', 200, 'display.precision', 3):
+        print("Startup of make_dataset, median of {} runs".format(repeats))
+        print(verbs)
+        print("\nWorker startup, {} tasks, parent holding {} MB".format(workers, parent_mb))
+        print(worker_starts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+################################################################################
+#                           benchmark_storage.py
+#
+# Usage:
+#   python benchmark_storage.py [store_path] [key] [rows]
+#
+# Reads up to 'rows' rows of a table (by default, the first 2M rows of
+# proximity/member_to_badge in data_dirty.h5), writes them with each of the
+# storage profiles in hdf_storage_profiles, and reports the file size and the
+# read/write throughput of each profile. The 'pytables_defaults' row is what
+# the pipeline used before storage profiles (no compression, default chunks).
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+from config import *
+from storage import hdf_storage_profile
+
+
+def _benchmark_profile(df, key, profile_name, storage_kwargs, directory):
+    """
+    Writes and reads a table using a given storage profile
+    :return: dict with the results
+    """
+    path = os.path.join(directory, profile_name + '.h5')
+    in_memory_mb = df.memory_usage(index=True, deep=True).sum() / 1024**2
+
+    start_time = time.time()
+    df.to_hdf(path, key, mode='w', format='table', append=False, **storage_kwargs)
+    write_seconds = time.time() - start_time
+
+    start_time = time.time()
+    df_read = pd.read_hdf(path, key)
+    read_seconds = time.time() - start_time
+
+    # selective read, as done by the daily loops of clean and analysis
+    datetimes = df.index.get_level_values('datetime')
+    first_day = datetimes.min().normalize()
+    where = "datetime >= '" + str(first_day) + "' & datetime < '" + str(first_day + pd.Timedelta(days=1)) + "'"
+    start_time = time.time()
+    pd.read_hdf(path, key, where=where)
+    select_seconds = time.time() - start_time
+
+    size_mb = os.path.getsize(path) / 1024**2
+    if len(df_read) != len(df):
+        logger.warning("Profile {} read {} rows, expected {}".format(profile_name, len(df_read), len(df)))
+
+    return {
+        'profile': profile_name,
+        'size_mb': size_mb,
+        'compression_ratio': in_memory_mb / size_mb,
+        'write_mb_per_sec': in_memory_mb / write_seconds,
+        'read_mb_per_sec': in_memory_mb / read_seconds,
+        'select_day_sec': select_seconds,
+    }
+
+
+def benchmark_storage(store_path, key, rows):
+    """
+    Benchmarks all storage profiles on a sample of a table
+    :param store_path:
+    :param key:
+    :param rows: maximum number of rows to use
+    :return: table with one row per profile
+    """
+    logger.info("Loading {} rows of {} from {}".format(rows, key, store_path))
+    df = pd.read_hdf(store_path, key, start=0, stop=rows)
+    logger.info("Loaded {} rows. Key uses profile '{}'".format(len(df), hdf_storage_profile(key)))
+
+    profiles = [('pytables_defaults', {})] + sorted(hdf_storage_profiles.items())
+    directory = tempfile.mkdtemp(prefix='benchmark_storage_')
+    try:
+        results = [_benchmark_profile(df, key, name, kwargs, directory) for name, kwargs in profiles]
+    finally:
+        shutil.rmtree(directory)
+
+    return pd.DataFrame(results).set_index('profile')
+
+
+def main():
+    store_path = sys.argv[1] if len(sys.argv) > 1 else dirty_store_path
+    key = sys.argv[2] if len(sys.argv) > 2 else 'proximity/member_to_badge'
+    rows = int(sys.argv[3]) if len(sys.argv) > 3 else 2000000
+
+    results = benchmark_storage(store_path, key, rows)
+    with pd.option_context('display.width', 200, 'display.precision', 2):
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
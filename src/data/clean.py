@@ -1,15 +1,17 @@
 from __future__ import absolute_import, division, print_function
 import datetime
 
+import numpy as np
 import pandas as pd
 from config import *
+from storage import commit_unit, merge_units, read_checkpoint, recover_checkpoint, reset_checkpoint
 
 
 def _drop_in_time_slice(m2m, m2b, m5cb, time_slice, to_drop):
     """Drops certain members from data structures, only in a given time slice.
     This can be useful for removing people who weren't there on a specific day, or non-participants.
     """
-    logger.debug("Removing data: {} {}".format(time_slice, to_drop))
+    logger.debug("Removing data: %s %s", time_slice, to_drop)
     m2m.drop(m2m.loc[(time_slice, slice(None), to_drop), :].index, inplace=True)
     m2m.drop(m2m.loc[(time_slice, to_drop, slice(None)), :].index, inplace=True)
     m2b.drop(m2b.loc[(time_slice, to_drop, slice(None)), :].index, inplace=True)
@@ -21,8 +23,16 @@ def _clean_m2m(where, participation_dates, battery_sundays):
     m2m = pd.read_hdf(dirty_store_path, 'proximity/member_to_member', where=where)
     logger.info("original m2m len: {}".format(len(m2m)))
 
+    return _filter_m2m(m2m, participation_dates, battery_sundays)
+
+
+def _filter_m2m(m2m, participation_dates, battery_sundays):
+    """
+    Keeps the m2m records of participants within their participation dates, outside battery changes.
+    Used by clean and by the streaming mode
+    """
     if len(m2m) == 0:
-        return
+        return m2m
 
     logger.info('cleaning m2m')
     m2m.reset_index(inplace=True)
@@ -39,7 +49,7 @@ def _clean_m2m(where, participation_dates, battery_sundays):
     total_count = len(participation_dates)
     for item, p in participation_dates.iterrows():
         i += 1
-        logger.debug("({}/{}) {},{},{}".format(i, total_count, p.member, p.start_date_ts, p.end_date_ts))
+        logger.debug("(%d/%d) %s,%s,%s", i, total_count, p.member, p.start_date_ts, p.end_date_ts)
 
         side1_cond = ((m2m.member1 == p.member) & (m2m.datetime >= p.start_date_ts) & (m2m.datetime < p.end_date_ts))
         m2m.loc[side1_cond, 'keep_1'] = True
@@ -59,7 +69,7 @@ def _clean_m2m(where, participation_dates, battery_sundays):
     for item, s in battery_sundays.iterrows():
         i += 1
 
-        logger.debug("({}/{}) {},{}".format(i, total_count, s.battery_period_start, s.battery_period_end))
+        logger.debug("(%d/%d) %s,%s", i, total_count, s.battery_period_start, s.battery_period_end)
 
         cond = ((m2m.datetime >= s.battery_period_start) & (m2m.datetime <= s.battery_period_end))
         m2m.loc[cond, 'keep'] = False
@@ -71,10 +81,7 @@ def _clean_m2m(where, participation_dates, battery_sundays):
     del m2m['keep']
     m2m.set_index(['datetime','member1','member2'], inplace=True)
 
-    logger.info("appending cleaned m2m to {}".format(clean_store_path))
-    with pd.HDFStore(clean_store_path) as store:
-        store.append('proximity/member_to_member', m2m)
-    del m2m
+    return m2m
 
 
 def _clean_m2b(where, participation_dates, battery_sundays):
@@ -82,8 +89,16 @@ def _clean_m2b(where, participation_dates, battery_sundays):
     m2b = pd.read_hdf(dirty_store_path, 'proximity/member_to_beacon', where=where)
     logger.info("original m2b len: {}".format(len(m2b)))
 
+    return _filter_m2b(m2b, participation_dates, battery_sundays)
+
+
+def _filter_m2b(m2b, participation_dates, battery_sundays):
+    """
+    Keeps the m2b records of participants within their participation dates, outside battery changes.
+    Used by clean and by the streaming mode
+    """
     if len(m2b) == 0:
-        return
+        return m2b
 
     logger.info("cleaning m2b")
     m2b.reset_index(inplace=True)
@@ -97,7 +112,7 @@ def _clean_m2b(where, participation_dates, battery_sundays):
     total_count = len(participation_dates)
     for item, p in participation_dates.iterrows():
         i += 1
-        logger.debug("({}/{}) {},{},{}".format(i, total_count, p.member, p.start_date_ts, p.end_date_ts))
+        logger.debug("(%d/%d) %s,%s,%s", i, total_count, p.member, p.start_date_ts, p.end_date_ts)
         side1_cond = ((m2b.member == p.member) & (m2b.datetime >= p.start_date_ts) & (m2b.datetime < p.end_date_ts))
         m2b.loc[side1_cond, 'keep'] = True
 
@@ -109,7 +124,7 @@ def _clean_m2b(where, participation_dates, battery_sundays):
     total_count = len(battery_sundays)
     for item, s in battery_sundays.iterrows():
         i += 1
-        logger.debug("({}/{}) {},{}".format(i, total_count, s.battery_period_start, s.battery_period_end))
+        logger.debug("(%d/%d) %s,%s", i, total_count, s.battery_period_start, s.battery_period_end)
         cond = ((m2b.datetime >= s.battery_period_start) & (m2b.datetime <= s.battery_period_end))
         m2b.loc[cond, 'keep'] = False
     logger.info('So far, keeping {} rows'.format(len(m2b[m2b['keep'] == True])))
@@ -120,10 +135,7 @@ def _clean_m2b(where, participation_dates, battery_sundays):
     del m2b['keep']
     m2b.set_index(['datetime','member','beacon'], inplace=True)
 
-    logger.info("appending cleaned m2b to {}".format(clean_store_path))
-    with pd.HDFStore(clean_store_path) as store:
-        store.append('proximity/member_to_beacon', m2b)
-    del m2b
+    return m2b
 
 
 def _clean_m5cb(where, participation_dates, battery_sundays):
@@ -131,8 +143,16 @@ def _clean_m5cb(where, participation_dates, battery_sundays):
     m5cb = pd.read_hdf(dirty_store_path, 'proximity/member_5_closest_beacons', where=where)
     logger.info("original m2b len: {}".format(len(m5cb)))
 
+    return _filter_m5cb(m5cb, participation_dates, battery_sundays)
+
+
+def _filter_m5cb(m5cb, participation_dates, battery_sundays):
+    """
+    Keeps the m5cb records of participants within their participation dates, outside battery changes.
+    Used by clean and by the streaming mode
+    """
     if len(m5cb) == 0:
-        return
+        return m5cb
 
     logger.info("cleaning m2b")
     m5cb.reset_index(inplace=True)
@@ -146,7 +166,7 @@ def _clean_m5cb(where, participation_dates, battery_sundays):
     total_count = len(participation_dates)
     for item, p in participation_dates.iterrows():
         i += 1
-        logger.debug("({}/{}) {},{},{}".format(i, total_count, p.member, p.start_date_ts, p.end_date_ts))
+        logger.debug("(%d/%d) %s,%s,%s", i, total_count, p.member, p.start_date_ts, p.end_date_ts)
         side1_cond = ((m5cb.member == p.member) & (m5cb.datetime >= p.start_date_ts) & (m5cb.datetime < p.end_date_ts))
         m5cb.loc[side1_cond, 'keep'] = True
 
@@ -158,7 +178,7 @@ def _clean_m5cb(where, participation_dates, battery_sundays):
     total_count = len(battery_sundays)
     for item, s in battery_sundays.iterrows():
         i += 1
-        logger.debug("({}/{}) {},{}".format(i, total_count, s.battery_period_start, s.battery_period_end))
+        logger.debug("(%d/%d) %s,%s", i, total_count, s.battery_period_start, s.battery_period_end)
         cond = ((m5cb.datetime >= s.battery_period_start) & (m5cb.datetime <= s.battery_period_end))
         m5cb.loc[cond, 'keep'] = False
     logger.info('So far, keeping {} rows'.format(len(m5cb[m5cb['keep'] == True])))
@@ -169,22 +189,15 @@ def _clean_m5cb(where, participation_dates, battery_sundays):
     del m5cb['keep']
     m5cb.set_index(['datetime', 'member'], inplace=True)
 
-    logger.info("appending cleaned m5cb to {}".format(clean_store_path))
-    with pd.HDFStore(clean_store_path) as store:
-        store.append('proximity/member_5_closest_beacons', m5cb)
-    del m5cb
+    return m5cb
 
 
-def _clean_date_range(start_ts, end_ts, members_metadata):
+def _clean_filters(members_metadata):
     """
-    Clean a given date range for all relevant dataframes
+    Creates the tables used to filter the data: the participation dates of each member, and the
+    times of battery changes
+    :return: participation_dates, battery_sundays
     """
-
-    ##################################################
-    # figure out what to drop and what to keep
-    ##################################################
-    where = "datetime >= '" + str(start_ts) + "' & datetime < '" + str(end_ts) + "'"
-
     # Convert text into timestamps with timezone
     period1_start_ts = pd.Timestamp(period1_start, tz=time_zone)
     period2_end_ts = pd.Timestamp(period2_end, tz=time_zone)
@@ -204,27 +217,88 @@ def _clean_date_range(start_ts, end_ts, members_metadata):
     battery_sundays = battery_sundays[battery_sundays.su.dt.dayofweek == 6]
     battery_sundays['battery_period_start'] = battery_sundays.su + pd.Timedelta(hours=19, minutes=30)
     battery_sundays['battery_period_end'] = battery_sundays.su + pd.Timedelta(hours=23, minutes=30)
+    return participation_dates, battery_sundays
+
+
+def _stream_hour_starts(names):
+    """
+    Helper, start times of the hours the streaming mode committed to the clean store
+    :param names: units of the 'stream' checkpoint (hour names, e.g. - 20180612-10.gz)
+    :return: list of localized timestamps
+    """
+    return [pd.Timestamp(datetime.datetime.strptime(name.split('.')[0], "%Y%m%d-%H")).tz_localize(time_zone)
+            for name in names]
+
+
+def _drop_stream_hours(table, hour_starts):
+    """
+    Helper, drops the rows of the hours the streaming mode already committed to the clean store
+    """
+    if len(hour_starts) == 0 or len(table) == 0:
+        return table
+    datetimes = table.index.get_level_values('datetime')
+    streamed = np.zeros(len(table), dtype=bool)
+    for hour_start in hour_starts:
+        streamed |= (datetimes >= hour_start) & (datetimes < hour_start + pd.Timedelta(hours=1))
+    return table[~streamed]
+
+
+def _clean_date_range(start_ts, end_ts, members_metadata, stream_hour_starts=()):
+    """
+    Clean a given date range for all relevant dataframes. The cleaned tables are kept in memory
+    and committed to the clean store together, so a day is either fully written or not at all.
+    Hours that the streaming mode already committed are left out
+    """
+
+    ##################################################
+    # figure out what to drop and what to keep
+    ##################################################
+    where = "datetime >= '" + str(start_ts) + "' & datetime < '" + str(end_ts) + "'"
+    participation_dates, battery_sundays = _clean_filters(members_metadata)
 
     ##################################################
     # Clean
     ##################################################
+    tables = []
     logger.info('---------------------------------------')
-    _clean_m2m(where, participation_dates, battery_sundays)
+    tables.append(('proximity/member_to_member', _clean_m2m(where, participation_dates, battery_sundays)))
 
     logger.info('---------------------------------------')
-    _clean_m2b(where, participation_dates, battery_sundays)
+    tables.append(('proximity/member_to_beacon', _clean_m2b(where, participation_dates, battery_sundays)))
 
     logger.info('---------------------------------------')
-    _clean_m5cb(where, participation_dates, battery_sundays)
+    tables.append(('proximity/member_5_closest_beacons', _clean_m5cb(where, participation_dates, battery_sundays)))
 
+    hour_starts = [h for h in stream_hour_starts if start_ts <= h < end_ts]
+    if len(hour_starts) > 0:
+        logger.info("Leaving out {} hours committed by the stream".format(len(hour_starts)))
+        tables = [(key, _drop_stream_hours(table, hour_starts)) for key, table in tables]
 
+    logger.info("appending cleaned tables to {}".format(clean_store_path))
+    commit_unit(clean_store_path, 'clean', str(start_ts), tables)
 
-def clean_up_data():
-    # remove dirty data if already there
-    try:
-        os.remove(clean_store_path)
-    except OSError:
-        pass
+
+
+def clean_up_data(resume=False):
+    """
+    Cleans the dirty store into the clean store, one day at a time
+    :param resume: keep the clean store, and only clean days that were not committed yet. Hours
+        that the streaming mode committed are not cleaned again
+    """
+    if resume:
+        done = recover_checkpoint(clean_store_path, 'clean')
+        # the stream may still be running, so its checkpoint is only read
+        stream_hour_starts = _stream_hour_starts(read_checkpoint(clean_store_path, 'stream')['done'])
+    else:
+        # remove dirty data if already there. Hours committed by the stream are cleaned again too
+        try:
+            os.remove(clean_store_path)
+        except OSError:
+            pass
+        reset_checkpoint(clean_store_path, 'clean')
+        reset_checkpoint(clean_store_path, 'stream')
+        done = set()
+        stream_hour_starts = []
 
     logger.info("Cleaning up the data")
     members_metadata = pd.read_csv(members_metadata_path)
@@ -260,15 +334,20 @@ def clean_up_data():
     ##################################################
     # period 1
     for i in range(0, len(period1_dates) - 1, 1):
+        if str(period1_dates[i]) in done:
+            continue
         logger.info('---------------------------------------')
         logger.info("Cleaning date: {} - {}".format(period1_dates[i],period1_dates[i+1]))
-        _clean_date_range(period1_dates[i], period1_dates[i+1], members_metadata)
+        _clean_date_range(period1_dates[i], period1_dates[i+1], members_metadata, stream_hour_starts)
 
     # Period 2
     for i in range(0, len(period2_dates) - 1, 1):
+        if str(period2_dates[i]) in done:
+            continue
         logger.info('---------------------------------------')
         logger.info("Cleaning date: {} - {}".format(period2_dates[i], period2_dates[i + 1]))
-        _clean_date_range(period2_dates[i], period2_dates[i+1], members_metadata)
+        _clean_date_range(period2_dates[i], period2_dates[i+1], members_metadata, stream_hour_starts)
 
+    merge_units(clean_store_path, 'clean')
     logger.info('---------------------------------------')
     logger.info('Completed cleaning data!')
@@ -24,6 +24,45 @@ project_time_slices = [slice(period1_start, period1_end),
 # rssis to use in the analysis
 rssi_cutoffs = [-51,-57,-60,-62,-65]
 
+# Write the (15 seconds level) double sided member-to-member table for each rssi cutoff.
+#   Connection tables are computed without it, so it's only needed for ad-hoc analysis
+analysis_write_m2m_dbl = False
+
+# Time levels of the connection tables. Tables are aggregated once at the base frequency, and
+#   then rolled up to each of the (frequency, name) pairs, stored as <table>_<name> (for
+#   example, m2m_dbl_daily). Frequencies must be the base frequency or coarser. Besides pandas
+#   frequencies (e.g. - 'H', 'D', 'MS', 'AS'), these are supported:
+#     'shift'  - the shift windows in analysis_connections_shifts (needs an hourly base)
+#     'week'   - ISO weeks, labeled by their Monday
+#     'period' - the project periods in project_time_slices
+#   Levels made of whole days are rolled up from the daily tables, if 'D' comes before them
+analysis_connections_base_freq = 'H'
+analysis_connections_freqs = [('H', 'hourly'), ('shift', 'shift'), ('D', 'daily'), ('week', 'weekly'),
+                              ('period', 'period'), ('AS', 'annual')]
+
+# Shift windows within a day, as (name, start hour, end hour). Hours outside all windows are
+#   not included in the shift tables
+analysis_connections_shifts = [('night', 0, 8), ('morning', 8, 12), ('afternoon', 12, 18), ('evening', 18, 24)]
+
+# Daily connection tables that are also stored as sparse daily graphs, under graphs_data_dir
+analysis_graphs_tables = ['m2m_dbl', 'c2c_dbl']
+
+# Co-location settings (see analysis_colocation.py). Two members are co-located in a time bin when
+#   they are at the same beacon
+#   analysis_colocation_rssi_cutoffs - a member is at a beacon if its RSSI to the beacon passes the
+#       cutoff. Tables are written for each cutoff, like the connection tables
+#   analysis_colocation_top_k - beacons of each member that are used (1 for the closest beacon only,
+#       up to 5 for the 5 closest beacons)
+#   analysis_colocation_min_overlap - number of their top k beacons the two members must share
+#   analysis_colocation_freqs - time levels, as in analysis_connections_freqs. Tables are built
+#       daily, so only daily or coarser levels are supported
+#   analysis_colocation_chunk_pairs - maximal number of pairs generated at once
+analysis_colocation_rssi_cutoffs = [-65, -75, -85]
+analysis_colocation_top_k = 1
+analysis_colocation_min_overlap = 1
+analysis_colocation_freqs = [('D', 'daily'), ('week', 'weekly'), ('period', 'period')]
+analysis_colocation_chunk_pairs = 5000000
+
 # range of raspberry pi numbers included in experiment. It's fine to include
 #    sometimes-inactive pis, these files will be detected and ignored.
 pi_range = range(12, 27)
@@ -32,15 +71,91 @@ pi_range = range(12, 27)
 # Leave at least 1 processor on the machine available, so it stays responsive
 num_processors = 8
 
+# Memory settings for process, which runs one hourly file per worker (see workers.py). The number
+#   of workers (up to num_processors) is adapted so the predicted memory of the running workers
+#   stays under the ceiling
+#   worker_memory_limit - memory ceiling in bytes. If None, worker_memory_fraction of the physical memory
+#   worker_memory_safety - multiplier applied to the predicted memory of each task
+#   worker_memory_reserve - don't start new workers while less than this is available (bytes)
+#   worker_rss_guard_factor - stop a worker whose RSS grows over this multiple of its prediction,
+#       and run its file again alone
+worker_memory_limit = None
+worker_memory_fraction = 0.75
+worker_memory_safety = 1.2
+worker_memory_reserve = 2 * 1024**3
+worker_rss_guard_factor = 2.0
+
+# How the process workers are started (see workers.py)
+#   worker_start_method - 'forkserver' forks each worker from a small server process that imported
+#       worker_preload_modules once, so workers start without importing them again, and without
+#       copying the memory of the parent. 'fork' forks the parent. Can be overridden with the
+#       BADGES_WORKER_START_METHOD environment variable. Where forkserver isn't available (python 2,
+#       Windows), workers are forked
+#   worker_preload_modules - imported by the server when it starts
+worker_start_method = os.environ.get('BADGES_WORKER_START_METHOD') or 'forkserver'
+worker_preload_modules = ['numpy', 'pandas', 'tables', 'openbadge_analysis.preprocessing', 'process']
+
+# Number of processors to use when analyzing compliance (one day per process). Each
+#   process holds a full day of m2badge and m2m in memory, so this can be lower than
+#   num_processors. Set to 1 to analyze days serially
+analysis_comply_num_processors = 4
+
+# Maximal number of make_dataset stages to run at once, when using 'run' (see pipeline.py).
+#   Stages use their own pools of processes, so keep this low
+pipeline_max_concurrent_stages = 2
+
 # Data cleaning settings
 rssi_smooth_window_size = '1min' # Window size for smoothing proximity_data_dir
 rssi_smooth_min_samples = 1      # Only calculate if window has at least this number of samples
 time_bins_max_gap_size = 2       # this is the maximum number of consecutive NaN values to fill
+# Smooth and fill gaps with proximity_smooth.py instead of openbadge_analysis (same results, faster
+#   with many beacons)
+process_local_smoothing = True
+# Create the member to member table with member_pairs.py instead of openbadge_analysis
+process_local_m2m = True
+
+# Survey settings
+# Daily survey answers recorded before this hour belong to the previous day
+surveys_effective_date_breakpoint_hour = 12
+
+# Group settings
+# Also write the hourly data as binary columnar chunks (under proximity_chunks_dir). When
+#   available, process reads them instead of parsing the hourly JSON files
+group_write_binary_chunks = True
+
+# Streaming settings (see stream.py)
+#   stream_emit_seconds - how often (wall time) the open hours are processed, and the time bins
+#       that are complete are emitted
+#   stream_allowed_lateness_seconds - how late (in event time) records may arrive. A time bin is
+#       emitted, and an hour is closed and written to the stores, once the latest timestamp seen is
+#       this far past its end. Should cover the RSSI smoothing window and the gap filling
+#   stream_poll_seconds - how long to wait when the hub files have no new data
+#   stream_read_bytes - maximal number of bytes read from a hub file at once
+stream_emit_seconds = 30
+stream_allowed_lateness_seconds = 120
+stream_poll_seconds = 1.0
+stream_read_bytes = 64 * 1024**2
+
+# Preview mode settings (see preview.py). Preview mode is on when the BADGES_PREVIEW environment
+#   variable is set, to the kind of sample to run on:
+#     'badges' - a subset of the participants
+#     'days'   - a subset of the days, stratified by weekdays and weekends
+#     'hours'  - a subset of the hourly files, stratified by hour of day
+#   The stores are then written under interim/preview_<sample>
+#   preview_fraction - fraction of the units (badges, days or hourly files) in the sample
+#       (BADGES_PREVIEW_FRACTION)
+#   preview_seed - changes the sample (BADGES_PREVIEW_SEED). The same seed gives the same sample
+#   preview_confidence - confidence level of the intervals of the estimates
+preview_sample = os.environ.get('BADGES_PREVIEW') or None
+preview_fraction = float(os.environ.get('BADGES_PREVIEW_FRACTION', '0.1'))
+preview_seed = int(os.environ.get('BADGES_PREVIEW_SEED', '0'))
+preview_confidence = 0.95
 
 ### Various directories ###
 project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
 # project_dir = os.path.join('/home', 'kyeb', 'badges', 'test_data')
-data_dir = os.path.join(project_dir, 'data')
+# BADGES_DATA_DIR replaces the data directory, e.g. - to run on synthetic data (see shadow.py)
+data_dir = os.environ.get('BADGES_DATA_DIR') or os.path.join(project_dir, 'data')
 raw_data_dir = os.path.join(data_dir, 'raw', 'hub_data')
 interim_data_dir = os.path.join(data_dir, 'interim')
 metadata_dir = os.path.join(data_dir, 'metadata')
@@ -56,23 +171,87 @@ members_metadata_path = os.path.join(metadata_dir, members_metadata_filename)
 
 raw_data_proximity_filename_pattern = os.path.join(raw_data_dir, '*proximity*.txt.gz')
 proximity_data_dir = os.path.join(interim_data_dir, 'proximity')
+proximity_chunks_dir = os.path.join(interim_data_dir, 'proximity_chunks')
+# Hub files tailed by the streaming mode. Hubs append JSON lines to them, uncompressed
+stream_hub_dir = os.path.join(raw_data_dir, 'live')
+stream_hub_file_pattern = os.path.join(stream_hub_dir, '*proximity*.txt')
+
+# The stores, and the files derived from them. Preview runs read the same hourly files, but
+#   write to their own directory
+stores_dir = interim_data_dir if preview_sample is None else os.path.join(interim_data_dir, 'preview_' + preview_sample)
+dirty_store_path = os.path.join(stores_dir, 'data_dirty.h5')
+clean_store_path = os.path.join(stores_dir, 'data_cleaned.h5')
+analysis_store_path = os.path.join(stores_dir, 'analysis.h5')
+analysis_notebooks_store_path = os.path.join(stores_dir, 'analysis_notebooks.h5')
+# Published copies of the analysis store, read by notebooks while the stages write to
+#   analysis_store_path (see snapshots.py). Old snapshots are removed, keeping the newest
+#   analysis_snapshots_keep, and the ones published in the last analysis_snapshots_min_age_seconds
+analysis_snapshots_dir = os.path.join(stores_dir, 'analysis_snapshots')
+analysis_snapshots_keep = 3
+analysis_snapshots_min_age_seconds = 24 * 3600
+graphs_data_dir = os.path.join(stores_dir, 'graphs')
+features_cache_dir = os.path.join(stores_dir, 'features_cache')
+pipeline_state_path = os.path.join(stores_dir, 'pipeline_state.json')
+stream_store_path = os.path.join(stores_dir, 'stream.h5')
+# Packet counts of each hub in each hour, written by group (see process.group_by_hour)
+hub_packets_store_path = os.path.join(stores_dir, 'hub_packets.h5')
+pi_hour_packets_store_key = 'other/pi_hour_packets'
 
-dirty_store_path = os.path.join(interim_data_dir, 'data_dirty.h5')
-clean_store_path = os.path.join(interim_data_dir, 'data_cleaned.h5')
-analysis_store_path = os.path.join(interim_data_dir, 'analysis.h5')
-analysis_notebooks_store_path = os.path.join(interim_data_dir, 'analysis_notebooks.h5')
+# Maximum size of the in-process cache used by query.py, in bytes
+query_cache_max_bytes = 2 * 1024**3
+
+# HDF storage profiles, applied to every table written to the stores (see storage.py).
+#   complib/complevel - compression. The 15 seconds level tables are dominated by repetitive
+#       member, beacon and time columns, so they compress very well
+#   expectedrows - PyTables derives the chunk shape of a new table from it. Should be close
+#       to the final size of the table (pandas doesn't expose the chunk shape directly)
+#   chunksize - number of rows written in each batch
+hdf_storage_profiles = {
+    'bins_large': {'complib': 'blosc:lz4', 'complevel': 5, 'expectedrows': 200000000, 'chunksize': 1000000},
+    'bins': {'complib': 'blosc:lz4', 'complevel': 5, 'expectedrows': 20000000, 'chunksize': 500000},
+    'aggregates': {'complib': 'blosc:zstd', 'complevel': 5, 'expectedrows': 1000000, 'chunksize': 100000},
+    'metadata': {'complib': None, 'complevel': 0, 'expectedrows': 10000, 'chunksize': 10000},
+}
+
+# Maps store keys to storage profiles. Patterns are matched in order (fnmatch style), and
+#   keys that don't match any pattern use hdf_storage_default_profile
+hdf_storage_profile_keys = [
+    ('proximity/member_to_badge', 'bins_large'),
+    ('proximity/member_to_beacon*', 'bins_large'),
+    ('proximity/rssi_*/m2m_comply_filtered', 'bins'),
+    ('proximity/rssi_*/m2m_dbl', 'bins'),
+    ('proximity/rssi_*', 'aggregates'),
+    ('proximity/member_to_member_days', 'metadata'),
+    ('proximity/member_comply_daily', 'metadata'),
+    ('proximity/connections_*', 'metadata'),
+    ('proximity/*', 'bins'),
+    ('other/pi_hour_packets', 'metadata'),
+    ('other/*', 'bins'),
+    ('stream/*', 'bins'),
+    ('metadata/*', 'metadata'),
+    ('daily/*', 'metadata'),
+    ('entry/*', 'metadata'),
+    ('panels/*', 'metadata'),
+    ('preview/*', 'metadata'),
+]
+hdf_storage_default_profile = 'aggregates'
 
 surveys_anon_store_path = os.path.join(data_dir,'raw','surveys', 'surveys_anon.h5')
-surveys_clean_store_path = os.path.join(interim_data_dir, 'surveys_clean.h5')
+surveys_clean_store_path = os.path.join(stores_dir, 'surveys_clean.h5')
 
 performance_anon_store_path = os.path.join(data_dir,'raw','performance', 'performance_anon.h5')
 performance_clean_store_path = os.path.join(interim_data_dir, 'performance_clean.h5')
 
+# Logging settings (see logs.py)
+#   log_level - default level. Debug records are only created if some module logs at DEBUG
+#   log_module_levels - levels of specific modules (e.g. - {'clean': 'DEBUG'})
+#   log_debug_sampling - keep one of every N debug records of each logging line, by module
+log_path = 'make_dataset.log'
+log_level = 'INFO'
+log_module_levels = {}
+log_debug_sampling = {'clean': 100, 'workers': 10}
+
+# Handlers are set up by logs.setup_logging(), so importing config has no side effects
 logger = logging.getLogger(__name__)
 log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
-logging.basicConfig(level=logging.DEBUG, format=log_fmt)
-
-fileHandler = logging.FileHandler("make_dataset.log")
-fileFormatter = logging.Formatter(log_fmt)
-fileHandler.setFormatter(fileFormatter)
-logger.addHandler(fileHandler)
+logger.addHandler(logging.NullHandler())
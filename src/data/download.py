@@ -1,18 +1,19 @@
 from __future__ import absolute_import, division, print_function
 import time
 import urllib
-from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 from config import *
 
 
 def download_data(dates):
     '''
-    Downloads the data for 'dates' in 'pi_range' to 'directory', in parallel
+    Downloads the data for 'dates' in 'pi_range' to 'directory', in parallel. Downloads
+    wait on the network, so they run in threads rather than processes
     '''
     url = "http://openbadgeprod.media.mit.edu/media/data/SQKYZR2SXK/badgepi-{}_proximity_2018-{}.txt"
     filenames = []
-    pool = Pool(num_processors)
+    pool = ThreadPool(num_processors)
     for date in dates:
         # remove hourly files if they exist for the day
         try:
@@ -0,0 +1,196 @@
+################################################################################
+#                               logs.py
+#
+# Logging for make_dataset. All the modules log through the logger defined in
+# config.py. setup_logging() is called once, in the parent process. It replaces
+# the handlers of that logger with a handler that puts records on a queue, and
+# starts a listener thread that writes them to the console and to log_path.
+# Worker processes are forked from the parent, so they inherit the queue
+# handler, and only the parent writes to the log file. Workers that are not
+# forked from the parent (e.g. - started by a forkserver, see workers.py) get
+# the queue and the filters from worker_logging(), and set them up with
+# setup_worker_logging().
+#
+# Records are filtered before they are formatted: by level (log_level, and
+# log_module_levels for specific modules), and debug records of the modules in
+# log_debug_sampling are sampled. Messages are only formatted for records that
+# pass the filters.
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import json
+import logging
+import multiprocessing
+import threading
+
+from config import *
+
+_listener = {}
+
+
+class _ModuleFilter(logging.Filter):
+    """
+    Filters records by the module that logged them (record.module, e.g. - clean). Keeps records at
+    or above the level of their module, and one of every N debug records of each logging line of
+    sampled modules
+    """
+    def __init__(self, default_level, module_levels, debug_sampling):
+        logging.Filter.__init__(self)
+        self.default_level = default_level
+        self.module_levels = module_levels
+        self.debug_sampling = debug_sampling
+        self.counts = {}
+
+    def filter(self, record):
+        if record.levelno < self.module_levels.get(record.module, self.default_level):
+            return False
+
+        rate = self.debug_sampling.get(record.module, 1)
+        if rate > 1 and record.levelno <= logging.DEBUG:
+            line = (record.module, record.lineno)
+            count = self.counts.get(line, 0)
+            self.counts[line] = count + 1
+            return count % rate == 0
+        return True
+
+
+class _QueueHandler(logging.Handler):
+    """
+    Puts records on a queue, to be written by the listener in the parent process. The message is
+    formatted here, so records can be pickled
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+def _listen(queue, handlers):
+    """
+    Helper, runs in the listener thread. Writes records from the queue until it gets None
+    """
+    while True:
+        record = queue.get()
+        if record is None:
+            return
+        for handler in handlers:
+            handler.handle(record)
+
+
+def _level(name):
+    return logging.getLevelName(name) if not isinstance(name, int) else name
+
+
+def setup_logging(path=None, level=None, module_levels=None, debug_sampling=None, console=True):
+    """
+    Sets up logging for a run. Should be called once, in the parent process, before any
+    worker process is started
+    :param path: log file. Defaults to log_path
+    :param level: default level. Defaults to log_level
+    :param module_levels: dict mapping modules to levels. Defaults to log_module_levels
+    :param debug_sampling: dict mapping modules to sampling rates. Defaults to log_debug_sampling
+    :param console: also write to the console
+    :return:
+    """
+    path = log_path if path is None else path
+    default_level = _level(log_level if level is None else level)
+    module_levels = dict((module, _level(l)) for module, l in
+                         (log_module_levels if module_levels is None else module_levels).items())
+    debug_sampling = log_debug_sampling if debug_sampling is None else debug_sampling
+
+    stop_logging()
+
+    formatter = logging.Formatter(log_fmt)
+    handlers = [logging.FileHandler(path)]
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # forked workers inherit the queue. A queue of the fork context can't be given to workers
+    # started by a forkserver, so it's created in the spawn context where there is one
+    if hasattr(multiprocessing, 'get_context'):
+        queue = multiprocessing.get_context('spawn').Queue()
+    else:
+        queue = multiprocessing.Queue()
+    thread = threading.Thread(target=_listen, args=(queue, handlers), name='logs')
+    thread.daemon = True
+    thread.start()
+    _listener.update({'queue': queue, 'thread': thread, 'handlers': handlers})
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for log_filter in list(logger.filters):
+        logger.removeFilter(log_filter)
+    logger.addHandler(_QueueHandler(queue))
+    logger.addFilter(_ModuleFilter(default_level, module_levels, debug_sampling))
+    # records below all the configured levels aren't even created
+    logger.setLevel(min([default_level] + list(module_levels.values())))
+    logger.propagate = False
+
+
+def worker_logging():
+    """
+    The logging setup of this process, for setup_worker_logging() in workers that are not forked
+    from it. Pass it to the worker when starting it
+    :return: dict with the queue, the filters and the level, or None if setup_logging() was not called
+    """
+    if len(_listener) == 0:
+        return None
+    return {'queue': _listener['queue'], 'filters': list(logger.filters), 'level': logger.level}
+
+
+def setup_worker_logging(setup):
+    """
+    Sets up logging in a worker process, to put records on the queue of the parent
+    :param setup: as returned by worker_logging() in the parent. If None, logging is not changed
+    :return:
+    """
+    if setup is None:
+        return
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for log_filter in list(logger.filters):
+        logger.removeFilter(log_filter)
+    logger.addHandler(_QueueHandler(setup['queue']))
+    for log_filter in setup['filters']:
+        logger.addFilter(log_filter)
+    logger.setLevel(setup['level'])
+    logger.propagate = False
+
+
+def stop_logging():
+    """
+    Writes the records that are still in the queue, and stops the listener
+    """
+    if len(_listener) == 0:
+        return
+    _listener['queue'].put(None)
+    _listener['thread'].join()
+    for handler in _listener['handlers']:
+        handler.close()
+    _listener.clear()
+
+
+def log_summary(stage, seconds, **fields):
+    """
+    Logs a structured summary of a stage, as a single JSON line (prefixed with 'Summary: ')
+    :param stage: stage name
+    :param seconds: how long the stage took
+    :param fields: other values to include (must be JSON serializable)
+    :return:
+    """
+    summary = dict(fields)
+    summary['stage'] = stage
+    summary['seconds'] = round(seconds, 3)
+    logger.info("Summary: %s", json.dumps(summary, sort_keys=True))
@@ -4,6 +4,17 @@
 # Usage:
 #   Run the file with arguments 'download', 'process', or 'clean'
 #
+#   run [stage ...] [--dry-run] [--force]:
+#     - Brings the given stages (default: all but download) up to date, with
+#         the stages they depend on. Stages whose outputs are fresh are
+#         skipped, and independent stages run concurrently. See pipeline.py
+#         for the stages: group, process, clean, analysis_comply,
+#         analysis_metadata, analysis_connections, analysis_colocation,
+#         surveys
+#     - With --dry-run, only prints what would run
+#     - With --force, runs the given stages even if they are fresh
+#     - With --resume, stages continue from their last committed unit
+#
 #   download:
 #     - Downloads badgepi files in 'pi_range' for dates 'dates_to_download'
 #         to directory data/raw
@@ -11,24 +22,68 @@
 #   group:
 #     - Rearranges the just-downloaded raw data (gzipped) into hourly files in
 #         directory data/raw/proximity
+#     - Writes the packet counts of each hub in each hour to
+#         data/interim/hub_packets.h5
 #
 #   process:
 #     - Reads in the (gzipped) downloaded data
 #     - Processes these into a bunch of dataframes for analysis, including
 #         member to member, member to beacon, 5 closest beacons, etc.
 #     - Writes all these dataframes to data/interim/data_dirty.h5 (overwrites)
+#     - With --resume, keeps data_dirty.h5 and only processes hourly files that
+#         were not committed yet
 #
 #   clean:
 #     - Reads in data from data_dirty.h5
 #     - Runs the cleaning code based on members metadata provided, removing
 #         non-participants and data points outside project time slice
 #     - Writes m2m, m2b, and m5cb to data/interim/data_cleaned.h5 (appends)
+#     - With --resume, keeps data_cleaned.h5 and only cleans days that were not
+#         committed yet
+#
+#   analysis:
+#     - Creates the compliance, metadata and connection tables in
+#         data/interim/analysis.h5 (overwrites), including a daily summary of
+#         the compliance of each member (proximity/member_comply_daily)
+#     - With --incremental, keeps analysis.h5, analyzes only days that were not
+#         analyzed yet, and updates the connection tables with new or changed days
+#     - With --resume, keeps analysis.h5 and continues the compliance analysis
+#         from the last committed day
+#     - When done, publishes analysis.h5 and the graphs as a new snapshot in
+#         data/interim/analysis_snapshots, which notebooks read (see
+#         snapshots.py). 'run' does the same when it updates analysis.h5
+#
+#   publish:
+#     - Publishes the current analysis.h5 and graphs as a new snapshot
+#
+#   stream [--replay <dir>] [--speed <factor>]:
+#     - Tails the hub files in data/raw/hub_data/live as they grow, and emits
+#         compliance and per-pair minutes to data/interim/stream.h5 as time
+#         bins complete. Closed hours are written to data_dirty.h5 and
+#         data_cleaned.h5. See stream.py
+#     - With --replay, replays the hub files in <dir> into the live directory
+#         at <factor> times their pace (default 60), and stops when done
+#
+#   preview [stage ...]:
+#     - Needs BADGES_PREVIEW set to 'badges', 'days' or 'hours' (see config.py)
+#     - Brings the given stages (default: analysis_comply) up to date on a
+#         deterministic sample of the data, in data/interim/preview_<sample>
+#     - Prints the totals a full run would produce, estimated from the sample,
+#         with confidence intervals. See preview.py
+#
+#   surveys:
+#     - Cleans the daily and entry surveys in data/raw/surveys/surveys_anon.h5
+#         (translates answers to numbers, assigns each daily answer to its
+#         effective day, scores TIPI traits)
+#     - Writes them to data/interim/surveys_clean.h5. Needs the members table
+#         created by analysis
 #
 # Assumed directory structure for /data:
 # data
 # |-- external
 # |-- interim
 # |   |-- analysis.h5
+# |   |-- analysis_snapshots
 # |   |-- data_dirty.h5
 # |   |-- analysis.h5
 # |   `-- proximity
@@ -46,48 +101,143 @@
 
 from __future__ import absolute_import, division, print_function
 
+import glob
 import os
 import sys
 import time
-from multiprocessing import Pool, Queue
+from multiprocessing import Process
 
 from config import *
+from logs import log_summary, setup_logging, stop_logging
 
-from clean import clean_up_data
-from download import download_data
-from process import group_by_hour, process_proximity
-from analysis import analyze_data
+# The modules of the stages are imported by the verbs that use them, so verbs start without
+# loading what they don't need (e.g. - help and download don't import pandas). See
+# benchmark_startup.py
 
-def main():
+def _run_stage(stage, func, *args, **kwargs):
+    """
+    Runs a stage and logs its summary
+    """
+    start_time = time.time()
+    result = func(*args, **kwargs)
+    log_summary(stage, time.time() - start_time, argv=sys.argv[1:])
+    return result
+
+
+def _stream():
+    """
+    Runs the streaming mode. With --replay, replays hub files while streaming, and stops when
+    the replay is done
+    """
+    from stream import run_stream
+    from synthetic import replay_hub_files
+
+    if "--replay" not in sys.argv:
+        return run_stream()
+
+    replay_dir = sys.argv[sys.argv.index("--replay") + 1]
+    speed = float(sys.argv[sys.argv.index("--speed") + 1]) if "--speed" in sys.argv else 60.0
+    source_paths = sorted(glob.glob(os.path.join(replay_dir, os.path.basename(stream_hub_file_pattern))))
+    replay = Process(target=replay_hub_files, args=(source_paths, stream_hub_dir, speed))
+    replay.start()
+    try:
+        return run_stream(stop=lambda: not replay.is_alive())
+    finally:
+        replay.join()
+
+
+def _preview():
+    """
+    Runs the given stages on the preview sample, and prints the estimates of a full run
+    """
+    import pandas as pd
+    from pipeline import run_pipeline
+    from preview import preview_report
+
+    names = [arg for arg in sys.argv[2:] if not arg.startswith("--")] or ['analysis_comply']
+    run_pipeline(names, force="--force" in sys.argv)
+    estimates = preview_report()
+    print("\nPreview on a '{}' sample ({:.0%} of the units, seed {}). Totals of a full run, {:.0%} intervals:".format(
+        preview_sample, preview_fraction, preview_seed, preview_confidence))
+    with pd.option_context('display.width', 200, 'display.precision', 3):
+        print(estimates)
+
+
+def _main():
     start_time = time.time()
+    if len(sys.argv) > 1 and sys.argv[1] == "run":
+        from pipeline import run_pipeline
+        names = [arg for arg in sys.argv[2:] if not arg.startswith("--")]
+        run_pipeline(names, force="--force" in sys.argv, dry_run="--dry-run" in sys.argv,
+                     resume="--resume" in sys.argv)
+        print("Total runtime: %s seconds" % (time.time() - start_time))
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == "preview":
+        if preview_sample is None:
+            print("Set BADGES_PREVIEW to 'badges', 'days' or 'hours' to run a preview.")
+            return
+        _run_stage("preview", _preview)
+        print("Total runtime: %s seconds" % (time.time() - start_time))
+        return
+
     if "download" in sys.argv:
         # download raw data from server
-        raw_filenames = download_data(dates_to_download)
+        from download import download_data
+        raw_filenames = _run_stage("download", download_data, dates_to_download)
         print("\n\nfinished downloading data, ending. please gzip the data, then run group, process, and clean.")
         return
 
     if "group" in sys.argv:
         # Group available data by day
-        group_by_hour()
+        from process import group_by_hour
+        _run_stage("group", group_by_hour)
         print("\n\nfinished grouping data, ending. Next, run process, and clean.")
         return
 
     if "process" in sys.argv:
-        process_proximity()
+        from process import process_proximity
+        _run_stage("process", process_proximity, resume="--resume" in sys.argv)
 
         print('completed processing!')
 
     if "clean" in sys.argv:
         # clean up the data
-        clean_up_data()
+        from clean import clean_up_data
+        _run_stage("clean", clean_up_data, resume="--resume" in sys.argv)
 
     if "analysis" in sys.argv:
-        # create the analysis dataframes
-        analyze_data()
+        # create the analysis dataframes. With --incremental, only new or changed days are analyzed
+        from analysis import analyze_data
+        _run_stage("analysis", analyze_data, incremental="--incremental" in sys.argv,
+                   resume="--resume" in sys.argv)
+
+    if "publish" in sys.argv:
+        # make the analysis store available to notebooks
+        from snapshots import publish_analysis_snapshot
+        print(_run_stage("publish", publish_analysis_snapshot))
+
+    if "stream" in sys.argv:
+        # follow the hub files during a deployment
+        _run_stage("stream", _stream)
+        return
+
+    if "surveys" in sys.argv:
+        # clean the survey data
+        from surveys import clean_surveys
+        _run_stage("surveys", clean_surveys)
 
     if "help" in sys.argv or len(sys.argv) == 1:
-        print("Please use arguments 'download', 'group', 'process', or 'clean'.")
+        print("Please use arguments 'download', 'group', 'process', 'clean', 'analysis', 'surveys', 'publish', 'stream', 'preview' or 'run'.")
     print("Total runtime: %s seconds" % (time.time() - start_time))
 
+
+def main():
+    setup_logging()
+    try:
+        _main()
+    finally:
+        stop_logging()
+
 if __name__ == '__main__':
     main()
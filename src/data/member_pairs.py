@@ -0,0 +1,166 @@
+################################################################################
+#                              member_pairs.py
+#
+# Pairs of members (or companies) as int64 keys. Labels are mapped to dense
+# integer codes once, using a code book (the sorted unique labels, so codes
+# are ordered like the labels), and a pair (a, b) is encoded as
+#
+#   key = code(a) * len(code book) + code(b)
+#
+# A canonical key puts the smaller code first, so a->b and b->a get the same
+# key. Grouping, mirroring, deduplicating both directions and looking up the
+# company of each side are then done on integer arrays, and labels are put
+# back once, on the reduced results.
+#
+# Also creates the member to member table from the member to badge records,
+# like openbadge_analysis.preprocessing.member_to_member_proximity(), which
+# process used before (see process_local_m2m in config.py, and
+# benchmark_m2m.py). To check the stores end to end:
+#   python shadow.py --stages group,process,clean,analysis_comply --reference \
+#     member_pairs.member_to_member_proximity=openbadge_analysis.preprocessing.member_to_member_proximity
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pandas as pd
+from config import *
+
+
+def member_code_book(*labels):
+    """
+    Creates a code book: the sorted unique labels of the given arrays. The code of a label is its
+    position in the code book. Missing values are left out
+    :param labels: arrays of labels (e.g. - the member1 and member2 columns)
+    :return: pd.Index
+    """
+    values = pd.unique(np.concatenate([np.asarray(l, dtype=object) for l in labels]))
+    return pd.Index(values[pd.notnull(values)]).sort_values()
+
+
+def member_codes(code_book, labels):
+    """
+    Codes of labels
+    :param code_book: as returned by member_code_book()
+    :param labels: array of labels
+    :return: int64 array, -1 for labels that are not in the code book (and missing values)
+    """
+    return code_book.get_indexer(labels).astype(np.int64)
+
+
+def pair_keys(codes1, codes2, size, canonical=True):
+    """
+    Encodes pairs of codes as int64 keys
+    :param codes1: codes of side 1
+    :param codes2: codes of side 2
+    :param size: size of the code book
+    :param canonical: if True, the smaller code is put first, so both directions of a pair get
+        the same key
+    :return: int64 array, -1 for pairs with a side that has no code
+    """
+    codes1 = np.asarray(codes1, dtype=np.int64)
+    codes2 = np.asarray(codes2, dtype=np.int64)
+    if canonical:
+        codes1, codes2 = np.minimum(codes1, codes2), np.maximum(codes1, codes2)
+    keys = codes1 * max(size, 1) + codes2
+    keys[(codes1 < 0) | (codes2 < 0)] = -1
+    return keys
+
+
+def pair_codes(keys, size):
+    """
+    Decodes pair keys
+    :return: codes of side 1, and codes of side 2
+    """
+    return np.divmod(np.asarray(keys, dtype=np.int64), max(size, 1))
+
+
+def swap_pairs(keys, size):
+    """
+    Keys of the pairs in the other direction (b->a for a->b). Keys of -1 are kept
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    codes1, codes2 = pair_codes(keys, size)
+    return np.where(keys >= 0, codes2 * max(size, 1) + codes1, -1)
+
+
+def encode_pairs(labels1, labels2, canonical=False):
+    """
+    Encodes pairs of labels, with a code book of the labels of both sides
+    :param labels1: labels of side 1 (e.g. - the member1 column)
+    :param labels2: labels of side 2
+    :param canonical: see pair_keys()
+    :return: code book, and array of keys (-1 for pairs with a missing side)
+    """
+    code_book = member_code_book(labels1, labels2)
+    keys = pair_keys(member_codes(code_book, labels1), member_codes(code_book, labels2), len(code_book), canonical)
+    return code_book, keys
+
+
+def decode_pairs(code_book, keys):
+    """
+    Labels of the sides of pair keys
+    :param code_book: the code book the keys were encoded with
+    :param keys: array of keys, without -1
+    :return: labels of side 1, and labels of side 2
+    """
+    codes1, codes2 = pair_codes(keys, len(code_book))
+    return code_book.take(codes1), code_book.take(codes2)
+
+
+def code_book_lookup(code_book, mapping):
+    """
+    Looks up a value for each code (e.g. - the company of each member)
+    :param code_book: as returned by member_code_book()
+    :param mapping: series indexed by label (e.g. - members['company'])
+    :return: array of values, aligned with the code book. Missing values for labels that are
+        not in the mapping
+    """
+    return mapping.reindex(code_book).values
+
+
+def member_to_member_proximity(m2badge, idmap):
+    """
+    Creates the member to member table from the member to badge records. Observed badges are
+    mapped to members (records of beacons are dropped), and the records of a pair in a time bin,
+    from both directions, are reduced to a single record
+    :param m2badge: member to badge records, indexed by datetime, member and observed_id, with rssi
+        and count columns
+    :param idmap: series mapping badge ids to members, as returned by id_to_member_mapping()
+    :return: table indexed by datetime, member1 and member2 (member1 < member2), with the
+        rssi_weighted_mean (weighted by count), rssi_max, rssi_min and rssi_count (number of
+        records) columns
+    """
+    columns = ['rssi_weighted_mean', 'rssi_max', 'rssi_min', 'rssi_count']
+    df = m2badge.reset_index()
+    observed = idmap.reindex(df['observed_id'].values).values
+    code_book, keys = encode_pairs(df['member'].values, observed, canonical=True)
+
+    # records of beacons have no member, and a member observing its own badge id is not a pair
+    codes1, codes2 = pair_codes(keys, len(code_book))
+    valid = (keys >= 0) & (codes1 != codes2)
+    times = df['datetime'].values.view('int64')[valid]
+    keys = keys[valid]
+    rssi = df['rssi'].values.astype(np.float64)[valid]
+    count = df['count'].values.astype(np.float64)[valid]
+    if len(keys) == 0:
+        empty = pd.DataFrame(columns=['datetime', 'member1', 'member2'] + columns)
+        return empty.set_index(['datetime', 'member1', 'member2'])
+
+    # records of each time bin and pair are contiguous
+    order = np.lexsort((keys, times))
+    times, keys, rssi, count = times[order], keys[order], rssi[order], count[order]
+    starts = np.flatnonzero(np.append(True, (times[1:] != times[:-1]) | (keys[1:] != keys[:-1])))
+
+    m2m = pd.DataFrame({
+        'rssi_weighted_mean': np.add.reduceat(rssi * count, starts) / np.add.reduceat(count, starts),
+        'rssi_max': np.maximum.reduceat(rssi, starts),
+        'rssi_min': np.minimum.reduceat(rssi, starts),
+        'rssi_count': np.diff(np.append(starts, len(keys))),
+    }, columns=columns)
+    datetimes = pd.DatetimeIndex(times[starts])
+    if df['datetime'].dt.tz is not None:
+        datetimes = datetimes.tz_localize('UTC').tz_convert(df['datetime'].dt.tz)
+    m2m['datetime'] = datetimes
+    m2m['member1'], m2m['member2'] = decode_pairs(code_book, keys[starts])
+    return m2m.set_index(['datetime', 'member1', 'member2'])
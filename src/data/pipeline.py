@@ -0,0 +1,322 @@
+################################################################################
+#                               pipeline.py
+#
+# Runs the stages of make_dataset as a dependency graph. Each stage declares
+# the stages it depends on, the files it reads, the files and store keys it
+# writes, and the config values it uses. A stage is skipped when its outputs
+# exist and nothing it depends on changed since its last run. Stages that
+# don't depend on each other run concurrently (e.g. - analysis_metadata runs
+# alongside analysis_comply).
+#
+# The state of the last run of each stage is kept in pipeline_state_path.
+# When a run updates the analysis store and all its stages succeed, the store
+# is published as a new snapshot (see snapshots.py).
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import glob
+import hashlib
+import json
+import shutil
+import time
+from collections import namedtuple, OrderedDict
+from multiprocessing import Process
+
+import pandas as pd
+from config import *
+from logs import log_summary
+
+from clean import clean_up_data
+from process import group_by_hour, process_proximity
+from analysis_comply import analysis_comply, analysis_comply_store_keys
+from analysis_metadata import analysis_metadata
+from analysis_connections import analysis_connections
+from analysis_colocation import analysis_colocation, analysis_colocation_store_key
+from surveys import clean_surveys
+from snapshots import publish_analysis_snapshot
+
+# name - stage name, as used on the command line
+# func - function that runs the stage (module level, so it can run in a separate process)
+# requires - names of the stages it depends on
+# inputs - files (or glob patterns) it reads, that are not created by other stages
+# outputs - files, or (store path, key) pairs, that it writes
+# config - names of the config values it uses
+# resumable - whether func accepts resume=True, to continue from its last committed unit
+Stage = namedtuple('Stage', ['name', 'func', 'requires', 'inputs', 'outputs', 'config', 'resumable'])
+
+
+def _group():
+    """
+    Helper, runs group_by_hour() from scratch. Hourly files are appended to, so files from
+    previous runs must be removed first
+    """
+    for filepath in glob.glob(os.path.join(proximity_data_dir, '*.gz')):
+        os.remove(filepath)
+    shutil.rmtree(proximity_chunks_dir, ignore_errors=True)
+    group_by_hour()
+
+
+pipeline_stages = [
+    Stage('group', _group, [],
+          [raw_data_proximity_filename_pattern],
+          [os.path.join(proximity_data_dir, '*.gz'), (hub_packets_store_path, pi_hour_packets_store_key)],
+          ['group_write_binary_chunks'], False),
+    Stage('process', process_proximity, ['group'],
+          [members_metadata_path, beacons_metadata_path],
+          [(dirty_store_path, 'proximity/member_to_member'),
+           (dirty_store_path, 'proximity/member_to_beacon'),
+           (dirty_store_path, 'proximity/member_to_badge')],
+          ['time_bins_size', 'time_zone', 'log_version', 'hdf_storage_profiles', 'hdf_storage_profile_keys',
+           'rssi_smooth_window_size', 'rssi_smooth_min_samples', 'time_bins_max_gap_size',
+           'process_local_smoothing', 'process_local_m2m'], True),
+    Stage('clean', clean_up_data, ['process'],
+          [members_metadata_path],
+          [(clean_store_path, 'proximity/member_to_member'),
+           (clean_store_path, 'proximity/member_to_beacon'),
+           (clean_store_path, 'proximity/member_5_closest_beacons')],
+          ['period1_start', 'period1_end', 'period2_start', 'period2_end', 'time_zone'], True),
+    Stage('analysis_comply', analysis_comply, ['clean'],
+          [members_metadata_path, beacons_metadata_path],
+          [(analysis_store_path, key) for key in analysis_comply_store_keys],
+          ['project_time_slices', 'time_bins_size'], True),
+    Stage('analysis_metadata', analysis_metadata, [],
+          [members_metadata_path],
+          [(analysis_store_path, 'metadata/members')],
+          ['time_zone'], False),
+    Stage('analysis_connections', analysis_connections, ['analysis_comply', 'analysis_metadata'],
+          [],
+          [(analysis_store_path, 'proximity/connections_days')],
+          ['rssi_cutoffs', 'analysis_write_m2m_dbl', 'analysis_connections_base_freq',
+           'analysis_connections_freqs', 'analysis_connections_shifts', 'analysis_graphs_tables'], False),
+    Stage('analysis_colocation', analysis_colocation, ['analysis_comply'],
+          [],
+          [(analysis_store_path, analysis_colocation_store_key(max(analysis_colocation_rssi_cutoffs),
+                                                               analysis_colocation_freqs[0][1]))],
+          ['analysis_colocation_rssi_cutoffs', 'analysis_colocation_top_k', 'analysis_colocation_min_overlap',
+           'analysis_colocation_freqs', 'time_bins_size'], False),
+    Stage('surveys', clean_surveys, ['analysis_metadata'],
+          [surveys_anon_store_path],
+          [(surveys_clean_store_path, 'daily/daily_survey_data_clean'),
+           (surveys_clean_store_path, 'entry/participants_entry_survey_data_clean')],
+          ['surveys_effective_date_breakpoint_hour', 'period1_start', 'period1_end', 'period2_start',
+           'period2_end'], False),
+]
+
+if preview_sample is not None:
+    # Preview runs read the hourly files of the full run, and don't group them again. The sample
+    # settings are part of the process config, so changing them runs the preview again
+    pipeline_stages = [
+        stage._replace(requires=[name for name in stage.requires if name != 'group'],
+                       inputs=stage.inputs + [os.path.join(proximity_data_dir, '*.gz')],
+                       config=stage.config + ['preview_sample', 'preview_fraction', 'preview_seed'])
+        if stage.name == 'process' else stage
+        for stage in pipeline_stages if stage.name != 'group']
+
+
+def _stages_by_name():
+    return OrderedDict((stage.name, stage) for stage in pipeline_stages)
+
+
+def read_pipeline_state():
+    """
+    Reads the state of the last run of each stage
+    :return: dict mapping stage names to their state
+    """
+    try:
+        with open(pipeline_state_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_pipeline_state(state):
+    """
+    Helper, writes the pipeline state. Written to a temporary file first, so an interrupted
+    run doesn't leave a broken state file
+    """
+    directory = os.path.dirname(pipeline_state_path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_path = pipeline_state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, pipeline_state_path)
+
+
+def _inputs_signature(stage):
+    """
+    Helper, returns the name, size and modification time of all the input files of a stage
+    """
+    signature = []
+    for pattern in stage.inputs:
+        for path in sorted(glob.glob(pattern)):
+            file_stat = os.stat(path)
+            signature.append([path, file_stat.st_size, int(file_stat.st_mtime)])
+    return signature
+
+
+def _stage_signature(stage, state):
+    """
+    Helper, hashes everything a stage depends on: its config values, its input files, and the
+    runs of the stages it requires
+    """
+    config = [(name, repr(globals()[name])) for name in stage.config]
+    upstream = [(name, state.get(name, {}).get('run_id')) for name in stage.requires]
+    content = repr((config, _inputs_signature(stage), upstream))
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+
+def _missing_outputs(stage):
+    """
+    Helper, returns the outputs of a stage that don't exist
+    """
+    missing = []
+    for output in stage.outputs:
+        if isinstance(output, tuple):
+            path, key = output
+            if not os.path.exists(path):
+                missing.append(path + ':' + key)
+                continue
+            with pd.HDFStore(path, mode='r') as store:
+                if key not in store:
+                    missing.append(path + ':' + key)
+        elif len(glob.glob(output)) == 0:
+            missing.append(output)
+    return missing
+
+
+def _with_requirements(names):
+    """
+    Helper, returns the given stages and all the stages they depend on, in pipeline order
+    """
+    stages = _stages_by_name()
+    selected = set()
+    pending = list(names)
+    while len(pending) > 0:
+        name = pending.pop()
+        if name not in stages:
+            raise ValueError("Unknown stage: {}. Use one of {}".format(name, list(stages.keys())))
+        if name not in selected:
+            selected.add(name)
+            pending.extend(stages[name].requires)
+    return [stage for stage in pipeline_stages if stage.name in selected]
+
+
+def plan_pipeline(names=None, force=False):
+    """
+    Decides which stages need to run
+    :param names: stages to bring up to date (with the stages they depend on). Defaults to all
+    :param force: run the given stages even if they are fresh
+    :return: list of (stage, reason) pairs, in pipeline order. reason is None for fresh stages
+    """
+    if names is None or len(names) == 0:
+        names = [stage.name for stage in pipeline_stages]
+
+    state = read_pipeline_state()
+    will_run = set()
+    plan = []
+    for stage in _with_requirements(names):
+        stale_requirements = [name for name in stage.requires if name in will_run]
+        missing = _missing_outputs(stage)
+        if force and stage.name in names:
+            reason = 'forced'
+        elif stage.name not in state:
+            reason = 'never ran'
+        elif len(missing) > 0:
+            reason = 'missing outputs: ' + ', '.join(missing)
+        elif len(stale_requirements) > 0:
+            reason = 'requires ' + ', '.join(stale_requirements) + ', which will run'
+        elif state[stage.name]['signature'] != _stage_signature(stage, state):
+            reason = 'inputs, config or requirements changed'
+        else:
+            reason = None
+
+        if reason is not None:
+            will_run.add(stage.name)
+        plan.append((stage, reason))
+    return plan
+
+
+def print_plan(plan):
+    """
+    Prints what a plan would do
+    """
+    for stage, reason in plan:
+        if reason is None:
+            print("  skip  {:<22} (fresh)".format(stage.name))
+        else:
+            print("  run   {:<22} ({})".format(stage.name, reason))
+
+
+def run_pipeline(names=None, force=False, dry_run=False, max_concurrent=None, resume=False):
+    """
+    Brings the given stages up to date. Each stage runs in its own process, and stages whose
+    requirements are done run concurrently, up to max_concurrent at a time
+    :param names: stages to bring up to date (with the stages they depend on). Defaults to all
+    :param force: run the given stages even if they are fresh
+    :param dry_run: only print what would run
+    :param max_concurrent: maximal number of stages to run at once. Defaults to
+        pipeline_max_concurrent_stages
+    :param resume: stages that support it continue from their last committed unit, instead of
+        starting from scratch (e.g. - after a crash)
+    :return: names of the stages that ran
+    """
+    if max_concurrent is None:
+        max_concurrent = pipeline_max_concurrent_stages
+
+    plan = plan_pipeline(names, force)
+    print_plan(plan)
+    if dry_run:
+        return []
+
+    state = read_pipeline_state()
+    pending = [stage for stage, reason in plan if reason is not None]
+    reasons = dict((stage.name, reason) for stage, reason in plan)
+    running = {}
+    done = []
+    failed = []
+    while len(pending) > 0 or len(running) > 0:
+        # start stages that don't wait for anything
+        if len(failed) == 0:
+            for stage in list(pending):
+                if len(running) >= max_concurrent:
+                    break
+                waiting = [s for s in pending + list(running.keys()) if s.name in stage.requires]
+                if len(waiting) == 0:
+                    logger.info("Pipeline - starting {}".format(stage.name))
+                    kwargs = {'resume': True} if resume and stage.resumable else {}
+                    process = Process(target=stage.func, name=stage.name, kwargs=kwargs)
+                    process.start()
+                    running[stage] = (process, time.time())
+                    pending.remove(stage)
+        elif len(running) == 0:
+            break
+
+        time.sleep(1)
+        for stage, (process, start_time) in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del running[stage]
+            seconds = time.time() - start_time
+            if process.exitcode != 0:
+                logger.error("Pipeline - {} failed with exit code {}".format(stage.name, process.exitcode))
+                failed.append(stage.name)
+                continue
+
+            log_summary(stage.name, seconds, resume=resume and stage.resumable, reason=reasons[stage.name])
+            state[stage.name] = {'run_id': '{:.6f}'.format(time.time()),
+                                 'signature': _stage_signature(stage, state),
+                                 'seconds': seconds}
+            _write_pipeline_state(state)
+            done.append(stage.name)
+
+    if len(failed) > 0:
+        raise RuntimeError("Pipeline stages failed: {}. Not started: {}".format(
+            ', '.join(failed), ', '.join(stage.name for stage in pending)))
+
+    stages = _stages_by_name()
+    if any(isinstance(output, tuple) and output[0] == analysis_store_path
+           for name in done for output in stages[name].outputs):
+        publish_analysis_snapshot()
+    return done
@@ -0,0 +1,251 @@
+################################################################################
+#                               preview.py
+#
+# Usage:
+#   BADGES_PREVIEW=<badges|days|hours> python make_dataset.py preview [stage ...]
+#
+# Preview mode, for trying settings (rssi_cutoffs, smoothing, thresholds) in
+# minutes instead of running the whole dataset. When BADGES_PREVIEW is set (see
+# config.py), process only reads a deterministic sample of the data, and all
+# the stores are written to a separate preview directory, so the full stores
+# are never touched. The sample is made of units: participants ('badges'),
+# days ('days', stratified by weekdays and weekends) or hourly files ('hours',
+# stratified by hour of day). Units are selected by a hash of their name and
+# preview_seed, so the same settings always select the same units, and growing
+# preview_fraction keeps the units that were already selected.
+#
+# The preview verb brings the stages up to date in the preview stores (by
+# default, up to analysis_comply), and reports estimates of the totals a full
+# run would produce: complied minutes, and pair minutes at each rssi cutoff.
+# Sample totals are scaled up by the sampling design, and reported with
+# confidence intervals (preview_confidence). Day and hour samples use the
+# stratified expansion estimator, and badge samples use a jackknife over the
+# selected participants (pair totals scale with the number of pairs, not the
+# number of participants). Tables in the preview stores are not scaled.
+#
+# With a badge sample, the member to badge table keeps the observations of all
+# the badges, since compliance marks a badge as on the board by its max RSSI
+# to the other member badges, and dropping most of its neighbours would make
+# parked badges look worn. The sample is applied to the outputs: member to
+# beacon tables keep the selected participants, and member to member tables
+# keep the pairs where both are selected. The estimates assume that the
+# metrics of a selected participant (or pair) are the same as in a full run,
+# and that participants are a simple random sample (the hash ranks).
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import glob
+import hashlib
+import math
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from config import *
+from storage import hdf_storage_kwargs, store_lock
+
+# Kinds of samples, see preview_sample in config.py
+preview_samples = ['badges', 'days', 'hours']
+
+# Estimates written by preview_report(), in the (preview) analysis store
+preview_estimates_store_key = 'preview/estimates'
+
+
+def _unit_rank(unit):
+    """
+    Helper, deterministic pseudo-random number in [0, 1) for a unit, that only depends on the
+    unit name and preview_seed
+    """
+    digest = hashlib.md5('{}:{}'.format(preview_seed, unit).encode('utf-8')).hexdigest()
+    return int(digest[:15], 16) / 16**15
+
+
+def _hourly_file_names():
+    """
+    Helper, names of the hourly files (e.g. - 20180612-10.gz)
+    """
+    return sorted(os.path.basename(f) for f in glob.glob(os.path.join(proximity_data_dir, '*.gz')))
+
+
+def preview_plan():
+    """
+    The units of the preview sample, and the ones that are selected. Within each stratum, the
+    preview_fraction of the units with the lowest ranks are selected (at least two, so the
+    variance can be estimated)
+    :return: dataframe indexed by unit, with stratum and selected columns
+    """
+    if preview_sample == 'badges':
+        members_metadata = pd.read_csv(members_metadata_path)
+        units = members_metadata[members_metadata['member_id'].notnull() &
+                                 (members_metadata['participates'] == 1)]['member'].astype(str).unique()
+        strata = ['all'] * len(units)
+    elif preview_sample == 'days':
+        units = sorted(set(name[:8] for name in _hourly_file_names()))
+        strata = ['weekend' if pd.Timestamp(unit).dayofweek >= 5 else 'weekday' for unit in units]
+    elif preview_sample == 'hours':
+        units = _hourly_file_names()
+        strata = [unit[9:11] for unit in units]
+    else:
+        raise ValueError("Unknown preview sample: {}. Use one of {}".format(preview_sample, preview_samples))
+
+    plan = pd.DataFrame({'stratum': strata, 'rank': [_unit_rank(unit) for unit in units]},
+                        index=pd.Index(units, name='unit'))
+    plan['selected'] = False
+    for stratum, group in plan.groupby('stratum'):
+        count = min(len(group), max(2, int(math.ceil(len(group) * preview_fraction))))
+        plan.loc[group.sort_values('rank').index[:count], 'selected'] = True
+    return plan.drop('rank', axis=1).sort_index()
+
+
+def _selected_units():
+    plan = preview_plan()
+    return set(plan.index[plan.selected])
+
+
+def preview_hourly_files(filepaths):
+    """
+    Selects the hourly files that process reads. In preview mode with day or hour samples, only the
+    files of the selected units. Otherwise, all of them
+    :param filepaths: paths of hourly files
+    :return: list of paths
+    """
+    if preview_sample is None or preview_sample == 'badges':
+        return filepaths
+    selected = _selected_units()
+    unit_length = 8 if preview_sample == 'days' else None
+    selected_filepaths = [f for f in filepaths if os.path.basename(f)[:unit_length] in selected]
+    logger.info("Preview - {} of {} hourly files".format(len(selected_filepaths), len(filepaths)))
+    return selected_filepaths
+
+
+def preview_filter_members(table, *levels):
+    """
+    In preview mode with a badge sample, keeps the records of the selected participants: the ones
+    where the members of all the given index levels are selected. Otherwise, returns table as is.
+    Only applied to outputs, compliance needs the observations of all the badges (see the header)
+    :param table: table with member index levels
+    :param levels: names of the member levels (e.g. - member, or member1 and member2)
+    :return:
+    """
+    if preview_sample != 'badges':
+        return table
+    selected = _selected_units()
+    keep = np.ones(len(table), dtype=bool)
+    for level in levels:
+        keep &= table.index.get_level_values(level).astype(str).isin(selected)
+    return table[keep]
+
+
+def _preview_records():
+    """
+    Helper, reads the compliance and m2m_comply tables of the preview, with a column per metric,
+    in minutes: complied_minutes for compliance, and pair_minutes_<cutoff> for m2m
+    :return: compliance and m2m tables, with datetime as a column
+    """
+    bin_minutes = pd.Timedelta(time_bins_size).total_seconds() / 60
+    comply = pd.read_hdf(analysis_store_path, 'proximity/member_comply').to_frame('comply').reset_index()
+    comply['complied_minutes'] = comply['comply'].astype(float) * bin_minutes
+
+    m2m = pd.read_hdf(analysis_store_path, 'proximity/member_to_member').reset_index()
+    for rssi_cutoff in sorted(rssi_cutoffs, reverse=True):
+        m2m['pair_minutes_' + str(abs(rssi_cutoff))] = (m2m['rssi_max'] >= rssi_cutoff).astype(float) * bin_minutes
+    return comply, m2m
+
+
+def _estimates_table(rows, plan):
+    table = pd.DataFrame(rows, columns=['metric', 'sample_total', 'estimate', 'std_error']).set_index('metric')
+    z = stats.norm.ppf(0.5 + preview_confidence / 2)
+    table['ci_low'] = table['estimate'] - z * table['std_error']
+    table['ci_high'] = table['estimate'] + z * table['std_error']
+    table['relative_error'] = (z * table['std_error'] / table['estimate'].abs()).replace(np.inf, np.nan)
+    table['units_sampled'] = plan.selected.sum()
+    table['units_total'] = len(plan)
+    return table
+
+
+def _stratified_estimates(plan, comply, m2m):
+    """
+    Helper, estimates for day and hour samples. Each selected unit is a cluster of records, and
+    the total is estimated with the stratified expansion estimator, with finite population
+    correction
+    """
+    unit_format = "%Y%m%d" if preview_sample == 'days' else "%Y%m%d-%H.gz"
+    unit_metrics = []
+    for table in [comply, m2m]:
+        metrics = [c for c in table.columns if c == 'complied_minutes' or c.startswith('pair_minutes_')]
+        units = table['datetime'].dt.strftime(unit_format)
+        unit_metrics.append(table[metrics].groupby(units.values).sum())
+    selected = plan.index[plan.selected]
+    # selected units without records count as zeros
+    unit_metrics = pd.concat(unit_metrics, axis=1).reindex(selected).fillna(0)
+
+    rows = []
+    for metric in unit_metrics.columns:
+        estimate = 0.0
+        variance = 0.0
+        for stratum, group in plan.groupby('stratum'):
+            values = unit_metrics.loc[group.index[group.selected], metric]
+            population = len(group)
+            estimate += population * values.mean()
+            if len(values) > 1:
+                variance += population**2 * (1 - len(values) / population) * values.var() / len(values)
+        rows.append((metric, unit_metrics[metric].sum(), estimate, math.sqrt(variance)))
+    return _estimates_table(rows, plan)
+
+
+def _badge_estimates(plan, comply, m2m):
+    """
+    Helper, estimates for badge samples. Member totals scale with N/n, and pair totals with the
+    number of pairs, N(N-1)/(n(n-1)). Standard errors come from a delete-one jackknife over the
+    selected participants
+    """
+    selected = list(plan.index[plan.selected])
+    population = len(plan)
+    n = len(selected)
+    rows = []
+
+    member_totals = comply.groupby(comply['member'].astype(str))['complied_minutes'].sum().reindex(selected).fillna(0)
+    scale = population / n
+    replicates = (member_totals.sum() - member_totals) * population / (n - 1)
+    rows.append(('complied_minutes', member_totals.sum(), member_totals.sum() * scale, _jackknife_se(replicates)))
+
+    scale = population * (population - 1) / (n * (n - 1))
+    replicate_scale = population * (population - 1) / ((n - 1) * (n - 2)) if n > 2 else np.nan
+    for metric in [c for c in m2m.columns if c.startswith('pair_minutes_')]:
+        total = m2m[metric].sum()
+        # minutes of the pairs each participant is part of
+        involved = m2m.groupby(m2m['member1'].astype(str))[metric].sum().reindex(selected).fillna(0) + \
+            m2m.groupby(m2m['member2'].astype(str))[metric].sum().reindex(selected).fillna(0)
+        replicates = (total - involved) * replicate_scale
+        rows.append((metric, total, total * scale, _jackknife_se(replicates)))
+    return _estimates_table(rows, plan)
+
+
+def _jackknife_se(replicates):
+    """
+    Helper, jackknife standard error from delete-one replicates
+    """
+    n = len(replicates)
+    if n < 2:
+        return np.nan
+    return math.sqrt((n - 1) / n * ((replicates - replicates.mean())**2).sum())
+
+
+def preview_report():
+    """
+    Estimates the totals of a full run from the preview stores, and writes them to the analysis
+    store of the preview
+    :return: table indexed by metric, with the sample total, the estimate, its standard error and
+        confidence interval, and the relative error (half width of the interval over the estimate)
+    """
+    plan = preview_plan()
+    comply, m2m = _preview_records()
+    if preview_sample == 'badges':
+        estimates = _badge_estimates(plan, comply, m2m)
+    else:
+        estimates = _stratified_estimates(plan, comply, m2m)
+
+    with store_lock(analysis_store_path):
+        estimates.to_hdf(analysis_store_path, preview_estimates_store_key, mode="a", format="table",
+                         append=False, **hdf_storage_kwargs(preview_estimates_store_key))
+    return estimates
@@ -5,28 +5,41 @@ import time
 import glob
 import gzip
 import os
-from multiprocessing import Pool
+import re
 
+import numpy as np
 import pandas as pd
 from config import *
+from storage import commit_unit, hdf_storage_kwargs, merge_units, recover_checkpoint, reset_checkpoint, store_lock
+from workers import adaptive_imap
+from preview import preview_filter_members, preview_hourly_files
+import member_pairs
+import proximity_smooth
 
 import openbadge_analysis as ob
 import openbadge_analysis.preprocessing
 
 
-def group_by_hour():
+def group_by_hour(binary_chunks=None):
     """
-    Combines the downloaded raw data into hourly files
+    Combines the downloaded raw data into hourly files. Also counts the packets of each hub
+    (badgepi) in each hour, and writes the counts to hub_packets_store_path
+    :param binary_chunks: also write the hourly data as binary columnar chunks, that process can
+        read without parsing JSON. Defaults to group_write_binary_chunks
     """
+    if binary_chunks is None:
+        binary_chunks = group_write_binary_chunks
+
     # create target dir if doesn't exist
     if not os.path.exists(proximity_data_dir):
         os.makedirs(proximity_data_dir)
 
-    # iterate over files in raw directory
+    # iterate over files in raw directory. Sorted, so hourly files and chunks have the same order
     i = 0
-    proximity_filenames_gzipped = glob.glob(raw_data_proximity_filename_pattern)
+    proximity_filenames_gzipped = sorted(glob.glob(raw_data_proximity_filename_pattern))
     count = len(proximity_filenames_gzipped)
     proximity_split_filenames = set()
+    packet_counts = {}
     for filepath in proximity_filenames_gzipped:
         i += 1
         filename = os.path.basename(filepath)      
@@ -40,12 +53,38 @@ def group_by_hour():
         with gzip.open(filepath, 'r') as f:
             logger.info("Splitting file {}  ({}/{})".format(filename[-35:], i, count))
             if filename.find('proximity') >= 0 and filename.find('badgepi') >= 0:
-                names = _split_raw_data_by_hour(f, proximity_data_dir, 'proximity')
+                chunks_target = proximity_chunks_dir if binary_chunks else None
+                pi = int(re.search(r'badgepi-(\d+)', filename).group(1))
+                names = _split_raw_data_by_hour(f, proximity_data_dir, 'proximity',
+                                                chunks_target=chunks_target, chunk_name=filename,
+                                                packet_counts=packet_counts.setdefault(pi, {}))
                 proximity_split_filenames |= names
+
+    _write_pi_hour_packets(packet_counts)
     return proximity_split_filenames
 
 
-def _split_raw_data_by_hour(fileobject, target, kind):
+def _write_pi_hour_packets(packet_counts):
+    """
+    Helper, writes the packet counts collected by _split_raw_data_by_hour(), replacing the previous
+    ones. Hours are in the local time of the hourly file names
+    :param packet_counts: dict mapping pi numbers to the packet counts of their hours
+    """
+    rows = [(datetime.datetime.strptime(hour.split('.')[0], "%Y%m%d-%H"), pi, packets, observations, len(badges))
+            for pi, hours in packet_counts.items() for hour, (packets, observations, badges) in hours.items()]
+    table = pd.DataFrame(rows, columns=['datetime', 'pi', 'packets', 'observations', 'badges'])
+    if len(table) == 0:
+        logger.info("No packets to count")
+        return
+    table = table.set_index(['datetime', 'pi']).sort_index()
+    logger.info("Packet counts: {} hub hours, {} packets".format(len(table), table['packets'].sum()))
+
+    with store_lock(hub_packets_store_path):
+        table.to_hdf(hub_packets_store_path, pi_hour_packets_store_key, mode='a', format='table', append=False,
+                     **hdf_storage_kwargs(pi_hour_packets_store_key))
+
+
+def _split_raw_data_by_hour(fileobject, target, kind, chunks_target=None, chunk_name=None, packet_counts=None):
     """Splits the data from a raw data file into a single file for each day.
 
     Parameters
@@ -59,11 +98,25 @@ def _split_raw_data_by_hour(fileobject, target, kind):
 
     kind : str
         The kind of data being extracted, either 'audio' or 'proximity'.
+
+    chunks_target : str, optional
+        If given, proximity data is also written as binary columnar chunks into this
+        directory, one sub-directory per hour (see _write_proximity_chunk).
+
+    chunk_name : str, optional
+        Name of the chunk of each hour. Should be unique for each raw data file.
+
+    packet_counts : dict, optional
+        If given, counts the records of each hour into it. Maps hour file names to
+        [packets, observations, set of badge addresses].
     """
     # The hours fileobjects
     # It's a mapping from dates/hours (e.g. '2017-07-29-04') to fileobjects
     hour_files = {}
 
+    # The hours chunks, mapping from dates/hours to (scans, observations) lists
+    hour_chunks = {}
+
     # Read each line
     for line in fileobject:
         data = json.loads(line)
@@ -84,65 +137,253 @@ def _split_raw_data_by_hour(fileobject, target, kind):
         json.dump(data, hour_files[hour])
         hour_files[hour].write('\n')
 
+        if packet_counts is not None:
+            if hour not in packet_counts:
+                packet_counts[hour] = [0, 0, set()]
+            counts = packet_counts[hour]
+            counts[0] += 1
+            counts[1] += len(data['data'].get('rssi_distances') or {})
+            counts[2].add(data['data'].get('badge_address'))
+
+        if chunks_target is not None:
+            if hour not in hour_chunks:
+                hour_chunks[hour] = ([], [])
+            _add_to_proximity_chunk(data['data'], *hour_chunks[hour])
+
     # Free the memory
     for f in hour_files.values():
         f.close()
+
+    for hour, (scans, observations) in hour_chunks.items():
+        chunk_dir = _proximity_chunk_dir(hour, chunks_target)
+        if not os.path.exists(chunk_dir):
+            os.makedirs(chunk_dir)
+        _write_proximity_chunk(os.path.join(chunk_dir, chunk_name + '.npz'), scans, observations)
     return {hour for hour in hour_files.keys()}
 
 
-def process_proximity():
-    # remove dirty data if already there
-    try:
-        os.remove(dirty_store_path)
-    except OSError:
-        pass
+def _proximity_chunk_dir(hour_filename, chunks_target=None):
+    """
+    Returns the directory of the binary chunks of an hourly file (e.g. - 20180612-10.gz)
+    """
+    if chunks_target is None:
+        chunks_target = proximity_chunks_dir
+    return os.path.join(chunks_target, os.path.basename(hour_filename).split('.')[0])
+
+
+def _add_to_proximity_chunk(data, scans, observations):
+    """
+    Adds a proximity record to the lists of an hourly chunk. Each record is one scan, with
+    a voltage, and an observation per observed badge or beacon. Fields are read the same way
+    as openbadge_analysis.preprocessing reads them from the JSON lines
+    """
+    member = str(data['member'] if 'member' in data else data['member_id'])
+    timestamp = data['timestamp']
+    scans.append((timestamp, member, float(data['voltage'])))
+    for observed_id, distance in data['rssi_distances'].items():
+        observations.append((timestamp, member, int(observed_id), float(distance['rssi']), float(distance['count'])))
+
+
+def _write_proximity_chunk(path, scans, observations):
+    """
+    Writes an hourly chunk as typed columns into a .npz file. Members are stored once, and
+    referenced by their code. The file is written to a temporary name first, so an
+    interrupted run doesn't leave partial chunks
+    """
+    members = sorted(set(s[1] for s in scans) | set(o[1] for o in observations))
+    member_codes = {m: i for i, m in enumerate(members)}
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 members=np.array(members),
+                 scan_timestamp=np.array([s[0] for s in scans], dtype='float64'),
+                 scan_member=np.array([member_codes[s[1]] for s in scans], dtype='int32'),
+                 scan_voltage=np.array([s[2] for s in scans], dtype='float64'),
+                 obs_timestamp=np.array([o[0] for o in observations], dtype='float64'),
+                 obs_member=np.array([member_codes[o[1]] for o in observations], dtype='int32'),
+                 obs_observed_id=np.array([o[2] for o in observations], dtype='int64'),
+                 obs_rssi=np.array([o[3] for o in observations], dtype='float64'),
+                 obs_count=np.array([o[4] for o in observations], dtype='float64'))
+    os.rename(tmp_path, path)
+
+
+def _read_proximity_chunks(chunk_dir):
+    """
+    Reads all the chunks of an hour
+    :return: scans (timestamp, member, voltage) and observations (timestamp, member, observed_id,
+        rssi, count) dataframes, in the same order as the lines of the hourly file. None if there
+        are no chunks
+    """
+    paths = sorted(glob.glob(os.path.join(chunk_dir, '*.npz')))
+    if len(paths) == 0:
+        return None, None
+
+    scans = []
+    observations = []
+    for path in paths:
+        with np.load(path) as chunk:
+            members = chunk['members'].astype(str)
+            scans.append(pd.DataFrame({
+                'timestamp': chunk['scan_timestamp'],
+                'member': members[chunk['scan_member']],
+                'voltage': chunk['scan_voltage']},
+                columns=['timestamp', 'member', 'voltage']))
+            observations.append(pd.DataFrame({
+                'timestamp': chunk['obs_timestamp'],
+                'member': members[chunk['obs_member']],
+                'observed_id': chunk['obs_observed_id'],
+                'rssi': chunk['obs_rssi'],
+                'count': chunk['obs_count']},
+                columns=['timestamp', 'member', 'observed_id', 'rssi', 'count']))
+
+    scans = pd.concat(scans, ignore_index=True)
+    observations = pd.concat(observations, ignore_index=True)
+    scans['member'] = scans['member'].astype(object)
+    observations['member'] = observations['member'].astype(object)
+    return scans, observations
+
+
+def _chunk_datetimes(timestamps):
+    """
+    Helper, converts unix timestamps to localized datetimes
+    """
+    return pd.to_datetime(timestamps, unit='s').dt.tz_localize('UTC').dt.tz_convert(time_zone)
+
+
+def _chunk_voltages(scans):
+    """
+    Same as openbadge_analysis.preprocessing.voltages(), from the scans of a chunk
+    """
+    df = scans[['member', 'voltage']].copy()
+    df['datetime'] = _chunk_datetimes(scans['timestamp'])
+    df = df.groupby([pd.Grouper(key='datetime', freq=time_bins_size), 'member']).mean()
+    df.sort_index(inplace=True)
+    return df
+
+
+def _chunk_member_to_badge(observations):
+    """
+    Same as openbadge_analysis.preprocessing.member_to_badge_proximity(), from the observations of a chunk
+    """
+    df = observations[['member', 'observed_id', 'rssi', 'count']].copy()
+    df['datetime'] = _chunk_datetimes(observations['timestamp'])
+
+    # Group per time bins, member and observed_id, and take the first value, arbitrarily
+    df = df.groupby([pd.Grouper(key='datetime', freq=time_bins_size), 'member', 'observed_id']).first()
+    df.sort_index(inplace=True)
+    return df
 
-    proximity_filepaths_gzipped = sorted(glob.glob((os.path.join(proximity_data_dir,'*gz'))))
 
-    # process and write files in groups of num_processors for max efficiency
-    for i in range(0, len(proximity_filepaths_gzipped), num_processors):
-        pool = Pool(num_processors)
-        results = pool.map(_process_proximity_file, proximity_filepaths_gzipped[i:i+num_processors])
-        pool.close()
-        pool.join()
-        _write_proximity(results)
-        del results
+def process_proximity(resume=False):
+    """
+    Processes the hourly files into the dirty store. Each hourly file is committed separately, and
+    the committed files are merged into the store at the end (see storage.commit_unit)
+    :param resume: keep the dirty store, and only process hourly files that were not committed yet
+    """
+    proximity_filepaths_gzipped = preview_hourly_files(sorted(glob.glob((os.path.join(proximity_data_dir,'*gz')))))
+
+    if resume:
+        done = recover_checkpoint(dirty_store_path, 'process')
+        proximity_filepaths_gzipped = [f for f in proximity_filepaths_gzipped if os.path.basename(f) not in done]
+        logger.info("Resuming, {} hourly files to process".format(len(proximity_filepaths_gzipped)))
+    else:
+        # remove dirty data if already there
+        try:
+            os.remove(dirty_store_path)
+        except OSError:
+            pass
+        reset_checkpoint(dirty_store_path, 'process')
+
+    # process files in up to num_processors workers, as memory allows, and write them in order. The
+    # metadata is read once, and passed to the workers with each file
+    beacons_metadata, idmap = _proximity_metadata()
+    sizes = [os.path.getsize(f) for f in proximity_filepaths_gzipped]
+    results = adaptive_imap(_process_proximity_file,
+                            [(f, beacons_metadata, idmap) for f in proximity_filepaths_gzipped], sizes,
+                            num_processors, name='hourly files')
+    for filepath, output in zip(proximity_filepaths_gzipped, results):
+        _write_proximity([filepath], [output])
+        del output
+    merge_units(dirty_store_path, 'process')
+
+
+def _proximity_metadata():
+    """
+    Reads the beacons metadata, and creates the ID-to-member mapping
+    :return: beacons metadata, and idmap
+    """
+    beacons_metadata = pd.read_csv(beacons_metadata_path)
+    members_metadata = pd.read_csv(members_metadata_path)
+    logger.info("ID-to-member mapping")
+    idmap = ob.preprocessing.id_to_member_mapping(members_metadata)
+    logger.info("idmap. Counter: {}".format(len(idmap)))
+    logger.debug("idmap:\n%s", idmap.head())
+    return beacons_metadata, idmap
 
 
-def _process_proximity_file(filepath_zipped):
+def _process_proximity_file(task):
     '''
     Do all the processing on a single file, filename. Returns a dictionary
       mapping store names to dataframes, ready to be written to storage
       via write_proximity().
+    task is (path of the hourly file, beacons metadata, idmap), see
+      _proximity_metadata()
     '''
+    filepath_zipped, beacons_metadata, idmap = task
     filename = os.path.basename(filepath_zipped)
     output = {}
-    beacons_metadata = pd.read_csv(beacons_metadata_path)
-    members_metadata = pd.read_csv(members_metadata_path)
     logger.info("-------------------------------------------")
     logger.info("Processing proximity file '{}'".format(filename))
 
-    logger.info("ID-to-member mapping")
-    with gzip.open(filepath_zipped, 'r') as f:
-        idmap = ob.preprocessing.id_to_member_mapping(members_metadata)
-        logger.info("idmap. Counter: {}".format(len(idmap)))
-        print(idmap.head())
+    # Use the binary chunks created by group_by_hour() if available
+    chunk_dir = _proximity_chunk_dir(filepath_zipped)
+    scans, observations = None, None
+    if os.path.isdir(chunk_dir):
+        logger.info("Reading binary chunks from {}".format(chunk_dir))
+        scans, observations = _read_proximity_chunks(chunk_dir)
 
     logger.info("Voltages")
-    with gzip.open(filepath_zipped, 'r') as f:
-        voltages = ob.preprocessing.voltages(f, time_bins_size, tz=time_zone)
-        output['other/voltages'] = voltages
-        del voltages
+    if scans is not None:
+        voltages = _chunk_voltages(scans)
+    else:
+        with gzip.open(filepath_zipped, 'r') as f:
+            voltages = ob.preprocessing.voltages(f, time_bins_size, tz=time_zone)
+    output['other/voltages'] = voltages
+    del voltages
+    del scans
 
     logger.info("Member-to-badge proximity")
-    with gzip.open(filepath_zipped, 'r') as f:
-        m2badge = ob.preprocessing.member_to_badge_proximity(f, time_bins_size, tz=time_zone)
+    if observations is not None:
+        m2badge = _chunk_member_to_badge(observations)
+    else:
+        with gzip.open(filepath_zipped, 'r') as f:
+            m2badge = ob.preprocessing.member_to_badge_proximity(f, time_bins_size, tz=time_zone)
+    del observations
+
+    output.update(_process_proximity_tables(m2badge, idmap, beacons_metadata))
+    logger.info("Finished processing file {}".format(filename))
+    return output
 
-        # Remove RSSI values that are invalid
-        logger.info("Member-to-badge proximity - cleaning RSSIs. Count before: {}".format(len(m2badge)))
-        m2badge = m2badge[m2badge['rssi'] < -10]
-        logger.info("Member-to-badge proximity - cleaning RSSIs. Count after: {}".format(len(m2badge)))
-        output['proximity/member_to_badge'] = m2badge
+
+def _process_proximity_tables(m2badge, idmap, beacons_metadata):
+    """
+    Creates the member to badge, member to member, member to beacon and closest beacons tables
+    from the member to badge records of an hour. Used by process and by the streaming mode. With a
+    preview badge sample, the member to badge table is kept whole (compliance uses it), and the
+    other tables only keep the selected participants (see preview_filter_members())
+    :param m2badge: member to badge records, as returned by member_to_badge_proximity()
+    :param idmap: as returned by id_to_member_mapping()
+    :param beacons_metadata:
+    :return: dict mapping store names to dataframes
+    """
+    output = {}
+
+    # Remove RSSI values that are invalid
+    logger.info("Member-to-badge proximity - cleaning RSSIs. Count before: {}".format(len(m2badge)))
+    m2badge = m2badge[m2badge['rssi'] < -10]
+    logger.info("Member-to-badge proximity - cleaning RSSIs. Count after: {}".format(len(m2badge)))
+    output['proximity/member_to_badge'] = m2badge
 
     if len(m2badge) == 0:
         logger.info("Empty dataset. Skipping the rest")
@@ -150,13 +391,18 @@ def _process_proximity_file(filepath_zipped):
 
     # Calculate other dataframes (note which version of m2badge i'm using)
     logger.info("Member-to-member proximity")
-    m2m = ob.preprocessing.member_to_member_proximity(m2badge, idmap)
+    if process_local_m2m:
+        m2m = member_pairs.member_to_member_proximity(m2badge, idmap)
+    else:
+        m2m = ob.preprocessing.member_to_member_proximity(m2badge, idmap)
+    m2m = preview_filter_members(m2m, 'member1', 'member2')
     logger.info("Member-to-member proximity. Count: {}".format(len(m2m)))
     output['proximity/member_to_member'] = m2m
     del m2m
 
     logger.info("Member-to-beacon proximity")
-    m2b_raw = ob.preprocessing.member_to_beacon_proximity(m2badge, beacons_metadata.set_index('beacon_id')['beacon'])
+    m2b_raw = ob.preprocessing.member_to_beacon_proximity(preview_filter_members(m2badge, 'member'),
+                                                          beacons_metadata.set_index('beacon_id')['beacon'])
     logger.info("Member-to-beacon proximity. Count: {}".format(len(m2b_raw)))
     output['proximity/member_to_beacon_raw'] = m2b_raw
     del m2badge
@@ -166,11 +412,12 @@ def _process_proximity_file(filepath_zipped):
         return output
 
     # Smoothing RSSIs and filling gaps
-    m2b_smooth = ob.preprocessing.member_to_beacon_proximity_smooth(
+    smoothing = proximity_smooth if process_local_smoothing else ob.preprocessing
+    m2b_smooth = smoothing.member_to_beacon_proximity_smooth(
         m2b_raw, window_size=rssi_smooth_window_size, min_samples=rssi_smooth_min_samples)
     logger.info("Member-to-beacon proximity - Smooth. Count after: {}".format(len(m2b_smooth)))
 
-    m2b = ob.preprocessing.member_to_beacon_proximity_fill_gaps(
+    m2b = smoothing.member_to_beacon_proximity_fill_gaps(
         m2b_smooth, time_bins_size=time_bins_size, max_gap_size=time_bins_max_gap_size)
     logger.info("Member-to-beacon proximity - fill gaps. Count after: {}".format(len(m2b)))
     output['proximity/member_to_beacon'] = m2b
@@ -200,31 +447,28 @@ def _process_proximity_file(filepath_zipped):
             beacon_field_name = 'beacon_'+str(i)
             
             if rssi_field_name not in m5cb.columns.values:
-                logger.debug("Adding missing field{}".format(rssi_field_name))
+                logger.debug("Adding missing field %s", rssi_field_name)
                 m5cb[rssi_field_name] = rssi_nan_value
 
             if beacon_field_name not in m5cb.columns.values:
-                logger.debug("Adding missing field {}".format(beacon_field_name))
+                logger.debug("Adding missing field %s", beacon_field_name)
                 m5cb[beacon_field_name] = None    
 
         logger.info("Member 5 closest beacons. Count: {}".format(len(m5cb)))
         output['proximity/member_5_closest_beacons'] = m5cb
         del m5cb
     del m2b
-
-    logger.info("Finished processing file {}".format(filename))
     return output
 
-def _write_proximity(outputs):
+def _write_proximity(filepaths, outputs):
     """
     Helper function; just writes "outputs" to an h5 file at dirty_store_path
 
-        outputs - dict, maps store names to pandas DataFrames.
+        filepaths - list, the hourly files that were processed
+        outputs - list of dicts, maps store names to pandas DataFrames. One for each file
 
     Returns nothing
     """
     for i in range(len(outputs)):
         logger.info("writing {}/{}".format(i+1, len(outputs)))
-        for name, table in outputs[i].iteritems():
-            with pd.HDFStore(dirty_store_path) as store:
-                store.append(name, table)
+        commit_unit(dirty_store_path, 'process', os.path.basename(filepaths[i]), sorted(outputs[i].items()))
@@ -0,0 +1,147 @@
+################################################################################
+#                           proximity_smooth.py
+#
+# Smoothing and gap filling of the member to beacon table, computed on sorted
+# arrays instead of per (member, beacon) groups. Equivalent to
+# member_to_beacon_proximity_smooth() and member_to_beacon_proximity_fill_gaps()
+# of openbadge_analysis.preprocessing, which process used before (see
+# process_local_smoothing in config.py, and benchmark_smoothing.py):
+#
+#   smooth - for each record, the records of the same member and beacon in the
+#       time window (t - window_size, t] give the median RSSI (rssi) and the
+#       standard deviation (rssi_std, -1 when there's a single record). Records
+#       with fewer than min_samples RSSIs in their window are dropped
+#   fill gaps - each (member, beacon) series is put on the time bins grid, and
+#       missing bins are filled with the previous value, up to max_gap_size
+#       bins after each record. Rows with missing values are dropped
+#
+# Records are sorted by (member, beacon, datetime). The window of each record
+# is found with a binary search on a key that combines its group and its time,
+# and windows are gathered into a (records x window length) matrix, so the
+# rolling sums and medians are computed for all groups at once.
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pandas as pd
+from config import *
+
+
+def _sorted_groups(m2b):
+    """
+    Helper, sorts a member to beacon table by member, beacon and datetime
+    :return: sorted table (datetime, member and beacon as columns), int64 times (ns), and group codes
+    """
+    df = m2b.reset_index()
+    member_codes, _ = pd.factorize(df['member'], sort=True)
+    beacon_codes, _ = pd.factorize(df['beacon'], sort=True)
+    times = df['datetime'].values.view('int64')
+    order = np.lexsort((times, beacon_codes, member_codes))
+    df = df.iloc[order].reset_index(drop=True)
+    groups = member_codes[order].astype(np.int64) * (beacon_codes.max() + 1) + beacon_codes[order]
+    return df, times[order], groups
+
+
+def _group_keys(times, groups, margin):
+    """
+    Helper, combines group codes and times into increasing int64 keys, with at least margin
+    between the times of consecutive groups
+    """
+    start = times.min()
+    span = times.max() - start + margin + 1
+    if (groups.max() + 1) * float(span) >= 2**62:
+        raise ValueError("Too many groups or too long a time range to smooth at once")
+    return groups * span + (times - start)
+
+
+def _to_m2b(df, columns):
+    """
+    Helper, indexes a table like the member to beacon table
+    """
+    return df.set_index(['datetime', 'member', 'beacon'])[columns].sort_index()
+
+
+def member_to_beacon_proximity_smooth(m2b, window_size='1min', min_samples=1):
+    """
+    Smooths the RSSIs of the member to beacon table with a rolling median over time
+    :param m2b: member to beacon table, indexed by datetime, member and beacon, with an rssi column
+    :param window_size: window of the rolling median (e.g. - '1min')
+    :param min_samples: minimal number of RSSIs in a window
+    :return: table indexed by datetime, member and beacon, with rssi and rssi_std columns
+    """
+    if len(m2b) == 0:
+        return _to_m2b(m2b.reset_index().assign(rssi_std=[]), ['rssi', 'rssi_std'])
+
+    df, times, groups = _sorted_groups(m2b)
+    window = pd.Timedelta(window_size).value
+    keys = _group_keys(times, groups, window)
+
+    # window of each record is [start, end). pandas windows are closed on the right: (t - w, t]
+    ends = np.arange(1, len(df) + 1)
+    starts = np.searchsorted(keys, keys - window, side='right')
+    lengths = ends - starts
+
+    # matrix of the window values, latest first, NaN past the start of the window
+    offsets = np.arange(lengths.max())
+    positions = ends[:, None] - 1 - offsets[None, :]
+    in_window = offsets[None, :] < lengths[:, None]
+    rssi = df['rssi'].values.astype(np.float64)
+    values = np.where(in_window, rssi[np.maximum(positions, 0)], np.nan)
+
+    # rolling sums over the windows
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=1)
+    sums = np.where(valid, values, 0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        squares = np.where(valid, (values - means[:, None])**2, 0).sum(axis=1)
+        std = np.sqrt(squares / (counts - 1))
+    enough = counts >= max(min_samples, 1)
+
+    median = np.full(len(df), np.nan)
+    if enough.any():
+        median[enough] = np.nanmedian(values[enough], axis=1)
+
+    df['rssi'] = median
+    df['rssi_std'] = np.where(np.isnan(std), -1.0, std)
+    return _to_m2b(df[enough], ['rssi', 'rssi_std'])
+
+
+def member_to_beacon_proximity_fill_gaps(m2b, time_bins_size='15S', max_gap_size=2):
+    """
+    Fills gaps in the member to beacon table, by repeating each record in up to max_gap_size
+    of the empty time bins after it. Times must be aligned to the time bins. Other times are
+    handled by openbadge_analysis
+    :param m2b: member to beacon table, indexed by datetime, member and beacon
+    :param time_bins_size: size of the time bins (e.g. - '15S')
+    :param max_gap_size: maximal number of bins to fill after each record
+    :return: table indexed by datetime, member and beacon, with the same columns
+    """
+    if len(m2b) == 0:
+        return m2b.copy()
+
+    bin_size = pd.Timedelta(time_bins_size).value
+    columns = list(m2b.columns)
+    df, times, groups = _sorted_groups(m2b)
+    if (times % bin_size != 0).any():
+        import openbadge_analysis.preprocessing
+        logger.debug("Times are not aligned to %s bins, filling gaps with openbadge_analysis", time_bins_size)
+        return openbadge_analysis.preprocessing.member_to_beacon_proximity_fill_gaps(
+            m2b, time_bins_size=time_bins_size, max_gap_size=max_gap_size)
+
+    # empty bins between each record and the next record of its group
+    last_in_group = np.append(groups[1:] != groups[:-1], True)
+    gaps = np.append((times[1:] - times[:-1]) // bin_size - 1, 0)
+    gaps[last_in_group] = 0
+    repeats = 1 + np.clip(gaps, 0, max_gap_size)
+
+    filled = df.iloc[np.repeat(np.arange(len(df)), repeats)].reset_index(drop=True)
+    steps = np.arange(len(filled)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    filled_times = pd.DatetimeIndex(np.repeat(times, repeats) + steps * bin_size)
+    if df['datetime'].dt.tz is not None:
+        filled_times = filled_times.tz_localize('UTC').tz_convert(df['datetime'].dt.tz)
+    filled['datetime'] = filled_times
+
+    # like the library, records with missing values are dropped, along with the bins they fill
+    return _to_m2b(filled, columns).dropna()
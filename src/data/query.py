@@ -0,0 +1,230 @@
+################################################################################
+#                               query.py
+#
+# Cached access to the analysis stores, for notebooks. For example:
+#
+#   import sys
+#   sys.path.insert(0, '../../src/data/')
+#   import query
+#
+#   members = query.members()
+#   m2m = query.connections(-62, level='m2m', freq='daily',
+#                           start='2018-06-12', end='2018-06-19')
+#
+# Time and member predicates are pushed down to the store, so only the
+# requested rows are read. Results are kept in an in-process LRU cache, bounded
+# by query_cache_max_bytes. Cached results of a store are dropped when the
+# store file changes (based on its modification time).
+#
+# Analysis tables are read from the current published snapshot of the analysis
+# store (see snapshots.py), so queries work while the pipeline rebuilds it. A
+# new snapshot is picked up by the next query.
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+from collections import OrderedDict
+
+import pandas as pd
+from config import *
+from analysis_connections import generate_analysis_connections_store_key
+from snapshots import current_analysis_snapshot
+
+# maps query levels to connection table names
+_connection_levels = {'m2m': 'm2m_dbl', 'm2c': 'm2c', 'c2c': 'c2c_dbl'}
+
+# (path, key, where) -> (store mtime, size in bytes, dataframe)
+_cache = OrderedDict()
+_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def _cache_size():
+    return sum(entry[1] for entry in _cache.values())
+
+
+def _cache_get(cache_key, mtime):
+    entry = _cache.get(cache_key)
+    if entry is None:
+        return None
+
+    # store was modified since this was cached
+    if entry[0] != mtime:
+        del _cache[cache_key]
+        return None
+
+    # most recently used goes last
+    del _cache[cache_key]
+    _cache[cache_key] = entry
+    return entry[2]
+
+
+def _cache_put(cache_key, mtime, df):
+    size = int(df.memory_usage(index=True, deep=True).sum())
+    if size > query_cache_max_bytes:
+        logger.debug("Not caching {}, size {} is over the cache limit".format(cache_key, size))
+        return
+
+    _cache[cache_key] = (mtime, size, df)
+    while _cache_size() > query_cache_max_bytes:
+        _cache.popitem(last=False)
+
+
+def clear_cache():
+    """
+    Removes all cached results
+    """
+    _cache.clear()
+    _cache_stats['hits'] = 0
+    _cache_stats['misses'] = 0
+
+
+def cache_info():
+    """
+    Returns a dict with the number of cached results, their size in bytes, and the number of
+    cache hits and misses
+    """
+    return {'entries': len(_cache), 'bytes': _cache_size(),
+            'hits': _cache_stats['hits'], 'misses': _cache_stats['misses']}
+
+
+def read(path, key, where=None):
+    """
+    Reads a table from a store, using the cache. Results are copies, so they can be modified
+    by the caller without affecting the cache
+    :param path: store path (e.g. - current_analysis_snapshot())
+    :param key: store key
+    :param where: optional where clause, passed to the store
+    :return:
+    """
+    mtime = os.path.getmtime(path)
+    cache_key = (path, key, where)
+
+    df = _cache_get(cache_key, mtime)
+    if df is None:
+        _cache_stats['misses'] += 1
+        df = pd.read_hdf(path, key, where=where)
+        _cache_put(cache_key, mtime, df)
+    else:
+        _cache_stats['hits'] += 1
+    return df.copy()
+
+
+def _where(start=None, end=None, **columns):
+    """
+    Helper, creates a where clause from a time range and lists of allowed values
+    """
+    terms = []
+    if start is not None:
+        terms.append("datetime >= '" + str(pd.Timestamp(start, tz=time_zone)) + "'")
+    if end is not None:
+        terms.append("datetime < '" + str(pd.Timestamp(end, tz=time_zone)) + "'")
+    for column, values in sorted(columns.items()):
+        if values is not None:
+            terms.append(column + " = " + repr([str(v) for v in values]))
+
+    if len(terms) == 0:
+        return None
+    return " & ".join(terms)
+
+
+def members():
+    """
+    Members metadata, indexed by member
+    """
+    return read(current_analysis_snapshot(), 'metadata/members')
+
+
+def connections(cutoff, level='m2m', freq='daily', start=None, end=None, members=None):
+    """
+    Connection tables, as created by analysis_connections
+    :param cutoff: rssi cutoff (e.g. -62)
+    :param level: 'm2m' (member to member), 'm2c' (member to company) or 'c2c' (company to company)
+    :param freq: time level name (e.g. - hourly, shift, daily, weekly, period, annual).
+        See analysis_connections_freqs
+    :param start: if given, only rows on or after this time
+    :param end: if given, only rows before this time
+    :param members: if given, only rows with these members on side 1. Not supported for c2c
+    :return:
+    """
+    if level not in _connection_levels:
+        raise ValueError("Unknown level: {}. Use one of {}".format(level, sorted(_connection_levels)))
+    if members is not None and level == 'c2c':
+        raise ValueError("members can't be used with c2c tables")
+
+    key = generate_analysis_connections_store_key(cutoff, _connection_levels[level] + "_" + freq)
+    return read(current_analysis_snapshot(), key, where=_where(start, end, member1=members))
+
+
+def compliance(start=None, end=None, members=None, dirty=False):
+    """
+    Compliance series (whether the badge was worn), at the time bin level
+    :param start: if given, only rows on or after this time
+    :param end: if given, only rows before this time
+    :param members: if given, only these members
+    :param dirty: use the compliance computed from the data before cleaning
+    :return:
+    """
+    key = 'proximity/member_comply_dirty' if dirty else 'proximity/member_comply'
+    return read(current_analysis_snapshot(), key, where=_where(start, end, member=members))
+
+
+def compliance_summary(start=None, end=None, members=None):
+    """
+    Daily compliance summary of each member: observed time bins, off-board hours and complied
+    hours, before and after cleaning. See analysis_comply._analysis_comply_summary()
+    :param start: if given, only days on or after this time
+    :param end: if given, only days before this time
+    :param members: if given, only these members
+    :return:
+    """
+    return read(current_analysis_snapshot(), 'proximity/member_comply_daily',
+                where=_where(start, end, member=members))
+
+
+def hub_packets():
+    """
+    Number of packets, observations and badges of each hub (pi) in each hour, as counted by group.
+    Hours are in the local time of the hourly file names
+    """
+    return read(hub_packets_store_path, pi_hour_packets_store_key)
+
+
+def closest_beacon(start=None, end=None, members=None):
+    """
+    Closest beacon of each member, at the time bin level
+    :param start: if given, only rows on or after this time
+    :param end: if given, only rows before this time
+    :param members: if given, only these members
+    :return:
+    """
+    return read(current_analysis_snapshot(), 'proximity/member_closest_beacon', where=_where(start, end, member=members))
+
+
+def member_to_member(start=None, end=None):
+    """
+    Member to member records, after removing times in which badges were not worn
+    :param start: if given, only rows on or after this time
+    :param end: if given, only rows before this time
+    :return:
+    """
+    return read(current_analysis_snapshot(), 'proximity/member_to_member', where=_where(start, end))
+
+
+def daily_surveys():
+    """
+    Cleaned daily survey responses
+    """
+    return read(surveys_clean_store_path, 'daily/daily_survey_data_clean')
+
+
+def entry_surveys():
+    """
+    Cleaned entry survey responses, indexed by member
+    """
+    return read(surveys_clean_store_path, 'entry/participants_entry_survey_data_clean')
+
+
+def panel(name):
+    """
+    Panels created by the notebooks (e.g. - members_panel, company_panel)
+    """
+    return read(analysis_notebooks_store_path, 'panels/' + name)
@@ -0,0 +1,314 @@
+################################################################################
+#                               shadow.py
+#
+# Usage:
+#   python shadow.py [--candidate <module.function>=<module.function>] ...
+#                    [--reference <module.function>=<module.function>] ...
+#                    [--stages <stage,...>] [--hours <hours>] [--seed <seed>]
+#                    [--keep <dir>]
+#
+# Shadow runs, to check that a faster replacement of a function produces the
+# same stores. Synthetic data (see synthetic.py) is created in a temporary
+# directory, and the stages (by default, all but download and surveys) run on
+# it twice, in separate data directories (BADGES_DATA_DIR): once with the
+# reference code, and once with the candidate patches applied. For example,
+#   --candidate process._process_proximity_file=fast_process.process_file
+# replaces _process_proximity_file in process.py with process_file from
+# fast_process.py (which must be importable, e.g. - through PYTHONPATH).
+# Patches replace the module attribute, so they apply where the function is
+# looked up in that module (worker processes are forked, and see them too).
+#
+# Each stage runs in its own process, alternating between the reference and
+# the candidate, and its time and peak memory (RSS, including its workers) are
+# measured. Then every key of every store is compared, ignoring the order of
+# rows and columns, with a tolerance for floats (shadow_rtol, shadow_atol).
+# Prints both side by side, and exits with 1 if any table differs. No network
+# access is needed.
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import glob
+import gzip
+import importlib
+import json
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from config import *
+from logs import setup_logging, stop_logging
+from pipeline import pipeline_stages
+from synthetic import synthetic_metadata, write_synthetic_hub_files
+
+# Tolerance for comparing floats, as in numpy.isclose()
+shadow_rtol = 1e-9
+shadow_atol = 1e-12
+
+# Stages that run by default. download needs the network, and surveys the survey data
+shadow_default_stages = [stage.name for stage in pipeline_stages if stage.name != 'surveys']
+
+
+def _make_synthetic_data(directory, hours, seed):
+    """
+    Helper, creates a data directory with synthetic metadata and gzipped hub files, laid out
+    like data/ (see config.py)
+    """
+    metadata_directory = os.path.join(directory, 'metadata')
+    hub_directory = os.path.join(directory, 'raw', 'hub_data')
+    os.makedirs(metadata_directory)
+
+    members, beacons = synthetic_metadata()
+    members.to_csv(os.path.join(metadata_directory, members_metadata_filename), index=False)
+    beacons.to_csv(os.path.join(metadata_directory, beacons_metadata_filename), index=False)
+
+    for path in write_synthetic_hub_files(hub_directory, members, beacons, period1_start, hours, seed=seed):
+        with open(path, 'rb') as f_in, gzip.open(path + '.gz', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(path)
+
+
+def _resolve(name):
+    """
+    Helper, returns the module and attribute name of a dotted name (e.g. - process._process_proximity_file)
+    """
+    module_name, attribute = name.rsplit('.', 1)
+    module = importlib.import_module(module_name)
+    if not hasattr(module, attribute):
+        raise ValueError("{} has no attribute {}".format(module_name, attribute))
+    return module, attribute
+
+
+def _apply_patches(patches):
+    """
+    Helper, applies a list of (target, replacement) dotted names
+    """
+    for target, replacement in patches:
+        module, attribute = _resolve(target)
+        replacement_module, replacement_attribute = _resolve(replacement)
+        setattr(module, attribute, getattr(replacement_module, replacement_attribute))
+        logger.info("Shadow - {} replaced by {}".format(target, replacement))
+
+
+def _run_child(stage_name, result_path, patches):
+    """
+    Runs a single stage, in the child process started by _run_stage(), and writes its time and
+    peak RSS to result_path
+    """
+    setup_logging(os.path.join(data_dir, 'shadow.log'), console=False)
+    try:
+        _apply_patches(patches)
+        stage = dict((stage.name, stage) for stage in pipeline_stages)[stage_name]
+        # look the function up again, so patches of stage functions apply
+        func = getattr(sys.modules[stage.func.__module__], stage.func.__name__)
+        start_time = time.time()
+        func()
+        seconds = time.time() - start_time
+    finally:
+        stop_logging()
+
+    # ru_maxrss is in kilobytes on Linux. Workers are children of this process
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    with open(result_path, 'w') as f:
+        json.dump({'seconds': seconds, 'peak_rss': peak_rss}, f)
+
+
+def _run_stage(stage_name, directory, patches):
+    """
+    Helper, runs a stage in a new process, on the data in directory
+    :return: dict with seconds and peak_rss
+    """
+    result_path = os.path.join(directory, 'shadow_' + stage_name + '.json')
+    env = dict(os.environ)
+    env['BADGES_DATA_DIR'] = directory
+    env.pop('BADGES_PREVIEW', None)
+    # workers started by a forkserver import the modules again, without the patches
+    env['BADGES_WORKER_START_METHOD'] = 'fork'
+    args = [sys.executable, os.path.abspath(__file__), '--child', stage_name, result_path]
+    for target, replacement in patches:
+        args += ['--patch', target + '=' + replacement]
+
+    exit_code = subprocess.call(args, env=env)
+    if exit_code != 0:
+        raise RuntimeError("Stage {} failed in {} (exit code {}), see {}".format(
+            stage_name, directory, exit_code, os.path.join(directory, 'shadow.log')))
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def _normalize_table(table):
+    """
+    Helper, sorts the rows and columns of a table, so tables that only differ in order are equal
+    """
+    if isinstance(table, pd.Series):
+        table = table.to_frame()
+    table = table[sorted(table.columns, key=str)]
+    if table.index.is_unique:
+        return table.sort_index()
+    # duplicate index values, sort by everything
+    table = table.reset_index()
+    return table.sort_values(list(table.columns)).reset_index(drop=True)
+
+
+def compare_tables(reference, candidate, rtol=None, atol=None):
+    """
+    Compares two tables, ignoring the order of rows and columns. Floats are compared with a tolerance
+    :param rtol: relative tolerance. Defaults to shadow_rtol
+    :param atol: absolute tolerance. Defaults to shadow_atol
+    :return: None if the tables are equal, otherwise a description of the first difference
+    """
+    rtol = shadow_rtol if rtol is None else rtol
+    atol = shadow_atol if atol is None else atol
+    reference = _normalize_table(reference)
+    candidate = _normalize_table(candidate)
+
+    if list(reference.columns) != list(candidate.columns):
+        return "columns {}, candidate {}".format(list(reference.columns), list(candidate.columns))
+    if len(reference) != len(candidate):
+        return "{} rows, candidate {}".format(len(reference), len(candidate))
+    if not reference.index.equals(candidate.index):
+        differ = (reference.index.values != candidate.index.values).sum()
+        return "index differs in {} rows".format(differ)
+
+    for column in reference.columns:
+        ref = reference[column]
+        cand = candidate[column]
+        if ref.dtype != cand.dtype:
+            return "column {}: dtype {}, candidate {}".format(column, ref.dtype, cand.dtype)
+        if ref.dtype.kind in 'fc':
+            close = np.isclose(ref.values, cand.values, rtol=rtol, atol=atol, equal_nan=True)
+        else:
+            close = (ref.values == cand.values) | (ref.isnull().values & cand.isnull().values)
+        if not close.all():
+            first = np.flatnonzero(~close)[0]
+            return "column {}: {} of {} values differ, first at {}: {!r}, candidate {!r}".format(
+                column, (~close).sum(), len(close), reference.index[first], ref.values[first], cand.values[first])
+    return None
+
+
+def compare_stores(reference_directory, candidate_directory):
+    """
+    Compares every key of every store (*.h5) under two directories
+    :return: table with a row per store key, and the difference ('' if equal)
+    """
+    def store_paths(directory):
+        return set(os.path.relpath(path, directory) for path in
+                   glob.glob(os.path.join(directory, '*.h5')) + glob.glob(os.path.join(directory, '*', '*.h5')))
+
+    rows = []
+    for store in sorted(store_paths(reference_directory) | store_paths(candidate_directory)):
+        stores = {}
+        for side, directory in [('reference', reference_directory), ('candidate', candidate_directory)]:
+            path = os.path.join(directory, store)
+            stores[side] = pd.HDFStore(path, mode='r') if os.path.exists(path) else None
+        try:
+            keys = set()
+            for side_store in stores.values():
+                keys |= set(side_store.keys()) if side_store is not None else set()
+            for key in sorted(keys):
+                missing = [side for side, side_store in stores.items() if side_store is None or key not in side_store]
+                if len(missing) > 0:
+                    difference = "missing in " + ", ".join(sorted(missing))
+                else:
+                    difference = compare_tables(stores['reference'][key], stores['candidate'][key]) or ''
+                rows.append({'store': store, 'key': key, 'difference': difference})
+        finally:
+            for side_store in stores.values():
+                if side_store is not None:
+                    side_store.close()
+    return pd.DataFrame(rows, columns=['store', 'key', 'difference'])
+
+
+def shadow_run(candidate_patches, reference_patches=None, stages=None, hours=3, seed=0, keep_directory=None):
+    """
+    Runs the stages on synthetic data with the reference and the candidate code, and compares them
+    :param candidate_patches: list of (target, replacement) dotted names, applied to the candidate run
+    :param reference_patches: same, for the reference run (by default, none)
+    :param stages: names of the stages to run, in order. Defaults to shadow_default_stages
+    :param hours: hours of synthetic data
+    :param seed: seed of the synthetic data
+    :param keep_directory: keep the data of both runs in this directory. By default, it's removed
+    :return: table of the stages (time and peak RSS of both runs), and table of the store keys (see
+        compare_stores())
+    """
+    stages = shadow_default_stages if stages is None else stages
+    reference_patches = [] if reference_patches is None else reference_patches
+    directory = keep_directory or tempfile.mkdtemp(prefix='shadow_')
+    try:
+        logger.info("Shadow - creating {} hours of synthetic data in {}".format(hours, directory))
+        _make_synthetic_data(os.path.join(directory, 'input'), hours, seed)
+        runs = [('reference', reference_patches), ('candidate', candidate_patches)]
+        for name, _ in runs:
+            shutil.copytree(os.path.join(directory, 'input'), os.path.join(directory, name))
+
+        rows = []
+        for stage_name in stages:
+            row = {'stage': stage_name}
+            for name, patches in runs:
+                logger.info("Shadow - running {} ({})".format(stage_name, name))
+                result = _run_stage(stage_name, os.path.join(directory, name), patches)
+                row[name + '_sec'] = result['seconds']
+                row[name + '_peak_mb'] = result['peak_rss'] / 1024**2
+            rows.append(row)
+        timings = pd.DataFrame(rows).set_index('stage')
+        timings['speedup'] = timings['reference_sec'] / timings['candidate_sec']
+        timings['peak_mb_delta'] = timings['candidate_peak_mb'] - timings['reference_peak_mb']
+        timings = timings[['reference_sec', 'candidate_sec', 'speedup',
+                           'reference_peak_mb', 'candidate_peak_mb', 'peak_mb_delta']]
+
+        keys = compare_stores(os.path.join(directory, 'reference', 'interim'),
+                              os.path.join(directory, 'candidate', 'interim'))
+    finally:
+        if keep_directory is None:
+            shutil.rmtree(directory, ignore_errors=True)
+    return timings, keys
+
+
+def _patch_arguments(flag):
+    """
+    Helper, the (target, replacement) pairs given with a flag on the command line
+    """
+    patches = []
+    for i, arg in enumerate(sys.argv[:-1]):
+        if arg == flag:
+            target, replacement = sys.argv[i + 1].split('=', 1)
+            patches.append((target, replacement))
+    return patches
+
+
+def _argument(flag, default):
+    return sys.argv[sys.argv.index(flag) + 1] if flag in sys.argv else default
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        _run_child(sys.argv[2], sys.argv[3], _patch_arguments('--patch'))
+        return
+
+    stages = _argument('--stages', None)
+    setup_logging(console=True)
+    try:
+        timings, keys = shadow_run(_patch_arguments('--candidate'), _patch_arguments('--reference'),
+                                   stages=stages.split(',') if stages is not None else None,
+                                   hours=float(_argument('--hours', 3)), seed=int(_argument('--seed', 0)),
+                                   keep_directory=_argument('--keep', None))
+    finally:
+        stop_logging()
+
+    different = keys[keys.difference != '']
+    with pd.option_context('display.width', 200, 'display.precision', 2, 'display.max_colwidth', 120,
+                           'display.max_rows', 500):
+        print(timings)
+        print()
+        print(keys.set_index(['store', 'key']))
+    print("\n{} of {} store keys differ".format(len(different), len(keys)))
+    sys.exit(1 if len(different) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
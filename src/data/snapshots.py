@@ -0,0 +1,161 @@
+################################################################################
+#                               snapshots.py
+#
+# Usage:
+#   python make_dataset.py publish
+#
+# Published snapshots of the analysis store, so notebooks can read while the
+# pipeline writes. Stages write to analysis_store_path, which is removed and
+# rebuilt by full runs and appended to for hours, and to the graph files under
+# graphs_data_dir, which are rebuilt in place. When a run completes, the store
+# is copied to a new snapshot under analysis_snapshots_dir, the graphs to a
+# directory next to it (analysis-<time>.graphs), and the CURRENT pointer file
+# is replaced to name the snapshot (an atomic rename, so readers see either
+# the previous snapshot or the new one). Snapshots are never written after
+# they are published.
+#
+# Readers open the current snapshot once, and use it for all their reads, e.g.
+# in notebooks:
+#
+#   from snapshots import current_analysis_snapshot
+#   analysis_snapshot_path = current_analysis_snapshot()
+#   members = pd.read_hdf(analysis_snapshot_path, 'metadata/members')
+#
+# query.py does this for all the analysis tables, and analysis_graphs.load_graphs()
+# reads the graphs of the current snapshot. Old snapshots are removed
+# after each publish, keeping the analysis_snapshots_keep newest ones, and any
+# snapshot younger than analysis_snapshots_min_age_seconds (a notebook may
+# still be reading it).
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import datetime
+import shutil
+import time
+
+from config import *
+from storage import store_lock
+
+_snapshot_prefix = 'analysis-'
+_snapshot_suffix = '.h5'
+
+
+def _pointer_path():
+    return os.path.join(analysis_snapshots_dir, 'CURRENT')
+
+
+def snapshot_graphs_dir(snapshot_path):
+    """
+    The directory of the graph files published with a snapshot (see analysis_graphs.py)
+    :param snapshot_path: as returned by current_analysis_snapshot()
+    :return:
+    """
+    return snapshot_path[:-len(_snapshot_suffix)] + '.graphs'
+
+
+def list_analysis_snapshots():
+    """
+    Published snapshots, oldest first
+    :return: list of paths
+    """
+    if not os.path.exists(analysis_snapshots_dir):
+        return []
+    names = [name for name in os.listdir(analysis_snapshots_dir)
+             if name.startswith(_snapshot_prefix) and name.endswith(_snapshot_suffix)]
+    return [os.path.join(analysis_snapshots_dir, name) for name in sorted(names)]
+
+
+def current_analysis_snapshot():
+    """
+    The path of the latest published snapshot of the analysis store
+    :return:
+    """
+    try:
+        with open(_pointer_path()) as f:
+            name = f.read().strip()
+    except IOError:
+        raise IOError("No published analysis snapshot in {}. Run the analysis, or 'make_dataset.py publish' "
+                      "to publish the current analysis store".format(analysis_snapshots_dir))
+    return os.path.join(analysis_snapshots_dir, name)
+
+
+def current_analysis_graphs_dir():
+    """
+    The directory of the graph files of the latest published snapshot
+    :return:
+    """
+    return snapshot_graphs_dir(current_analysis_snapshot())
+
+
+def publish_analysis_snapshot():
+    """
+    Copies the analysis store and the graph files to a new snapshot, makes it the current one, and
+    removes old snapshots. The store lock is held while copying, so no stage writes to the store
+    or the graphs meanwhile
+    :return: path of the new snapshot
+    """
+    if not os.path.exists(analysis_snapshots_dir):
+        os.makedirs(analysis_snapshots_dir)
+
+    name = _snapshot_prefix + datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f') + _snapshot_suffix
+    path = os.path.join(analysis_snapshots_dir, name)
+    logger.info("Publishing analysis snapshot {}".format(name))
+
+    # copied under a temporary name, so a snapshot is never seen half-written. The graphs are
+    # published first, so the snapshot has them once it exists
+    graphs_dir = snapshot_graphs_dir(path)
+    with store_lock(analysis_store_path):
+        shutil.copyfile(analysis_store_path, path + '.tmp')
+        if os.path.exists(graphs_data_dir):
+            shutil.copytree(graphs_data_dir, graphs_dir + '.tmp')
+    with open(path + '.tmp', 'rb') as f:
+        os.fsync(f.fileno())
+    if os.path.exists(graphs_dir + '.tmp'):
+        os.rename(graphs_dir + '.tmp', graphs_dir)
+    os.rename(path + '.tmp', path)
+
+    with open(_pointer_path() + '.tmp', 'w') as f:
+        f.write(name + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(_pointer_path() + '.tmp', _pointer_path())
+
+    remove_old_analysis_snapshots()
+    return path
+
+
+def remove_old_analysis_snapshots(keep=None, min_age_seconds=None):
+    """
+    Removes old snapshots, and their graphs. The current snapshot, the newest ones and the recent
+    ones are kept
+    :param keep: number of snapshots to keep. Defaults to analysis_snapshots_keep
+    :param min_age_seconds: snapshots published more recently are kept. Defaults to
+        analysis_snapshots_min_age_seconds
+    :return: paths of the removed snapshots
+    """
+    if keep is None:
+        keep = analysis_snapshots_keep
+    if min_age_seconds is None:
+        min_age_seconds = analysis_snapshots_min_age_seconds
+
+    try:
+        current = current_analysis_snapshot()
+    except IOError:
+        current = None
+
+    snapshots = list_analysis_snapshots()
+    removed = []
+    for path in snapshots[:max(len(snapshots) - keep, 0)]:
+        if path == current or time.time() - os.path.getmtime(path) < min_age_seconds:
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning("Can't remove snapshot {}: {}".format(path, e))
+            continue
+        shutil.rmtree(snapshot_graphs_dir(path), ignore_errors=True)
+        removed.append(path)
+
+    if len(removed) > 0:
+        logger.info("Removed {} old analysis snapshots".format(len(removed)))
+    return removed
@@ -0,0 +1,253 @@
+from __future__ import absolute_import, division, print_function
+import contextlib
+import fnmatch
+import json
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows. Stages can't run concurrently there
+    fcntl = None
+
+import pandas as pd
+from config import *
+
+
+def hdf_storage_profile(key):
+    """
+    Returns the name of the storage profile of a store key (see hdf_storage_profile_keys)
+    :param key: store key (e.g. - proximity/member_to_badge)
+    :return:
+    """
+    key = key.lstrip('/')
+    for pattern, profile_name in hdf_storage_profile_keys:
+        if fnmatch.fnmatchcase(key, pattern):
+            return profile_name
+    return hdf_storage_default_profile
+
+
+def hdf_storage_kwargs(key):
+    """
+    Returns the arguments to pass to HDFStore.append() or DataFrame.to_hdf() when writing
+    a given store key, according to its storage profile
+    :param key: store key (e.g. - proximity/member_to_badge)
+    :return: dict with complib, complevel, expectedrows and chunksize
+    """
+    return dict(hdf_storage_profiles[hdf_storage_profile(key)])
+
+
+@contextlib.contextmanager
+def store_lock(path):
+    """
+    Inter-process lock for using a store. Stages that run concurrently (see pipeline.py) use the
+    same analysis store, and an HDF5 file can't be written by two processes at once, or read by one
+    while another writes it. Stages hold the lock when they read the analysis store too. The lock
+    is held on a separate '.lock' file next to the store, and is not reentrant
+    :param path: store path
+    :return:
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with open(path + '.lock', 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def checkpoint_path(store_path, stage):
+    """
+    Returns the path of the checkpoint file of a stage that writes to a store
+    :param store_path:
+    :param stage: stage name (e.g. - process)
+    :return:
+    """
+    return store_path + '.' + stage + '.checkpoint.json'
+
+
+def read_checkpoint(store_path, stage):
+    """
+    Reads the checkpoint of a stage
+    :return: dict with the list of committed units ('done'), the partitions that were not merged
+        into the store yet ('partitions', see commit_unit), and the partitions of a merge that was
+        interrupted after its merged store was complete ('merging', see merge_units)
+    """
+    try:
+        with open(checkpoint_path(store_path, stage)) as f:
+            checkpoint = json.load(f)
+    except (IOError, ValueError):
+        checkpoint = {}
+    checkpoint.setdefault('done', [])
+    checkpoint.setdefault('partitions', [])
+    checkpoint.setdefault('next_partition', 0)
+    checkpoint.setdefault('merging', None)
+    return checkpoint
+
+
+def _write_checkpoint(store_path, stage, checkpoint):
+    """
+    Helper, writes a checkpoint. Written to a temporary file first, so the checkpoint file is
+    always complete
+    """
+    path = checkpoint_path(store_path, stage)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+
+def _partitions_dir(store_path, stage):
+    """
+    Helper, directory of the partition files of a stage (see commit_unit)
+    """
+    return store_path + '.' + stage + '.partitions'
+
+
+def _merge_path(store_path, stage):
+    """
+    Helper, path of the merged store while merge_units() builds it
+    """
+    return store_path + '.' + stage + '.merge.tmp'
+
+
+def _fsync_file(path):
+    """
+    Helper, flushes a file to disk
+    """
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def reset_checkpoint(store_path, stage):
+    """
+    Removes the checkpoint of a stage, and its partitions, for runs that start from scratch
+    """
+    try:
+        os.remove(checkpoint_path(store_path, stage))
+    except OSError:
+        pass
+    shutil.rmtree(_partitions_dir(store_path, stage), ignore_errors=True)
+    try:
+        os.remove(_merge_path(store_path, stage))
+    except OSError:
+        pass
+
+
+def commit_unit(store_path, stage, unit, tables):
+    """
+    Commits the tables of a unit of work (e.g. - an hourly file, or a day), and records the unit as
+    done. The store itself is not written: the tables go to a partition file of their own, written
+    under a temporary name and renamed, so a crash leaves either the whole unit or nothing, and
+    never touches the units that were committed before. merge_units() appends the partitions to
+    the store, at the end of the stage
+    :param store_path:
+    :param stage: stage name (e.g. - process)
+    :param unit: unit name (e.g. - 20180612-10.gz)
+    :param tables: list of (store key, dataframe) pairs, appended in order
+    :return:
+    """
+    tables = [(key, table) for key, table in tables if len(table) > 0]
+    directory = _partitions_dir(store_path, stage)
+    with store_lock(store_path):
+        checkpoint = read_checkpoint(store_path, stage)
+        name = '{:06d}.h5'.format(checkpoint['next_partition'])
+        checkpoint['next_partition'] += 1
+        _write_checkpoint(store_path, stage, checkpoint)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    path = os.path.join(directory, name)
+    with pd.HDFStore(path + '.tmp', mode='w') as partition:
+        for key, table in tables:
+            partition.append(key, table, **hdf_storage_kwargs(key))
+    _fsync_file(path + '.tmp')
+    os.rename(path + '.tmp', path)
+
+    with store_lock(store_path):
+        checkpoint = read_checkpoint(store_path, stage)
+        checkpoint['done'].append(unit)
+        checkpoint['partitions'].append(name)
+        _write_checkpoint(store_path, stage, checkpoint)
+
+
+def _finish_merge(store_path, stage, checkpoint):
+    """
+    Helper, replaces the store with the merged store (if it wasn't replaced yet), and removes the
+    merged partitions. Called with the store lock held
+    """
+    merge_path = _merge_path(store_path, stage)
+    if os.path.exists(merge_path):
+        os.rename(merge_path, store_path)
+    directory = _partitions_dir(store_path, stage)
+    for name in checkpoint['merging']:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+    checkpoint['partitions'] = [name for name in checkpoint['partitions'] if name not in checkpoint['merging']]
+    checkpoint['merging'] = None
+    _write_checkpoint(store_path, stage, checkpoint)
+
+
+def merge_units(store_path, stage):
+    """
+    Appends the committed partitions of a stage to the store. The store is copied, the partitions
+    are appended to the copy, and the copy replaces the store (a rename), so a crash during the
+    merge leaves the store as it was, and the partitions in place. The store lock is held
+    throughout, so no other stage writes to the store meanwhile. Copying makes a merge as slow
+    as reading the store once, so stages merge once, when they end
+    :param store_path:
+    :param stage: stage name (e.g. - process)
+    :return:
+    """
+    directory = _partitions_dir(store_path, stage)
+    merge_path = _merge_path(store_path, stage)
+    with store_lock(store_path):
+        checkpoint = read_checkpoint(store_path, stage)
+        if checkpoint['merging'] is None:
+            if len(checkpoint['partitions']) == 0:
+                return
+            logger.info("Merging {} committed units into {}".format(len(checkpoint['partitions']), store_path))
+            if os.path.exists(store_path):
+                shutil.copyfile(store_path, merge_path)
+            elif os.path.exists(merge_path):
+                os.remove(merge_path)
+            with pd.HDFStore(merge_path) as store:
+                for name in checkpoint['partitions']:
+                    with pd.HDFStore(os.path.join(directory, name), mode='r') as partition:
+                        for key in partition.keys():
+                            store.append(key, partition[key], **hdf_storage_kwargs(key))
+            _fsync_file(merge_path)
+            # from here, the merged store is complete. If the merge is interrupted, recovery only
+            # renames it (or, if it was already renamed, removes the merged partitions)
+            checkpoint['merging'] = list(checkpoint['partitions'])
+            _write_checkpoint(store_path, stage, checkpoint)
+        _finish_merge(store_path, stage, checkpoint)
+
+
+def recover_checkpoint(store_path, stage):
+    """
+    Recovers from an interrupted run of a stage: removes the partitions a crash left uncommitted,
+    and merges the committed ones into the store, so the store has every unit that was done. The
+    stage must not be running elsewhere
+    :param store_path:
+    :param stage: stage name (e.g. - process)
+    :return: set of units that were committed
+    """
+    with store_lock(store_path):
+        checkpoint = read_checkpoint(store_path, stage)
+        directory = _partitions_dir(store_path, stage)
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name not in checkpoint['partitions']:
+                    logger.info("Removing uncommitted partition {} of {}".format(name, stage))
+                    os.remove(os.path.join(directory, name))
+
+    merge_units(store_path, stage)
+    return set(checkpoint['done'])
@@ -0,0 +1,455 @@
+################################################################################
+#                               stream.py
+#
+# Usage:
+#   python make_dataset.py stream [--replay <dir>] [--speed <factor>]
+#
+# Streaming mode for live deployments. Tails the hub files
+# (stream_hub_file_pattern) as the hubs append to them, and keeps the proximity
+# records of the hours that are still open in memory. Every stream_emit_seconds,
+# the open hours are processed with the same code as process, clean and
+# analysis_comply, and the compliance and per-pair minutes of the time bins that
+# are complete are emitted (appended to stream_store_path by default). When an
+# hour closes, its tables are committed to the dirty store (as the hourly file
+# process would have written, so 'process --resume' skips it) and to the clean
+# store, replacing any rows clean already wrote for that hour ('clean --resume'
+# leaves out the hours committed by the stream). The committed hours are kept
+# as partitions, and merged into both stores when the stream stops, or when it
+# restarts after a crash (see storage.merge_units), so the stores are not copied
+# while the stream runs. Live readers use stream_store_path.
+#
+# Records are assigned to hours and time bins by their own timestamp, not by
+# when they arrive. The watermark is the latest timestamp seen, minus
+# stream_allowed_lateness_seconds. Time bins that end before the watermark are
+# emitted, and hours that end before it are closed. Records for closed hours
+# are counted and dropped. Records for bins that were already emitted are kept
+# for the stores, but the emitted rows are not updated. Only the hours that are
+# not closed are held in memory, so memory is bounded by about one hour of
+# records plus the allowed lateness.
+#
+# Open hours are not written when the stream is interrupted. On restart, the hub
+# files are read from the start, and records of the hours that were already
+# closed are dropped.
+#
+# With --replay, the hub files in <dir> are replayed into stream_hub_dir at
+# <speed> times their real pace (see synthetic.py), and the stream ends once
+# the replay is done.
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import datetime
+import glob
+import json
+import time
+
+import numpy as np
+import pandas as pd
+from config import *
+from storage import commit_unit, hdf_storage_kwargs, merge_units, read_checkpoint, recover_checkpoint, store_lock
+from process import _add_to_proximity_chunk, _chunk_member_to_badge, _chunk_voltages, _process_proximity_tables
+from clean import _clean_filters, _filter_m2b, _filter_m2m, _filter_m5cb
+from analysis_comply import _analysis_compliance, _analysis_m1cb, _analysis_m2m_comply
+from analysis_connections import _time_bin_minutes
+
+import openbadge_analysis as ob
+import openbadge_analysis.preprocessing
+
+# Tables emitted by the stream, appended to stream_store_path
+stream_comply_store_key = 'stream/member_comply'
+stream_pair_minutes_store_key = 'stream/pair_minutes'
+
+# Clean tables, and the filters that create them from the dirty tables
+_stream_clean_filters = [('proximity/member_to_member', _filter_m2m),
+                         ('proximity/member_to_beacon', _filter_m2b),
+                         ('proximity/member_5_closest_beacons', _filter_m5cb)]
+
+
+def _local_ts(seconds):
+    """
+    Helper, converts a unix timestamp to a localized timestamp
+    """
+    return pd.to_datetime(seconds, unit='s').tz_localize('UTC').tz_convert(time_zone)
+
+
+def _hour_name(hour):
+    """
+    Helper, name of an hour (hours since the epoch), as named by group (e.g. - 20180612-10.gz)
+    """
+    return _local_ts(hour * 3600).strftime("%Y%m%d-%H") + '.gz'
+
+
+def _hour_from_name(name):
+    """
+    Helper, inverse of _hour_name()
+    """
+    local = pd.Timestamp(datetime.datetime.strptime(name.split('.')[0], "%Y%m%d-%H")).tz_localize(time_zone)
+    return int(local.value // 10**9 // 3600)
+
+
+def _bin_seconds():
+    return pd.Timedelta(time_bins_size).total_seconds()
+
+
+def _stream_metadata():
+    """
+    Helper, loads the metadata used to process, clean and analyze the records
+    """
+    members_metadata = pd.read_csv(members_metadata_path)
+    beacons_metadata = pd.read_csv(beacons_metadata_path)
+    participation_dates, battery_sundays = _clean_filters(members_metadata[members_metadata['member_id'].notnull()])
+    return {
+        'idmap': ob.preprocessing.id_to_member_mapping(members_metadata),
+        'beacons_metadata': beacons_metadata,
+        'members_by_member': members_metadata.set_index('member'),
+        'beacons_by_beacon': beacons_metadata.set_index('beacon'),
+        'participation_dates': participation_dates,
+        'battery_sundays': battery_sundays,
+    }
+
+
+def _new_stream_state(closed_until):
+    """
+    Helper, the state of a stream
+    :param closed_until: first hour that is not closed, or None
+    """
+    return {
+        'files': {},          # hub file path -> offset of the first line not read yet
+        'hours': {},          # open hour -> (scans, observations) lists, see _add_to_proximity_chunk()
+        'results': {},        # open hour -> tables of its last processing
+        'changed': set(),     # open hours with records that were not processed yet
+        'closed_until': closed_until,
+        'emitted_until': None if closed_until is None else closed_until * 3600,
+        'max_timestamp': None,
+        'counts': {'records': 0, 'dropped': 0, 'after_emit': 0, 'malformed': 0, 'hours_closed': 0},
+    }
+
+
+def _watermark(state):
+    if state['max_timestamp'] is None:
+        return None
+    return state['max_timestamp'] - stream_allowed_lateness_seconds
+
+
+def _stream_add_line(state, line):
+    """
+    Helper, adds a line of a hub file to the open hours. Lines are filtered like
+    _split_raw_data_by_hour() does
+    """
+    line = line.strip()
+    if len(line) == 0:
+        return
+    try:
+        data = json.loads(line.decode('utf-8'))
+    except ValueError:
+        state['counts']['malformed'] += 1
+        return
+    if data.get('type') != 'proximity received':
+        return
+
+    record = data['data']
+    timestamp = record['timestamp']
+    hour = int(timestamp // 3600)
+    state['counts']['records'] += 1
+    if state['closed_until'] is not None and hour < state['closed_until']:
+        state['counts']['dropped'] += 1
+        return
+    if state['emitted_until'] is not None and timestamp < state['emitted_until']:
+        state['counts']['after_emit'] += 1
+
+    if hour not in state['hours']:
+        state['hours'][hour] = ([], [])
+    _add_to_proximity_chunk(record, *state['hours'][hour])
+    state['changed'].add(hour)
+    if state['max_timestamp'] is None or timestamp > state['max_timestamp']:
+        state['max_timestamp'] = timestamp
+
+
+def _tail_hub_files(state, pattern):
+    """
+    Helper, reads the complete lines that were appended to the hub files since the last call.
+    A partial line at the end of a file is read once it's complete. A file that got shorter
+    is read again from the start
+    :return: number of lines read
+    """
+    lines_read = 0
+    for path in sorted(glob.glob(pattern)):
+        offset = state['files'].get(path, 0)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        if size < offset:
+            logger.warning("Stream - hub file {} was truncated, reading it from the start".format(path))
+            offset = 0
+        if size == offset:
+            continue
+
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(stream_read_bytes)
+        end = data.rfind(b'\n')
+        if end < 0:
+            continue
+        for line in data[:end].split(b'\n'):
+            _stream_add_line(state, line)
+            lines_read += 1
+        state['files'][path] = offset + end + 1
+    return lines_read
+
+
+def _stream_hour_tables(scans, observations, metadata):
+    """
+    Processes the records of an hour the way process, clean and analysis_comply do
+    :param scans: scans of the hour, see _add_to_proximity_chunk()
+    :param observations: observations of the hour, see _add_to_proximity_chunk()
+    :param metadata: as returned by _stream_metadata()
+    :return: dirty, clean and analysis tables, as dicts mapping store names to dataframes
+    """
+    dirty = {}
+    clean = {}
+    analysis = {}
+    scans = pd.DataFrame(scans, columns=['timestamp', 'member', 'voltage'])
+    observations = pd.DataFrame(observations, columns=['timestamp', 'member', 'observed_id', 'rssi', 'count'])
+    if len(scans) > 0:
+        dirty['other/voltages'] = _chunk_voltages(scans)
+    if len(observations) == 0:
+        return dirty, clean, analysis
+
+    dirty.update(_process_proximity_tables(_chunk_member_to_badge(observations), metadata['idmap'],
+                                           metadata['beacons_metadata']))
+
+    for key, filter_table in _stream_clean_filters:
+        if key in dirty:
+            clean[key] = filter_table(dirty[key].copy(), metadata['participation_dates'],
+                                      metadata['battery_sundays'])
+
+    m5cb = clean.get('proximity/member_5_closest_beacons')
+    m2m = clean.get('proximity/member_to_member')
+    if m5cb is not None and len(m5cb) > 0 and m2m is not None and len(m2m) > 0:
+        m1cb = _analysis_m1cb(m5cb, metadata['members_by_member'], metadata['beacons_by_beacon'])
+        m_comply = _analysis_compliance(dirty['proximity/member_to_badge'], m1cb, board_threshold=-48)
+        analysis['proximity/member_comply'] = m_comply
+        analysis['proximity/member_to_member'] = _analysis_m2m_comply(m2m, m_comply)
+    return dirty, clean, analysis
+
+
+def _hour_results(state, hour, metadata):
+    """
+    Helper, returns the tables of an open hour. An hour is only processed again if it got new records
+    """
+    if hour in state['changed'] or hour not in state['results']:
+        state['results'][hour] = _stream_hour_tables(state['hours'][hour][0], state['hours'][hour][1], metadata)
+        state['changed'].discard(hour)
+    return state['results'][hour]
+
+
+def _stream_increment(analysis, start, end):
+    """
+    Selects the compliance and per-pair minutes of the time bins in [start, end)
+    :param analysis: analysis tables of an hour, as returned by _stream_hour_tables()
+    :param start: unix timestamp, start of the first bin
+    :param end: unix timestamp, end of the last bin
+    :return: dict mapping stream store names to tables. Pair minutes are indexed by the start of
+        the time bin and the pair, with a column for each of the rssi_cutoffs (e.g. - rssi_57).
+        Each bin is emitted once, so the index is unique in the stream store
+    """
+    tables = {}
+    start_ts = _local_ts(start)
+    end_ts = _local_ts(end)
+
+    m_comply = analysis.get('proximity/member_comply')
+    if m_comply is not None:
+        datetimes = m_comply.index.get_level_values('datetime')
+        m_comply = m_comply[(datetimes >= start_ts) & (datetimes < end_ts)]
+        if len(m_comply) > 0:
+            tables[stream_comply_store_key] = m_comply.to_frame('comply')
+
+    m2m = analysis.get('proximity/member_to_member')
+    if m2m is not None and len(m2m) > 0:
+        datetimes = m2m.index.get_level_values('datetime')
+        m2m = m2m[(datetimes >= start_ts) & (datetimes < end_ts)].reset_index()
+        if len(m2m) > 0:
+            minutes = {}
+            for rssi_cutoff in rssi_cutoffs:
+                passed = m2m[m2m.rssi_max >= rssi_cutoff]
+                minutes['rssi_' + str(abs(rssi_cutoff))] = \
+                    passed.groupby(['datetime', 'member1', 'member2']).size() * _time_bin_minutes()
+            minutes = pd.DataFrame(minutes).fillna(0)
+            tables[stream_pair_minutes_store_key] = minutes[sorted(minutes.columns)]
+    return tables
+
+
+def _emit_range(state, hour, until, metadata, emit):
+    """
+    Helper, emits the bins of an hour from the last emitted bin until a given time
+    """
+    start = max(state['emitted_until'] or 0, hour * 3600)
+    end = min(until, (hour + 1) * 3600)
+    if end <= start:
+        return
+    tables = _stream_increment(_hour_results(state, hour, metadata)[2], start, end)
+    if len(tables) > 0:
+        emit(tables)
+
+
+def _emit_open_hours(state, metadata, emit):
+    """
+    Helper, emits the bins of the open hours that ended before the watermark
+    """
+    watermark = _watermark(state)
+    if watermark is None:
+        return
+    emit_until = np.floor(watermark / _bin_seconds()) * _bin_seconds()
+    for hour in sorted(state['hours']):
+        if hour * 3600 >= emit_until:
+            break
+        _emit_range(state, hour, emit_until, metadata, emit)
+    state['emitted_until'] = max(state['emitted_until'] or 0, emit_until)
+
+
+def _close_hour(state, hour, metadata, emit):
+    """
+    Helper, emits the remaining bins of an hour, commits its tables to the dirty and clean stores,
+    and drops it from memory
+    """
+    _emit_range(state, hour, (hour + 1) * 3600, metadata, emit)
+    dirty, clean, analysis = _hour_results(state, hour, metadata)
+
+    name = _hour_name(hour)
+    logger.info("Stream - closing hour {} ({} scans)".format(name, len(state['hours'][hour][0])))
+    # the dirty tables may already be there, if the stream stopped between the two commits
+    if name not in read_checkpoint(dirty_store_path, 'process')['done']:
+        commit_unit(dirty_store_path, 'process', name, sorted(dirty.items()))
+    _remove_clean_hour(hour)
+    commit_unit(clean_store_path, 'stream', name, sorted(clean.items()))
+
+    del state['hours'][hour]
+    del state['results'][hour]
+    state['changed'].discard(hour)
+    state['emitted_until'] = max(state['emitted_until'] or 0, (hour + 1) * 3600)
+    state['closed_until'] = max(state['closed_until'] or 0, hour + 1)
+    state['counts']['hours_closed'] += 1
+
+
+def _merge_closed_hours():
+    """
+    Helper, merges the hours committed by _close_hour() into the dirty and clean stores
+    """
+    merge_units(dirty_store_path, 'process')
+    merge_units(clean_store_path, 'stream')
+
+
+def _remove_clean_hour(hour):
+    """
+    Helper, removes the rows of an hour from the clean store, in case clean already cleaned it
+    from the dirty store, so closing the hour doesn't add duplicate rows
+    """
+    if not os.path.exists(clean_store_path):
+        return
+    where = "datetime >= '" + str(_local_ts(hour * 3600)) + "' & datetime < '" + \
+        str(_local_ts((hour + 1) * 3600)) + "'"
+    with store_lock(clean_store_path), pd.HDFStore(clean_store_path) as store:
+        for key, _ in _stream_clean_filters:
+            if key in store:
+                store.remove(key, where=where)
+
+
+def _close_hours(state, metadata, emit, final=False):
+    """
+    Helper, closes the open hours that ended before the watermark
+    :param final: close all the open hours
+    """
+    watermark = _watermark(state)
+    if watermark is None:
+        return
+    for hour in sorted(state['hours']):
+        if not final and (hour + 1) * 3600 > watermark:
+            break
+        _close_hour(state, hour, metadata, emit)
+    if not final:
+        # hours without records are closed too, so late records for them are dropped
+        state['closed_until'] = max(state['closed_until'] or 0, int(watermark // 3600))
+
+
+def write_stream_tables(tables):
+    """
+    Appends emitted tables to stream_store_path. The default emit function of run_stream()
+    :param tables: dict mapping stream store names to tables
+    """
+    with store_lock(stream_store_path):
+        for key in sorted(tables):
+            tables[key].to_hdf(stream_store_path, key, mode="a", format="table", append=True,
+                               **hdf_storage_kwargs(key))
+
+
+def _reset_stream_store(closed_until):
+    """
+    Helper, removes the rows of the stream store that belong to hours that are not closed.
+    They are emitted again when the hub files are read again
+    """
+    if closed_until is None:
+        try:
+            os.remove(stream_store_path)
+        except OSError:
+            pass
+        return
+    if not os.path.exists(stream_store_path):
+        return
+
+    where = "datetime >= '" + str(_local_ts(closed_until * 3600)) + "'"
+    with store_lock(stream_store_path), pd.HDFStore(stream_store_path) as store:
+        for key in [stream_comply_store_key, stream_pair_minutes_store_key]:
+            if key in store:
+                store.remove(key, where=where)
+
+
+def run_stream(emit=None, stop=None, hub_file_pattern=None):
+    """
+    Runs the streaming mode, until it's interrupted, or until stop() returns True
+    :param emit: function called with a dict mapping stream store names to the rows of newly
+        complete time bins. Defaults to write_stream_tables()
+    :param stop: function called when the hub files have no new data. When it returns True, the
+        open hours are closed and the stream ends. If None, runs until interrupted
+    :param hub_file_pattern: hub files to tail. Defaults to stream_hub_file_pattern
+    :return: dict of counts (records, dropped records, etc.)
+    """
+    pattern = stream_hub_file_pattern if hub_file_pattern is None else hub_file_pattern
+    recover_checkpoint(dirty_store_path, 'process')
+    done = recover_checkpoint(clean_store_path, 'stream')
+    closed_until = max(_hour_from_name(name) for name in done) + 1 if len(done) > 0 else None
+    if emit is None:
+        _reset_stream_store(closed_until)
+        emit = write_stream_tables
+
+    state = _new_stream_state(closed_until)
+    metadata = _stream_metadata()
+    logger.info("Streaming from {}, {} hours already closed".format(pattern, len(done)))
+
+    last_emit = time.time()
+    try:
+        while True:
+            lines_read = _tail_hub_files(state, pattern)
+            _close_hours(state, metadata, emit)
+
+            if time.time() - last_emit >= stream_emit_seconds:
+                _emit_open_hours(state, metadata, emit)
+                last_emit = time.time()
+                watermark = _watermark(state)
+                logger.info("Stream - watermark {}, {} open hours. Counts: {}".format(
+                    None if watermark is None else _local_ts(watermark), len(state['hours']), state['counts']))
+
+            if lines_read == 0:
+                # read once more after stop(), for lines written just before it returned True
+                if stop is not None and stop() and _tail_hub_files(state, pattern) == 0:
+                    break
+                time.sleep(stream_poll_seconds)
+    except KeyboardInterrupt:
+        _merge_closed_hours()
+        logger.info("Stream interrupted. {} open hours were not written, they are rebuilt on restart".format(
+            len(state['hours'])))
+        return state['counts']
+
+    _close_hours(state, metadata, emit, final=True)
+    _merge_closed_hours()
+    logger.info("Stream - done. Counts: {}".format(state['counts']))
+    return state['counts']
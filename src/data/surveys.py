@@ -0,0 +1,225 @@
+from __future__ import absolute_import, division, print_function
+
+import pandas as pd
+from config import *
+from storage import hdf_storage_kwargs, store_lock
+
+# Answer scales of the surveys. Answers are stripped of surrounding spaces before they are mapped
+survey_answer_scales = {
+    'good_bad_7': {
+        'Extremely good': 7.0,
+        'Moderately good': 6.0,
+        'Slightly good': 5.0,
+        'Neither good nor bad': 4.0,
+        'Slightly bad': 3.0,
+        'Moderately bad': 2.0,
+        'Extremely bad': 1.0,
+    },
+    'agree_7': {
+        'Strongly agree': 7.0,
+        'Agree': 6.0,
+        'Somewhat agree': 5.0,
+        'Neither agree nor disagree': 4.0,
+        'Somewhat disagree': 3.0,
+        'Disagree': 2.0,
+        'Strongly disagree': 1.0,
+    },
+    'tipi_7': {
+        'Agree strongly': 7.0,
+        'Agree moderately': 6.0,
+        'Agree a little': 5.0,
+        'Neither agree nor disagree': 4.0,
+        'Disagree a little': 3.0,
+        'Disagree moderately': 2.0,
+        'Disagree strongly': 1.0,
+    },
+    'hhh': {
+        'Hacker (you can solve any technical problem and make anything work)': 'Hacker',
+        'Hustler (you are the one who closes deals and brings back the money)': 'Hustler',
+        # spelled this way in the stored data, keep for compatibility
+        'Hipster (you are a creative design genius who makes the user experience awesome)': 'Hispster',
+    },
+    'gender': {
+        'Male': 'M',
+        'Female': 'F',
+    },
+}
+
+# Columns translated with each scale, as (column, scale, value for answers not in the scale).
+# A default of None keeps the original answer
+survey_daily_scales = [('Q1', 'good_bad_7', float('nan')), ('Q2', 'agree_7', float('nan'))]
+survey_entry_scales = [('TIPI_{}'.format(i), 'tipi_7', None) for i in range(1, 11)] + \
+                      [('HHH_type', 'hhh', None), ('gender', 'gender', 'U')]
+
+# Entry survey question ids and their names
+survey_entry_columns = {
+    'member': 'member',
+    'Q3.3': 'race',
+    'Q3.3_7_TEXT': 'race_other',
+    'Q3.2': 'age',
+    'Q3.1': 'gender',
+    'Q3.4': 'citizneships',
+    'Q5.3': 'is_cofounder',
+    'Q5.5_1_TEXT': 'title',
+    'Q5.6': 'time_in_startup',
+    'Q6.1': 'HHH_type',
+    'Q6.2': 'experience',
+    'Q7.2_1': 'TIPI_1',
+    'Q7.2_2': 'TIPI_2',
+    'Q7.2_3': 'TIPI_3',
+    'Q7.2_4': 'TIPI_4',
+    'Q7.2_5': 'TIPI_5',
+    'Q7.2_6': 'TIPI_6',
+    'Q7.2_7': 'TIPI_7',
+    'Q7.2_8': 'TIPI_8',
+    'Q7.2_9': 'TIPI_9',
+    'Q7.2_10': 'TIPI_10',
+}
+
+# TIPI traits, as (trait, item, reverse-scored item)
+survey_tipi_traits = [('extraversion', 1, 6), ('agreeableness', 7, 2), ('conscientiousness', 3, 8),
+                      ('emotional_stability', 9, 4), ('openness', 5, 10)]
+
+# Members whose daily surveys are not used (researchers)
+survey_excluded_members = ['7EYKW64FHG', 'O3PUFCVB5K']
+
+# Manual corrections of entry survey answers, as (member, column, value)
+survey_entry_corrections = [('XLIPIHEOIT', 'is_cofounder', 0), ('UAXR5EMOI2', 'gender', 'M')]
+
+
+def _translate(answers, scale_name, default):
+    """
+    Maps answers to values using one of survey_answer_scales. The scale is resolved once for each
+    distinct answer, and the result is applied to all rows with a single lookup
+    :param answers: series of answers
+    :param scale_name:
+    :param default: value for answers that are not in the scale (including missing answers).
+        None keeps the answer
+    :return:
+    """
+    scale = survey_answer_scales[scale_name]
+    distinct = answers.dropna().unique()
+    mapping = pd.Series(distinct, index=distinct).astype(str).str.strip().map(scale)
+    if default is None:
+        mapping = mapping.fillna(pd.Series(distinct, index=distinct))
+    else:
+        mapping = mapping.fillna(default)
+
+    translated = answers.map(mapping)
+    if default is not None:
+        translated[answers.isnull()] = default
+    if all(isinstance(value, float) for value in scale.values()):
+        translated = pd.to_numeric(translated, errors='ignore')
+    return translated
+
+
+def _effective_dates(recorded_dates):
+    """
+    The day a daily survey answer refers to. Answers recorded before
+    surveys_effective_date_breakpoint_hour belong to the previous day. Computed on the local
+    (naive) time, so days are correct around DST changes
+    :param recorded_dates: series of local recorded times, without time zone
+    :return: series of days (midnight, localized to time_zone)
+    """
+    days = recorded_dates.dt.normalize()
+    previous_day = (recorded_dates.dt.hour < surveys_effective_date_breakpoint_hour).astype('int64')
+    return (days - pd.to_timedelta(previous_day, unit='D')).dt.tz_localize(time_zone)
+
+
+def _in_project_time(datetimes):
+    """
+    Helper, returns a boolean series that is True for times within the project periods
+    """
+    period1_start_ts = pd.Timestamp(period1_start, tz=time_zone)
+    period1_end_ts = pd.Timestamp(period1_end, tz=time_zone)
+    period2_start_ts = pd.Timestamp(period2_start, tz=time_zone)
+    period2_end_ts = pd.Timestamp(period2_end, tz=time_zone)
+    return ((datetimes >= period1_start_ts) & (datetimes < period1_end_ts)) | \
+           ((datetimes >= period2_start_ts) & (datetimes < period2_end_ts))
+
+
+def _clean_daily_surveys(daily, members):
+    """
+    Cleans the daily survey answers. Answers are translated to numbers, and the answers of a
+    member for the same effective day are averaged (c is the number of answers)
+    :param daily: anonymized daily survey data
+    :param members: members table, indexed by member
+    :return:
+    """
+    logger.info("Daily surveys: {} answers".format(len(daily)))
+    daily = daily[daily['Progress'] == '100'].copy()
+    logger.info("Daily surveys: {} completed answers".format(len(daily)))
+
+    for column, scale_name, default in survey_daily_scales:
+        daily[column] = _translate(daily[column], scale_name, default)
+
+    daily['effective_ts'] = _effective_dates(pd.to_datetime(daily['RecordedDate']))
+
+    # Handle multiple answers per day
+    grouped = daily.groupby(['effective_ts', 'member'])
+    daily = pd.DataFrame({'Q1': grouped['Q1'].mean(), 'Q2': grouped['Q2'].mean(), 'c': grouped['Q2'].count()})
+    daily = daily[['Q1', 'Q2', 'c']].reset_index()
+
+    # Weekend answers shouldn't occur, but they do because of the effective day heuristic
+    daily = daily[daily.effective_ts.dt.dayofweek < 5]
+    daily = daily[~daily.member.isin(survey_excluded_members)]
+
+    # Remove answers from before the member was active, and before/after the experiment
+    start_dates = daily.member.map(members['start_date_ts'])
+    daily = daily[(daily.effective_ts >= start_dates) & _in_project_time(daily.effective_ts)].copy()
+    logger.info("Daily surveys: {} member-days".format(len(daily)))
+    return daily
+
+
+def _clean_entry_surveys(entry):
+    """
+    Cleans the entry survey answers, and scores the TIPI personality traits
+    :param entry: anonymized entry survey data
+    :return: table indexed by member
+    """
+    logger.info("Entry surveys: {} answers".format(len(entry)))
+    entry = entry.rename(columns=survey_entry_columns)
+
+    for column, scale_name, default in survey_entry_scales:
+        entry[column] = _translate(entry[column], scale_name, default)
+
+    # TIPI scoring: each trait is the mean of an item and a reverse-scored item
+    for trait, item, reverse_item in survey_tipi_traits:
+        entry['TIPI_' + trait] = (entry['TIPI_{}'.format(item)] + (8 - entry['TIPI_{}'.format(reverse_item)])) / 2
+    for i in range(1, 11):
+        del entry['TIPI_{}'.format(i)]
+
+    entry['is_ceo'] = entry.title.fillna("").str.contains("ceo", case=False).astype('int64')
+    # 'Yes' and 'Maybe' count as co-founders
+    entry['is_cofounder'] = (entry.is_cofounder != 'No').astype('int64')
+
+    for member, column, value in survey_entry_corrections:
+        entry.loc[entry.member == member, column] = value
+
+    return entry.set_index('member')
+
+
+def clean_surveys():
+    """
+    Cleans the daily and entry surveys, and writes them to the clean surveys store. Uses the
+    members table created by analysis_metadata()
+    :return:
+    """
+    logger.info("Cleaning surveys")
+    with store_lock(analysis_store_path):
+        members = pd.read_hdf(analysis_store_path, 'metadata/members')
+
+    tables = [
+        ('daily/daily_survey_data_clean',
+         _clean_daily_surveys(pd.read_hdf(surveys_anon_store_path, 'daily/daily_survey_data_anon'), members)),
+        ('entry/participants_entry_survey_data_clean',
+         _clean_entry_surveys(pd.read_hdf(surveys_anon_store_path, 'entry/participants_entry_survey_data_anon'))),
+    ]
+
+    with store_lock(surveys_clean_store_path):
+        for key, table in tables:
+            table.to_hdf(surveys_clean_store_path, key, mode="a", format="table", append=False,
+                         **hdf_storage_kwargs(key))
+
+    logger.info('---------------------------------------')
+    logger.info('Completed cleaning surveys!')
@@ -0,0 +1,195 @@
+################################################################################
+#                               synthetic.py
+#
+# Usage:
+#   python synthetic.py <target_dir> [hours] [start]
+#
+# Synthetic hub data, for testing the stages without the study data. Creates
+# members and beacons metadata (members.csv and beacons.csv, in the format of
+# data/metadata) and hub files with proximity records, in the format the hubs
+# write (one JSON line per record). Members scan every
+# synthetic_scan_seconds, observing the members of their company and of a
+# neighbouring company, their company beacon, and sometimes the board beacon.
+# Some records are written late, out of order, like hubs that upload records
+# after a disconnection. The data only depends on the seed.
+#
+# replay_hub_files() copies hub files into a directory at an accelerated pace,
+# like hubs appending to them during a study (see stream.py).
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import heapq
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from config import *
+
+# Seconds between the scans of a badge
+synthetic_scan_seconds = 15
+
+# Fraction of the records that are written late, and by how much (seconds)
+synthetic_late_fraction = 0.01
+synthetic_late_seconds = 90
+
+# Observed ids of beacons start here. Badges of members have lower ids (see _max_rssi_method)
+_synthetic_first_beacon_id = 16000
+
+
+def synthetic_metadata(companies=4, members_per_company=5, start_date='2018-06-12', end_date='2018-06-29'):
+    """
+    Creates members and beacons metadata. Each company has a beacon, and there's one board beacon
+    :return: members and beacons dataframes, with the columns of members.csv and beacons.csv
+    """
+    members = []
+    beacons = []
+    for c in range(companies):
+        company = 'C{:02d}'.format(c)
+        for m in range(members_per_company):
+            member_id = c * members_per_company + m + 1
+            members.append({'member': 'M{:04d}'.format(member_id), 'member_id': member_id, 'company': company,
+                            'participates': 1, 'start_date': start_date, 'end_date': end_date})
+        neighbours = ['C{:02d}'.format(n) for n in [c - 1, c + 1] if 0 <= n < companies]
+        beacons.append({'beacon': 'B{:02d}'.format(c), 'beacon_id': _synthetic_first_beacon_id + c + 1,
+                        'company': company, 'type': 'company', 'nearby_companies': ",".join(neighbours)})
+    beacons.append({'beacon': 'BOARD', 'beacon_id': _synthetic_first_beacon_id, 'company': None,
+                    'type': 'board', 'nearby_companies': None})
+
+    members = pd.DataFrame(members, columns=['member', 'member_id', 'company', 'participates',
+                                             'start_date', 'end_date'])
+    beacons = pd.DataFrame(beacons, columns=['beacon', 'beacon_id', 'company', 'type', 'nearby_companies'])
+    return members, beacons
+
+
+def synthetic_hub_records(members, beacons, start, hours, seed=0):
+    """
+    Creates the proximity records of members, in the order a hub would write them
+    :param members: members metadata, as returned by synthetic_metadata()
+    :param beacons: beacons metadata, as returned by synthetic_metadata()
+    :param start: first timestamp (anything pd.Timestamp accepts, in time_zone)
+    :param hours: number of hours
+    :param seed: random seed
+    :return: list of hub lines (dicts), ordered by arrival
+    """
+    random = np.random.RandomState(seed)
+    start = pd.Timestamp(start, tz=time_zone).value / 10**9
+    company_beacons = beacons[beacons.type == 'company'].set_index('company')['beacon_id']
+    board_id = int(beacons[beacons.type == 'board'].beacon_id.iloc[0])
+    companies = sorted(members.company.unique())
+    # (member, badge id, company position, company beacon id)
+    badges = [(m.member, int(m.member_id), companies.index(m.company), int(company_beacons[m.company]))
+              for m in members.itertuples()]
+
+    records = []
+    for scan in range(int(hours * 3600 / synthetic_scan_seconds)):
+        for member, member_id, c, beacon_id in badges:
+            timestamp = start + scan * synthetic_scan_seconds + random.uniform(0, synthetic_scan_seconds)
+            on_board = random.uniform() < 0.05
+
+            rssi_distances = {}
+            for other, other_id, other_c, _ in badges:
+                distance = abs(other_c - c)
+                if other == member or distance > 1 or random.uniform() < 0.2:
+                    continue
+                rssi = random.normal(-60 - 10 * distance, 5) - (15 if on_board else 0)
+                rssi_distances[str(other_id)] = {'rssi': round(rssi, 1), 'count': int(random.randint(1, 4))}
+            rssi_distances[str(beacon_id)] = {'rssi': round(random.normal(-58, 4), 1), 'count': 1}
+            if on_board:
+                rssi_distances[str(board_id)] = {'rssi': round(random.normal(-40, 2), 1), 'count': 1}
+
+            records.append({'type': 'proximity received',
+                            'data': {'badge_address': 'AA:BB:CC:DD:{:02X}:{:02X}'.format(c, member_id % 256),
+                                     'member': member, 'member_id': member_id,
+                                     'timestamp': round(timestamp, 3), 'voltage': round(random.normal(2.9, 0.05), 3),
+                                     'rssi_distances': rssi_distances}})
+
+    # records arrive in time order, except for the late ones
+    arrival = np.array([r['data']['timestamp'] for r in records])
+    late = random.uniform(size=len(records)) < synthetic_late_fraction
+    arrival[late] += random.uniform(0, synthetic_late_seconds, size=late.sum())
+    return [records[i] for i in np.argsort(arrival, kind='mergesort')]
+
+
+def write_synthetic_hub_files(target_dir, members, beacons, start, hours, hubs=2, seed=0):
+    """
+    Writes synthetic hub files, one per hub. Members are assigned to hubs by company
+    :return: list of paths
+    """
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    companies = sorted(members.company.unique())
+    paths = [os.path.join(target_dir, 'badgepi-{:02d}_proximity_synthetic.txt'.format(hub + 1)) for hub in range(hubs)]
+    hub_of_member = dict((m.member, companies.index(m.company) % hubs) for m in members.itertuples())
+    files = [open(path, 'w') for path in paths]
+    try:
+        for record in synthetic_hub_records(members, beacons, start, hours, seed):
+            f = files[hub_of_member[record['data']['member']]]
+            json.dump(record, f)
+            f.write('\n')
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def _paced_lines(path):
+    """
+    Helper, yields (time, path, line) for the lines of a hub file. The time of a line is the latest
+    timestamp up to it, so late records are written when they arrived
+    """
+    latest = None
+    with open(path, 'rb') as f:
+        for line in f:
+            timestamp = json.loads(line.decode('utf-8'))['data']['timestamp']
+            latest = timestamp if latest is None else max(latest, timestamp)
+            yield latest, path, line
+
+
+def replay_hub_files(source_paths, target_dir, speed=60.0):
+    """
+    Copies hub files into a directory line by line, at speed times the pace of their timestamps.
+    Files with the same names in target_dir are replaced
+    :param source_paths: hub files
+    :param target_dir:
+    :param speed: e.g. - 60 replays an hour in a minute
+    :return:
+    """
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    targets = dict((path, open(os.path.join(target_dir, os.path.basename(path)), 'wb')) for path in source_paths)
+    logger.info("Replaying {} hub files into {}, {}x".format(len(source_paths), target_dir, speed))
+    try:
+        start_wall = time.time()
+        first = None
+        for timestamp, path, line in heapq.merge(*[_paced_lines(path) for path in source_paths]):
+            first = timestamp if first is None else first
+            delay = (timestamp - first) / speed - (time.time() - start_wall)
+            if delay > 0:
+                for f in targets.values():
+                    f.flush()
+                time.sleep(delay)
+            targets[path].write(line)
+    finally:
+        for f in targets.values():
+            f.close()
+    logger.info("Replay done")
+
+
+def main():
+    target_dir = sys.argv[1]
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+    start = sys.argv[3] if len(sys.argv) > 3 else period1_start
+
+    members, beacons = synthetic_metadata()
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    members.to_csv(os.path.join(target_dir, members_metadata_filename), index=False)
+    beacons.to_csv(os.path.join(target_dir, beacons_metadata_filename), index=False)
+    for path in write_synthetic_hub_files(target_dir, members, beacons, start, hours):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+################################################################################
+#                               workers.py
+#
+# Runs tasks in worker processes, keeping the memory they use under a ceiling.
+# The memory a task needs is predicted from the size of its input file, using
+# the peak memory (RSS) measured on earlier tasks, and new tasks are only
+# started when the predicted memory of all in-flight tasks fits under the
+# ceiling. New tasks are also held back while the machine is low on available
+# memory, and a task that grows far beyond its prediction is stopped before it
+# pushes the machine into swap, and runs again later on its own.
+#
+# Each task runs in a new worker process, started with worker_start_method. With
+# 'forkserver', workers are forked from a server process that imported
+# worker_preload_modules once, so starting a worker doesn't import pandas
+# again, and doesn't copy the memory of the parent (which holds the results
+# that wait to be written).
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import multiprocessing
+import os
+import resource
+import threading
+import time
+
+from config import *
+from logs import setup_worker_logging, worker_logging
+
+# exit code of a task stopped by the RSS guard
+_rss_guard_exit_code = 75
+
+# the RSS guard never stops a task below this, so small tasks aren't stopped by normal jitter
+_rss_guard_min_bytes = 512 * 1024**2
+
+# start method -> multiprocessing context, see worker_context()
+_contexts = {}
+
+
+def worker_context(start_method=None):
+    """
+    The multiprocessing context to start workers with. The forkserver is started, with
+    worker_preload_modules imported, the first time a worker is started with it
+    :param start_method: 'fork' or 'forkserver'. Defaults to worker_start_method. Falls back to
+        the default start method where it's not available
+    :return:
+    """
+    start_method = worker_start_method if start_method is None else start_method
+    if start_method not in _contexts:
+        if not hasattr(multiprocessing, 'get_context') or \
+                start_method not in multiprocessing.get_all_start_methods():
+            logger.debug("Start method %s is not available, using the default", start_method)
+            _contexts[start_method] = multiprocessing
+        else:
+            context = multiprocessing.get_context(start_method)
+            if start_method == 'forkserver':
+                context.set_forkserver_preload(worker_preload_modules)
+            _contexts[start_method] = context
+    return _contexts[start_method]
+
+
+def _page_size():
+    return os.sysconf('SC_PAGE_SIZE')
+
+
+def total_memory():
+    """
+    Physical memory of the machine, in bytes
+    """
+    return os.sysconf('SC_PHYS_PAGES') * _page_size()
+
+
+def available_memory():
+    """
+    Memory available for new processes, in bytes (MemAvailable in /proc/meminfo). Returns None
+    where it's not available
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def _current_rss():
+    """
+    Helper, current RSS of this process in bytes, or None where it's not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _page_size()
+    except IOError:
+        return None
+
+
+def _peak_rss():
+    """
+    Helper, peak RSS of this process in bytes. ru_maxrss is in kilobytes on Linux
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _rss_guard(limit):
+    """
+    Helper, runs in a thread of the worker. Stops the worker if its RSS goes over the limit
+    """
+    while True:
+        rss = _current_rss()
+        if rss is None:
+            return
+        if rss > limit:
+            logger.error("Worker {} RSS {:.0f} MB is over its limit of {:.0f} MB, stopping it".format(
+                os.getpid(), rss / 1024**2, limit / 1024**2))
+            os._exit(_rss_guard_exit_code)
+        time.sleep(0.2)
+
+
+def _run_task(func, item, conn, rss_limit, logging_setup):
+    """
+    Helper, runs a single task in a worker process and sends back its result, along with the
+    memory it used (peak RSS minus the RSS the worker started with)
+    """
+    setup_worker_logging(logging_setup)
+    start_rss = _current_rss() or 0
+    if rss_limit is not None:
+        guard = threading.Thread(target=_rss_guard, args=(start_rss + rss_limit,))
+        guard.daemon = True
+        guard.start()
+
+    result = func(item)
+    conn.send((result, max(_peak_rss() - start_rss, 0)))
+    conn.close()
+
+
+def _receive_result(conn):
+    """
+    Helper, receives the result of a task if the worker sent it
+    :return: (result, memory used), or None if nothing was sent yet, or the worker exited
+        without sending a result (EOF)
+    """
+    if not conn.poll():
+        return None
+    try:
+        return conn.recv()
+    except EOFError:
+        return None
+
+
+def memory_ceiling():
+    """
+    Memory that the workers may use, in bytes. worker_memory_limit if set, otherwise
+    worker_memory_fraction of the physical memory
+    """
+    if worker_memory_limit is not None:
+        return worker_memory_limit
+    return int(total_memory() * worker_memory_fraction)
+
+
+def adaptive_imap(func, items, sizes, max_workers, name='tasks', start_method=None):
+    """
+    Like Pool.imap(), but the number of tasks running at once is adapted to their memory use.
+    Each task runs in a new worker process. Until the first task is done, tasks run one at a
+    time. Then, the memory a task needs is predicted from its input size, using a fixed cost (the
+    lowest memory seen) plus a cost per input byte (the highest seen), times worker_memory_safety.
+    Tasks are started as long as the predictions of the in-flight tasks fit under memory_ceiling().
+    A task whose RSS goes over worker_rss_guard_factor times its prediction is stopped and retried
+    alone. Decisions are logged
+    :param func: module level function, called with a single item
+    :param items: list of items
+    :param sizes: list of input sizes in bytes, one per item (e.g. - file sizes)
+    :param max_workers: maximal number of tasks to run at once
+    :param name: name of the tasks, for the log
+    :param start_method: see worker_context()
+    :return: generator of results, in the order of items
+    """
+    ceiling = memory_ceiling()
+    context = worker_context(start_method)
+    logging_setup = worker_logging()
+    logger.info("Running {} {}. Memory ceiling {:.0f} MB, at most {} at once".format(
+        len(items), name, ceiling / 1024**2, max_workers))
+
+    fixed_cost = None
+    bytes_per_input_byte = None
+    samples = []
+    pending = list(range(len(items)))
+    retry_alone = set()
+    running = {}
+    results = {}
+    next_result = 0
+    while next_result < len(items):
+        # yield the results that are ready, in order
+        while next_result in results:
+            yield results.pop(next_result)
+            next_result += 1
+        if next_result >= len(items):
+            break
+
+        # start new tasks while the predicted memory fits. Results waiting to be yielded are in
+        # memory too, so they count as in-flight. When nothing is running, a task is always started,
+        # so the next result in order is never blocked
+        in_flight = len(running) + len(results)
+        predicted_total = sum(task[2] or 0 for task in running.values())
+        # tasks without a prediction run alone
+        running_alone = any(task[2] is None for task in running.values())
+        while len(pending) > 0 and (in_flight < max_workers or len(running) == 0):
+            i = pending[0]
+            if bytes_per_input_byte is None or i in retry_alone:
+                predicted = None
+                fits = len(running) == 0
+            else:
+                predicted = (fixed_cost + sizes[i] * bytes_per_input_byte) * worker_memory_safety
+                fits = len(running) == 0 or (not running_alone and predicted_total + predicted <= ceiling)
+
+            available = available_memory()
+            if fits and len(running) > 0 and available is not None and available < worker_memory_reserve:
+                logger.info("Holding back {}: only {:.0f} MB available, {} running".format(
+                    name, available / 1024**2, len(running)))
+                fits = False
+            if not fits:
+                break
+
+            rss_limit = None
+            if predicted is not None:
+                rss_limit = max(predicted * worker_rss_guard_factor, _rss_guard_min_bytes)
+            parent_conn, child_conn = context.Pipe(duplex=False)
+            process = context.Process(target=_run_task, args=(func, items[i], child_conn, rss_limit, logging_setup))
+            process.start()
+            child_conn.close()
+            running[i] = (process, parent_conn, predicted)
+            pending.pop(0)
+            in_flight += 1
+            predicted_total += predicted or 0
+            running_alone = running_alone or predicted is None
+            logger.debug("Started {} {}/{} ({:.1f} MB input, predicted {}), {} running".format(
+                name, i+1, len(items), sizes[i] / 1024**2,
+                "unknown" if predicted is None else "{:.0f} MB".format(predicted / 1024**2), len(running)))
+
+        # collect finished tasks
+        time.sleep(0.1)
+        for i, (process, conn, predicted) in list(running.items()):
+            received = _receive_result(conn)
+            if received is None and not process.is_alive():
+                # the worker may have sent its result and exited after the first poll
+                received = _receive_result(conn)
+                if received is None:
+                    process.join()
+                    del running[i]
+                    if process.exitcode == _rss_guard_exit_code and i not in retry_alone:
+                        logger.warning("{} {}/{} was stopped by the RSS guard, it will run again alone".format(
+                            name, i+1, len(items)))
+                        retry_alone.add(i)
+                        pending.insert(0, i)
+                        continue
+                    raise RuntimeError("{} {}/{} failed with exit code {}, without a result".format(
+                        name, i+1, len(items), process.exitcode))
+            if received is None:
+                continue
+
+            result, used = received
+            process.join()
+            del running[i]
+            results[i] = result
+            samples.append((sizes[i], used))
+            estimate = (fixed_cost, bytes_per_input_byte)
+            fixed_cost = min(u for _, u in samples)
+            bytes_per_input_byte = max((u - fixed_cost) / max(size, 1) for size, u in samples)
+            if (fixed_cost, bytes_per_input_byte) != estimate:
+                logger.info("{}: memory estimate is now {:.0f} MB + {:.1f} bytes per input byte ({} samples)".format(
+                    name, fixed_cost / 1024**2, bytes_per_input_byte, len(samples)))
+            logger.debug("Finished {} {}/{}: {:.0f} MB peak".format(name, i+1, len(items), used / 1024**2))
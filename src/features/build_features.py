@@ -0,0 +1,292 @@
+################################################################################
+#                           build_features.py
+#
+# Usage:
+#   python build_features.py [panel ...] [--no-cache]
+#
+# Builds the member and company panels (by default, all the panels in
+# feature_panels) and writes them to analysis_notebooks_store_path, under
+# panels/<name>.
+#
+# Each panel is declared as a base table and a list of features. A feature is
+# a set of columns taken from a named source table (feature_sources), either
+# as is, or aggregated by a column of the source. Before building, the
+# features of all the panels are planned together, so each source table is
+# read once, and grouped once per grouping column for all the columns and
+# aggregations that use it. Aggregates are cached under features_cache_dir,
+# keyed by the aggregation and by the modification times of the source stores,
+# so rebuilding after a change only recomputes what depends on it.
+################################################################################
+
+from __future__ import absolute_import, division, print_function
+import hashlib
+import os
+import sys
+import time
+from collections import namedtuple, OrderedDict
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data'))
+from config import *
+from logs import setup_logging, stop_logging
+from storage import hdf_storage_kwargs
+from snapshots import current_analysis_snapshot
+
+# path, key - where the table is stored. Tables of the analysis store are read from its current
+#   snapshot (see snapshots.py)
+# requires - other sources used to prepare it
+# prepare - function(table, sources) that returns the prepared table, or None
+Source = namedtuple('Source', ['path', 'key', 'requires', 'prepare'])
+
+# source - name of the source table
+# by - column to group by, or None to take the columns as they are (the source must be indexed
+#   like the panel)
+# columns - columns to use. None for all the columns (only when by is None)
+# aggs - aggregations (e.g. - ['mean', 'count']). Aggregated columns are named <column>_<agg>
+# rename - dict for renaming the resulting columns, or None
+Feature = namedtuple('Feature', ['source', 'by', 'columns', 'aggs', 'rename'])
+
+# name - panel name, stored as panels/<name>
+# base - feature that defines the rows of the panel
+# base_derive - function(panel) that adds columns to the base, or None
+# features - features joined to the base (left join)
+# derive - function(panel) that adds or fixes columns after the joins, or None
+# query - rows to keep, or None
+Panel = namedtuple('Panel', ['name', 'base', 'base_derive', 'features', 'derive', 'query'])
+
+milestones_columns = ['m1_rank', 'm2_rank', 'm3_rank', 'm123_rank', 'm123_total']
+subjective_aggs = ['mean', 'count', 'min', 'max', 'var']
+
+
+def _prepare_daily_surveys(daily, sources):
+    """
+    Adds the company of each member to the daily surveys. Answers of members that are not in
+    the members table (researchers) are dropped
+    """
+    return daily.reset_index(drop=True).join(sources['members']['company'], on='member', how='inner')
+
+
+def _prepare_milestones(milestones, sources):
+    """
+    Indexes the milestones by company, and adds the percentile of each milestone rank
+    """
+    milestones = milestones[['company'] + milestones_columns].set_index('company').sort_index()
+    percentiles = milestones.rank(pct=True)
+    percentiles.columns = [column + "_percentile" for column in percentiles.columns]
+    return milestones.join(percentiles)
+
+
+def _derive_members_base(panel):
+    panel['is_participant'] = (panel.company != "Staff").astype(int)
+    return panel
+
+
+def _derive_members_panel(panel):
+    panel['is_ceo'] = panel['is_ceo'].fillna(0).astype(int)
+    panel['is_cofounder'] = panel['is_cofounder'].fillna(0).astype(int)
+    return panel
+
+
+def _derive_company_base(panel):
+    # count potential dyads
+    panel['dyads_count'] = (panel.members_count * (panel.members_count - 1) / 2).astype(int)
+    return panel
+
+
+feature_sources = {
+    'members': Source(analysis_store_path, 'metadata/members', [], None),
+    'entry_surveys': Source(surveys_clean_store_path, 'entry/participants_entry_survey_data_clean', [], None),
+    'daily_surveys': Source(surveys_clean_store_path, 'daily/daily_survey_data_clean', ['members'],
+                            _prepare_daily_surveys),
+    'milestones': Source(performance_clean_store_path, 'performance/milestones', [], _prepare_milestones),
+}
+
+feature_panels = [
+    Panel('members_panel',
+          Feature('members', None, None, None, None),
+          _derive_members_base,
+          [Feature('entry_surveys', None, None, None, None),
+           Feature('daily_surveys', 'member', ['Q1', 'Q2'], subjective_aggs, None)],
+          _derive_members_panel,
+          None),
+    Panel('company_panel',
+          Feature('members', 'company', ['member'], ['count'], {'member_count': 'members_count'}),
+          _derive_company_base,
+          [Feature('milestones', None, milestones_columns + [c + "_percentile" for c in milestones_columns],
+                   None, None),
+           Feature('daily_surveys', 'company', ['Q1', 'Q2'], subjective_aggs, None)],
+          None,
+          'company not in ("EIR","Staff")'),
+]
+
+
+def _source_path(source):
+    """
+    Helper, the store to read a source from
+    """
+    if source.path == analysis_store_path:
+        return current_analysis_snapshot()
+    return source.path
+
+
+def _source_signature(name):
+    """
+    Helper, identifies the current content of a source: the modification time and size of its
+    store, and of the stores of the sources it requires
+    """
+    source = feature_sources[name]
+    path = _source_path(source)
+    file_stat = os.stat(path)
+    signature = [(path, source.key, file_stat.st_mtime, file_stat.st_size)]
+    for required in source.requires:
+        signature += _source_signature(required)
+    return signature
+
+
+def _load_source(name, sources):
+    """
+    Helper, loads a source table (and the sources it requires) into sources, once
+    """
+    if name in sources:
+        return sources[name]
+
+    source = feature_sources[name]
+    for required in source.requires:
+        _load_source(required, sources)
+
+    logger.info("Features - reading {}".format(name))
+    table = pd.read_hdf(_source_path(source), source.key)
+    if source.prepare is not None:
+        table = source.prepare(table, sources)
+    sources[name] = table
+    return table
+
+
+def plan_features(panels):
+    """
+    Plans the aggregations needed by a list of panels. Features that group the same source by the
+    same column are merged into a single aggregation
+    :param panels:
+    :return: OrderedDict mapping (source, by) to (columns, aggs), for the grouped features
+    """
+    plan = OrderedDict()
+    for panel in panels:
+        for feature in [panel.base] + panel.features:
+            if feature.by is None:
+                continue
+            columns, aggs = plan.get((feature.source, feature.by), ([], []))
+            columns = columns + [c for c in feature.columns if c not in columns]
+            aggs = aggs + [a for a in feature.aggs if a not in aggs]
+            plan[(feature.source, feature.by)] = (columns, aggs)
+    return plan
+
+
+def _cache_path(source, by, columns, aggs):
+    """
+    Helper, path of the cached result of an aggregation
+    """
+    content = repr((source, by, columns, aggs, _source_signature(source)))
+    return os.path.join(features_cache_dir, hashlib.md5(content.encode('utf-8')).hexdigest() + '.pkl')
+
+
+def _aggregate(source, by, columns, aggs, sources, use_cache):
+    """
+    Helper, groups a source by a column and aggregates the columns, using the cache
+    :return: table indexed by the grouping column, with columns named <column>_<agg>
+    """
+    path = _cache_path(source, by, columns, aggs)
+    if use_cache and os.path.exists(path):
+        logger.info("Features - {} by {}: cached".format(source, by))
+        return pd.read_pickle(path)
+
+    logger.info("Features - {} by {}: {} columns, {}".format(source, by, len(columns), aggs))
+    table = _load_source(source, sources).reset_index()
+    aggregated = table.groupby(by)[columns].agg(aggs)
+    aggregated.columns = ["_".join(column) for column in aggregated.columns.ravel()]
+
+    if use_cache:
+        if not os.path.exists(features_cache_dir):
+            os.makedirs(features_cache_dir)
+        aggregated.to_pickle(path + '.tmp')
+        os.rename(path + '.tmp', path)
+    return aggregated
+
+
+def _feature_table(feature, aggregates, sources):
+    """
+    Helper, returns the columns of a feature
+    """
+    if feature.by is None:
+        table = _load_source(feature.source, sources)
+        if feature.columns is not None:
+            table = table[feature.columns]
+        table = table.copy()
+    else:
+        names = [column + "_" + agg for column in feature.columns for agg in feature.aggs]
+        table = aggregates[(feature.source, feature.by)][names].copy()
+
+    if feature.rename is not None:
+        table = table.rename(columns=feature.rename)
+    return table
+
+
+def build_panels(names=None, use_cache=True):
+    """
+    Builds panels
+    :param names: names of the panels to build. Defaults to all the panels in feature_panels
+    :param use_cache: use (and update) the cache of aggregates
+    :return: OrderedDict mapping panel names to panels
+    """
+    panels = [p for p in feature_panels if names is None or len(names) == 0 or p.name in names]
+    unknown = set(names or []) - set(p.name for p in feature_panels)
+    if len(unknown) > 0:
+        raise ValueError("Unknown panels: {}. Use any of {}".format(
+            sorted(unknown), [p.name for p in feature_panels]))
+
+    sources = {}
+    aggregates = {}
+    for (source, by), (columns, aggs) in plan_features(panels).items():
+        aggregates[(source, by)] = _aggregate(source, by, columns, aggs, sources, use_cache)
+
+    built = OrderedDict()
+    for panel in panels:
+        logger.info("Features - building {}".format(panel.name))
+        table = _feature_table(panel.base, aggregates, sources)
+        if panel.base_derive is not None:
+            table = panel.base_derive(table)
+        for feature in panel.features:
+            table = table.join(_feature_table(feature, aggregates, sources))
+        if panel.derive is not None:
+            table = panel.derive(table)
+        if panel.query is not None:
+            table = table.query(panel.query).copy()
+        built[panel.name] = table
+    return built
+
+
+def write_panels(panels):
+    """
+    Writes panels to analysis_notebooks_store_path, under panels/<name>
+    :param panels: dict mapping panel names to panels, as returned by build_panels()
+    """
+    for name, panel in panels.items():
+        key = 'panels/' + name
+        logger.info("Features - writing {} ({} rows)".format(key, len(panel)))
+        panel.to_hdf(analysis_notebooks_store_path, key, mode="a", format="table", append=False,
+                     **hdf_storage_kwargs(key))
+
+
+def main():
+    start_time = time.time()
+    setup_logging()
+    try:
+        names = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+        write_panels(build_panels(names, use_cache="--no-cache" not in sys.argv))
+    finally:
+        stop_logging()
+    print("Total runtime: %s seconds" % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()